@@ -0,0 +1,554 @@
+"""
+Benchmarks for textllm performance work. These are not part of the test suite and
+never call a live provider.
+
+    $ python bench_textllm.py --help
+    $ python bench_textllm.py worker -n 20
+"""
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from textwrap import dedent
+
+from textllm_mock import MockServer
+
+HERE = Path(__file__).resolve().parent
+TEXTLLM = str(HERE / "textllm.py")
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.removeprefix("bench_")] = func
+    return func
+
+
+def has_litellm():
+    return importlib.util.find_spec("litellm") is not None
+
+
+def timed_runs(argv, env, n):
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        subprocess.run(argv, env=env, cwd=HERE, check=True, capture_output=True)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def report(label, times):
+    print(
+        f"{label:<28} "
+        f"median {1000 * statistics.median(times):8.1f} ms   "
+        f"mean {1000 * statistics.mean(times):8.1f} ms   "
+        f"(n={len(times)})"
+    )
+
+
+@benchmark
+def bench_worker(n=10):
+    """Cold in-process calls vs. calls forwarded to a warm `textllm serve` worker."""
+    scenarios = [("fake", "1")]
+    if has_litellm():
+        scenarios.append(("stub", "0"))
+    else:
+        print("LiteLLM is not installed. Skipping the stub server scenario")
+
+    with tempfile.TemporaryDirectory() as tmpdir, MockServer() as stub:
+        for name, test_mode in scenarios:
+            convo = Path(tmpdir) / f"{name}.md"
+            convo.write_text(dedent(f"""\
+                # bench
+
+                ```toml
+                model = "openai/stub-model"
+                api_base = "{stub.url}"
+                api_key = "sk-stub"
+                ```
+
+                --- User ---
+                """))
+            socket_path = os.path.join(tmpdir, f"{name}.sock")
+            env = os.environ | {"TEXTLLM_TEST_MODE": test_mode}
+            argv = [sys.executable, TEXTLLM, str(convo), "--prompt", "hi", "-q"]
+
+            cold = timed_runs(argv, env | {"TEXTLLM_SOCKET": ""}, n)
+
+            worker = subprocess.Popen(
+                [sys.executable, TEXTLLM, "serve", "--socket", socket_path, "-q"],
+                env=env,
+            )
+            try:
+                while not os.path.exists(socket_path):
+                    time.sleep(0.05)
+                warm = timed_runs(argv, env | {"TEXTLLM_SOCKET": socket_path}, n)
+            finally:
+                worker.terminate()
+                worker.wait()
+
+            report(f"{name}: cold (in-process)", cold)
+            report(f"{name}: warm (worker)", warm)
+
+
+@benchmark
+def bench_backends(n=10):
+    """Fresh-interpreter time for one streamed call through each backend."""
+    backends = ["openai-compat"]
+    if has_litellm():
+        backends.append("litellm")
+    else:
+        print("LiteLLM is not installed. Skipping the litellm backend")
+
+    script = dedent("""\
+        import sys
+        import textllm
+        chunks = textllm.iter_completion_text(
+            model="openai/stub-model",
+            messages=[{"role": "user", "content": "hi"}],
+            settings={
+                "textllm_backend": sys.argv[1],
+                "api_base": sys.argv[2],
+                "api_key": "sk-stub",
+            },
+        )
+        assert "".join(text for text, _ in chunks)
+        """)
+    env = os.environ | {"TEXTLLM_TEST_MODE": "0", "TEXTLLM_SOCKET": ""}
+    with MockServer() as stub:
+        for backend in backends:
+            argv = [sys.executable, "-c", script, backend, stub.url]
+            report(backend, timed_runs(argv, env, n))
+
+
+def timed_calls(func, n):
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+@benchmark
+def bench_images(n=10, count=50, size=512 * 1024):
+    """Parse a synthetic 50-image conversation with and without image caching."""
+    import textllm
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        lines = []
+        for ii in range(count):
+            (tmpdir / f"img{ii}.png").write_bytes(os.urandom(size))
+            lines.append(f"--- User ---\n\nLook at this\n![](img{ii}.png)\n")
+            lines.append("--- Assistant ---\n\nOK\n")
+        convo = tmpdir / "images.md"
+        convo.write_text("\n".join(lines) + "--- User ---\n\nSummarize\n")
+
+        def fresh_process():
+            textllm._IMAGE_MEMO.clear()
+            textllm.Conversation(convo)
+
+        env0 = os.environ.copy()
+        try:
+            os.environ["TEXTLLM_CACHE_DIR"] = str(tmpdir / "cache")
+            os.environ.pop("TEXTLLM_IMAGE_CACHE", None)
+            report("no cache", timed_calls(fresh_process, n))
+
+            os.environ["TEXTLLM_IMAGE_CACHE"] = "1"
+            fresh_process()  # Fill the disk cache
+            report("disk cache (new process)", timed_calls(fresh_process, n))
+            report(
+                "in-process dedup",
+                timed_calls(lambda: textllm.Conversation(convo), n),
+            )
+        finally:
+            os.environ.clear()
+            os.environ.update(env0)
+
+
+@benchmark
+def bench_title(n=5, latency=0.5):
+    """First-turn time-to-first-token with sequential vs. overlapped titles."""
+    import textllm
+
+    iter_test_chunks = textllm._iter_test_chunks
+    first_token = []
+
+    def slow_chunks(messages):
+        time.sleep(latency)  # Injected model latency for every request
+        if any(msg["role"] == "user" for msg in messages):  # Not the title call
+            first_token.append(time.perf_counter())
+        yield from iter_test_chunks(messages)
+
+    def first_turn(overlap):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "title.md"
+            path.write_text(textllm.CONFIG.TEMPLATE + "A first question")
+            convo = textllm.Conversation(path)
+            first_token.clear()
+            t0 = time.perf_counter()
+            with open(os.devnull, "w") as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    if overlap:
+                        convo.chat(set_title=True)
+                    else:
+                        convo.set_title()
+                        convo.chat()
+                finally:
+                    sys.stdout = stdout
+            return first_token[0] - t0
+
+    textllm.TEST_MODE, textllm._iter_test_chunks = True, slow_chunks
+    try:
+        print(f"Injected latency per request: {1000 * latency:.0f} ms")
+        for label, overlap in [("sequential title", False), ("overlapped", True)]:
+            report(f"TTFT {label}", [first_turn(overlap) for _ in range(n)])
+    finally:
+        textllm.TEST_MODE, textllm._iter_test_chunks = False, iter_test_chunks
+
+
+@benchmark
+def bench_replay(n=10, chunks=2000):
+    """Full chat path (stream, print, append) fed from a cassette without pacing.
+
+    Uses the cassette in $TEXTLLM_REPLAY if set, e.g. one recorded with
+    $TEXTLLM_RECORD, and otherwise a synthetic one with `chunks` chunks.
+    """
+    import textllm
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        cassette = os.environ.get("TEXTLLM_REPLAY")
+        if not cassette:
+            cassette = tmpdir / "synthetic.jsonl"
+            recorded = [
+                [0.3 + ii * 0.01, {"choices": [{"delta": {"content": "word "}}]}]
+                for ii in range(chunks)
+            ]
+            line = {"key": "", "model": "synthetic", "chunks": recorded}
+            cassette.write_text(json.dumps(line) + "\n")
+
+        path = tmpdir / "replay.md"
+        env0 = os.environ.copy()
+        os.environ |= {
+            "TEXTLLM_REPLAY": str(cassette),
+            "TEXTLLM_REPLAY_ANY": "1",
+            "TEXTLLM_REPLAY_SPEED": "0",
+            "TEXTLLM_SOCKET": "",
+        }
+
+        def one_turn():
+            path.write_text(textllm.CONFIG.TEMPLATE + "Replay please")
+            with open(os.devnull, "w") as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    textllm.Conversation(path).chat()
+                finally:
+                    sys.stdout = stdout
+
+        try:
+            report("chat from cassette", timed_calls(one_turn, n))
+        finally:
+            os.environ.clear()
+            os.environ.update(env0)
+
+
+@benchmark
+def bench_load(n=3, files=32, jobs=8):
+    """`textllm batch` against the mock server with realistic latency.
+
+    The real backend code runs (LiteLLM if installed, else openai-compat). With
+    enough jobs the wall time approaches one request's latency per `jobs` files.
+    """
+    import textllm
+
+    backend = "litellm" if has_litellm() else "openai-compat"
+    print(f"Backend: {backend}. {files} files, {jobs} jobs")
+    env0 = os.environ.copy()
+    with MockServer(ttft=0.3, tokens_per_sec=200, tokens=100) as mock:
+        os.environ |= {"TEXTLLM_TEST_MODE": "0", "TEXTLLM_SOCKET": ""}
+
+        def one_batch():
+            with tempfile.TemporaryDirectory() as tmpdir:
+                paths = []
+                for ii in range(files):
+                    path = Path(tmpdir) / f"load{ii}.md"
+                    path.write_text(dedent(f"""\
+                        # Load {ii}
+
+                        ```toml
+                        model = "openai/mock-model"
+                        api_base = "{mock.url}"
+                        api_key = "sk-mock"
+                        textllm_backend = "{backend}"
+                        ```
+
+                        --- User ---
+
+                        Question {ii}
+                        """))
+                    paths.append(path)
+                with open(os.devnull, "w") as devnull:
+                    stdout, sys.stdout = sys.stdout, devnull
+                    try:
+                        textllm.run_batch(paths, jobs=jobs, title=False)
+                    finally:
+                        sys.stdout = stdout
+
+        try:
+            report("batch wall time", timed_calls(one_batch, n))
+        finally:
+            os.environ.clear()
+            os.environ.update(env0)
+        print(f"Mock server: {dict(mock.stats)}")
+
+
+@benchmark
+def bench_sinks(n=5, chunks=50_000):
+    """Stream many small chunks to a pipe: per-chunk flush vs. block buffering."""
+    import textllm
+
+    def stream_to_pipe(per_chunk):
+        read_fd, write_fd = os.pipe()
+        drain = threading.Thread(
+            target=lambda: [None for _ in iter(lambda: os.read(read_fd, 65536), b"")]
+        )
+        drain.start()
+        with open(write_fd, "w") as pipe:
+            sink = textllm.TerminalSink(pipe)
+            if per_chunk:
+                sink.interval = sink.max_chars = 0
+            with sink:
+                for _ in range(chunks):
+                    sink.write("tok ")
+        drain.join()
+        os.close(read_fd)
+
+    print(f"{chunks} chunks")
+    report("per-chunk flush", timed_calls(lambda: stream_to_pipe(True), n))
+    report("block-buffered (pipe)", timed_calls(lambda: stream_to_pipe(False), n))
+
+
+def synthetic_conversation(size):
+    """Markdown conversation text of about `size` bytes with code, images, and
+    escaped markers."""
+    turn = dedent("""\
+        --- User ---
+
+        Here is a question about the code below, with an image for context.
+        ![diagram](https://example.com/diagram.png)
+
+        ```python
+        def f(x):
+            return x + 1
+        ```
+
+        --- Assistant ---
+
+        The function adds one. A literal marker in the reply is escaped:
+        \\--- User ---
+        Long lines of prose follow so that the text is not all markup. Lorem ipsum
+        dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.
+
+        """)
+    return "# Synthetic\n\n" + turn * (size // len(turn) + 1)
+
+
+@benchmark
+def bench_parse(n=3, sizes=(1, 10, 100)):
+    """Parse 1, 10, and 100 MB conversations: single-pass scanner vs. the old
+    regex split and double unescape (kept in test_textllm.py as a reference)."""
+    import textllm
+
+    env0 = os.environ.copy()
+    from test_textllm import legacy_loads  # Sets test environment variables
+
+    os.environ.clear()
+    os.environ.update(env0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mb in sizes:
+            text = synthetic_conversation(mb * 1024 * 1024)
+            path = Path(tmpdir) / f"{mb}mb.md"
+            path.write_text(text)
+
+            def from_file():
+                with open(path, "rt") as fp:
+                    textllm.parse_lines(fp)
+
+            assert textllm.loads(text) == legacy_loads(text)
+            report(f"{mb} MB legacy", timed_calls(lambda: legacy_loads(text), n))
+            report(f"{mb} MB loads(text)", timed_calls(lambda: textllm.loads(text), n))
+            report(f"{mb} MB parse_lines(file)", timed_calls(from_file, n))
+
+
+@benchmark
+def bench_memory(n=1, mb=16, images=8):
+    """Peak traced memory loading a large text and an image conversation, with
+    and without `low_memory`."""
+    import tracemalloc
+
+    import textllm
+
+    def traced(func):
+        """`(kept, peak)` MB while the result of `func` is still alive."""
+        tracemalloc.start()
+        try:
+            result = func()  # Kept alive while measuring
+            return [mem / 1024 / 1024 for mem in tracemalloc.get_traced_memory()]
+        finally:
+            tracemalloc.stop()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        log_line = "2026-10-18 12:00:00 INFO worker[42]: processed request in 12 ms\n"
+        text_path = tmpdir / "text.md"
+        with text_path.open("wt") as fp:
+            for ii in range(mb):  # One 1 MB message per turn
+                fp.write(f"--- {['User', 'Assistant'][ii % 2]} ---\n\n")
+                fp.write(log_line * (1024 * 1024 // len(log_line)) + "\n")
+
+        image_path = tmpdir / "images.md"
+        lines = ["--- User ---\n\nLook\n"]
+        for ii in range(images):
+            (tmpdir / f"img{ii}.png").write_bytes(os.urandom(1024 * 1024))
+            lines.append(f"![](img{ii}.png)\n")
+        image_path.write_text("".join(lines))
+
+        for label, path in [("text", text_path), ("images", image_path)]:
+            size = text_path.stat().st_size if label == "text" else images << 20
+            size /= 1024 * 1024
+            for low_memory in [False, True]:
+                textllm._IMAGE_MEMO.clear()
+
+                def load_and_build():
+                    convo = textllm.Conversation(path, low_memory=low_memory)
+                    convo.request_messages()
+                    return convo
+
+                kept, peak = traced(load_and_build)
+                print(
+                    f"{label:<7} low_memory={low_memory!s:<5} "
+                    f"peak {peak:6.1f} MB ({peak / size:.2f}x), "
+                    f"kept {kept:6.1f} MB ({kept / size:.2f}x) of {size:.0f} MB"
+                )
+
+
+@benchmark
+def bench_merge(n=3, sizes=(1000, 2000, 4000, 8000)):
+    """Merge thousands of adjacent same-role blocks, as text and as content
+    blocks: linear `merge_message_runs()` vs. the old copy-per-merge version
+    (kept in test_textllm.py as a reference)."""
+    import textllm
+
+    env0 = os.environ.copy()
+    from test_textllm import legacy_merge_message_runs  # Sets test variables
+
+    os.environ.clear()
+    os.environ.update(env0)
+
+    block = "log line\n" * 100  # About 1 kB per block
+    image = {"type": "image_url", "image_url": {"url": "https://example.com/a.png"}}
+    for kind in ["text", "blocks"]:
+        for size in sizes:
+            if kind == "text":
+                messages = [{"role": "user", "content": block}] * size
+            else:
+                content = [{"type": "text", "text": block}, image]
+                messages = [{"role": "user", "content": content}] * size
+            for label, merge in [
+                ("legacy", legacy_merge_message_runs),
+                ("linear", textllm.merge_message_runs),
+            ]:
+                times = timed_calls(lambda: merge(messages), n)
+                report(f"{kind} x{size} {label}", times)
+
+
+@benchmark
+def bench_image_workers(n=5, count=32, edge=2048):
+    """Encode a message with many large PNG/JPEG images with 1 and the default
+    workers, as-is (always serial) and downscaled with Pillow (if installed)."""
+    import textllm
+
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+        print("Pillow is not installed. Using random bytes and skipping resizing")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for ii in range(count):
+            path = Path(tmpdir) / f"img{ii}.{['png', 'jpg'][ii % 2]}"
+            if Image:
+                noise = os.urandom(edge * edge * 3)
+                Image.frombytes("RGB", (edge, edge), noise).save(path)
+            else:
+                path.write_bytes(os.urandom(4 * 1024 * 1024))
+            paths.append(path)
+        total = sum(path.stat().st_size for path in paths) / 1024 / 1024
+        print(f"{count} images, {total:.0f} MB")
+
+        options = [("as-is", textllm.ImageOptions())]
+        if Image:
+            options.append(("max_edge=1024", textllm.ImageOptions(max_edge=1024)))
+        for label, option in options:
+            content = [textllm.LocalImage(str(path), option) for path in paths]
+            messages = [{"role": "user", "content": content}]
+            for workers in [1, textllm.IMAGE_WORKERS]:
+
+                def encode():
+                    textllm.resolve_images(messages, remember=False, workers=workers)
+
+                report(f"{label} workers={workers}", timed_calls(encode, n))
+
+
+@benchmark
+def bench_externalize(n=5, images=20, size=1024 * 1024):
+    """Load a conversation with pasted `data:` URL images before and after
+    `textllm externalize` moves them to sidecar files."""
+    import textllm
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "pasted.md"
+        with open(path, "wt") as fp:
+            fp.write(synthetic_conversation(256 * 1024))
+            for ii in range(images):
+                data = base64.b64encode(os.urandom(size)).decode()
+                fp.write(f"\n--- User ---\nImage {ii}\n")
+                fp.write(f"![](data:image/png;base64,{data})\n")
+                fp.write(f"\n--- Assistant ---\nReply {ii}\n")
+
+        def load():
+            return textllm.Conversation(path).messages
+
+        before = path.stat().st_size / 1024 / 1024
+        sent = textllm.Conversation(path).request_messages()
+        report(f"{before:.1f} MB embedded", timed_calls(load, n))
+
+        report("externalize", timed_calls(lambda: textllm.externalize_images(path), 1))
+        after = path.stat().st_size / 1024 / 1024
+        assert textllm.Conversation(path).request_messages() == sent
+        report(f"{after:.2f} MB linked", timed_calls(load, n))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("-n", type=int, default=10, help="[%(default)s] Repetitions")
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.name](n=args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
+import asyncio
 import base64
 import io
+import json
+import logging
 import os
 import shlex
 import shutil
 import subprocess
 import sys
+import threading
+import time
 import types
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from pathlib import Path
 from textwrap import dedent
@@ -13,10 +20,12 @@ from textwrap import dedent
 import pytest
 
 import textllm
+import textllm_mock
 
 ## Reset these
 os.environ["TEXTLLM_TEST_MODE"] = "1"
 os.environ["TEXTLLM_DEFAULT_TEMPERATURE"] = "0.01"
+os.environ["TEXTLLM_SOCKET"] = ""  # Never forward to a developer's running worker
 textllm.TEMPLATE = """\
 # !!AUTO TITLE!!
 
@@ -94,7 +103,23 @@ def run_cli(argv):
     return cap.out, log
 
 
-def test_main():
+@pytest.fixture(params=[False, True], ids=["sync", "async"])
+def use_async_cli(request, monkeypatch):
+    """Run the CLI's chat and title calls through their async versions."""
+    if request.param:
+
+        def chat(self, *args, **kwargs):
+            return asyncio.run(self.achat(*args, **kwargs))
+
+        def set_title(self):
+            return asyncio.run(self.aset_title())
+
+        monkeypatch.setattr(textllm.Conversation, "chat", chat)
+        monkeypatch.setattr(textllm.Conversation, "set_title", set_title)
+    return request.param
+
+
+def test_main(use_async_cli):
     # Test setting the title
     try:
         shutil.rmtree("testdir/")
@@ -359,7 +384,7 @@ def test_default_settings():
         clean()
 
 
-def test_images():
+def test_images(use_async_cli):
     """
     Test different image calling. filenames are flipped to make sure we don't get a false
     positive
@@ -516,6 +541,67 @@ def test_litellm_chunk_helpers_and_multimodal_merge():
     ]
 
 
+def legacy_merge_message_runs(messages):
+    """The copy-per-merge `merge_message_runs()` before `_MessageRun`. Reference."""
+
+    def content_blocks(content):
+        if isinstance(content, list):
+            return content.copy()
+        return [{"type": "text", "text": content}]
+
+    def merge_content(first, second):
+        if isinstance(first, str) and isinstance(second, str):
+            return f"{first}\n\n{second}"
+        blocks = content_blocks(first)
+        if blocks and blocks[-1].get("type") == "text":
+            blocks[-1] = blocks[-1].copy()
+            blocks[-1]["text"] = f"{blocks[-1].get('text', '')}\n\n"
+        else:
+            blocks.append({"type": "text", "text": "\n\n"})
+        blocks.extend(content_blocks(second))
+        return blocks
+
+    merged = []
+    for message in messages:
+        if merged and merged[-1]["role"] == message["role"]:
+            merged[-1] = {
+                "role": merged[-1]["role"],
+                "content": merge_content(merged[-1]["content"], message["content"]),
+            }
+            continue
+        merged.append(message.copy())
+    return merged
+
+
+def test_merge_message_runs_matches_legacy():
+    import copy
+    import random
+
+    rng = random.Random(0)
+    contents = [
+        lambda: "text",
+        lambda: "",
+        lambda: [],
+        lambda: [{"type": "text", "text": "block"}],
+        lambda: [{"type": "text", "text": "a"}, {"type": "image_url", "image_url": {}}],
+        lambda: [{"type": "image_url", "image_url": {}}],
+        lambda: [{"type": "text", "cache_control": {"type": "ephemeral"}}],
+    ]
+    for _ in range(300):
+        messages = []
+        for _ in range(rng.randint(0, 12)):
+            message = {"role": rng.choice(["user", "assistant"])}
+            message["content"] = rng.choice(contents)()
+            if rng.random() < 0.1:
+                message["name"] = "extra key"
+            messages.append(message)
+        original = copy.deepcopy(messages)
+        assert textllm.merge_message_runs(messages) == legacy_merge_message_runs(
+            messages
+        )
+        assert messages == original  # Inputs are not modified
+
+
 def test_call_llm_usage_and_empty_stream(monkeypatch):
     clean()
     try:
@@ -611,6 +697,113 @@ def test_parser_edges_and_image_code_blocks():
     assert "![real](outside.png)" not in msg
 
 
+def legacy_loads(text):
+    """The regex-split parser that `textllm.parse_lines()` replaced. Reference only.
+
+    Returns `loads()` output plus, as `textllm.process_conversation()` derived
+    them, `text` and `images` for messages with images.
+    """
+    import re
+
+    from textllm import FLAG2ROLE, CONVO_PATTERN
+
+    res = {}
+    split_text = CONVO_PATTERN.split(text)
+    if split_text[0].lower() not in FLAG2ROLE:
+        top = split_text.pop(0)
+    else:
+        top = ""
+
+    res["title"] = top.split("\n")[0].strip().strip("#").strip()
+    res["settings"] = textllm.Conversation.read_settings(top)
+    res["top"] = top
+
+    re_role = re.compile("--- (.*) ---")
+    res["conversation"] = conversation = []
+    for flag, msg in textllm.grouper(split_text, 2):
+        msg = msg.strip()
+        if not msg:
+            continue
+
+        msg_lines = []
+        for line in msg.strip().split("\n"):
+            if any(line.lower().startswith(rf"\{flag}") for flag in FLAG2ROLE):
+                line = line[1:]
+            msg_lines.append(line)
+
+        role = re_role.findall(flag)[0].lower()
+        content = "\n".join(msg_lines)
+        item = {"role": role, "content": content}
+
+        # Second pass from process_conversation()
+        msg_lines = []
+        for line in content.strip().split("\n"):
+            if any(line.lower().startswith(rf"\{flag}") for flag in FLAG2ROLE):
+                line = line[1:]
+            msg_lines.append(line)
+        text, images = textllm.process_msg_for_images(msg_lines)
+        if images:
+            item |= {"text": text, "images": images}
+        conversation.append(item)
+
+    return res
+
+
+PARSER_CORPUS = [
+    "",
+    "   \n\n  ",
+    "# Just a title",
+    "# Title\n\n```toml\nmodel = 'x'\n```\n\nNo markers at all\n",
+    "--- User ---",
+    "--- User ---\n\n   \n",
+    "--- User ---hello\nworld",
+    "--- user --- trailing text\n\n  indented first\n\nlast   \n\n",
+    "--- USER ---\nA\n--- Assistant ------ User ---\nB",
+    "top\n--- System ---\nS\n--- Developer ---\nD\n--- User ---\nU",
+    "--- User ---\n\\--- User ---\n\\--- ASSISTANT --- x\n\\\\--- User ---\nend",
+    "--- User ---\n   \\--- Assistant ---\nafter",
+    "--- User ---\nmid\n \\--- User ---\n\\---User---\n\\--- Userx",
+    "--- User ---\n![a](first.png)\ntext\n![b]( second.png \"T\" )  \n",
+    "--- User ---\n   ![lead](lead.png)\n\n![trail](trail.png)   \n\n\n",
+    "--- User ---\nLook\n\n![x](x.png)\n\n",
+    "--- User ---\n```\n![in](code.png)\n```\n![out](out.png)\n ```md\n![c](c.png)",
+    "--- User ---\n```\n--- Assistant ---\n![x](x.png)\n```",
+    "--- User ---\n\\--- User ---\n![x](x.png)\n\\--- Assistant ---",
+    "--- User ---\n\x0b\u2028text\u2028\x0c\n\u00a0",
+    "--- User ---\r\nwindows\r\n--- Assistant ---\r\nline\r\n",
+    "# Tïtle ✓\n--- User ---\nüñíçødé\n--- Assistant ---\nİ\\--- user ---",
+    "--- User ---\n------\n---\n--- User\n- -- User ---",
+    "--- ſystem ---\nlong s",
+]
+
+
+def test_parse_lines_matches_legacy_parser():
+    import random
+
+    rng = random.Random(0)
+    pieces = [
+        "--- User ---", "--- assistant ---", "--- System --- ", "\\--- User ---",
+        "\\--- aSSistant ---", "![i](a.png)", "  ![j](b.png \"t\")  ", "```",
+        " ```py", "", " ", "\t", "text", "  words  ", "# heading", "---", "\u2028",
+        "\\\\--- User ---", "![](data:image/png;base64,AAAA)", "--- User ---x",
+    ]  # fmt: skip
+    corpus = PARSER_CORPUS + [
+        "\n".join(rng.choices(pieces, k=rng.randint(1, 30))) for _ in range(500)
+    ]
+
+    def outcome(parse, arg):
+        try:
+            return parse(arg)
+        except Exception as E:  # e.g. invalid TOML in the top matter
+            return type(E)
+
+    for text in corpus:
+        expected = outcome(legacy_loads, text)
+        assert outcome(textllm.loads, text) == expected, repr(text)
+        lines = io.StringIO(text, newline="\n")
+        assert outcome(textllm.parse_lines, lines) == expected, repr(text)
+
+
 def test_stdin_prompt_joining_and_empty_prompt_file_edit():
     clean()
     try:
@@ -686,6 +879,1513 @@ def test_dynamic_env():
         os.environ = env0
 
 
+def test_openai_compat_backend(monkeypatch):
+    import urllib.request
+
+    requests = []
+
+    def fake_urlopen(request, timeout):
+        requests.append(request)
+        chunks = [
+            {"choices": [{"delta": {"role": "assistant"}}]},
+            {"choices": [{"delta": {"content": "Hello"}}]},
+            {"choices": [{"delta": {"content": " there"}}]},
+            {"choices": [], "usage": {"total_tokens": 7}},
+        ]
+        lines = [b": keep-alive\n", b"\n"]
+        lines += [f"data: {json.dumps(chunk)}\n\n".encode() for chunk in chunks]
+        lines += [b"data: [DONE]\n\n", b"data: ignored\n"]
+        return io.BytesIO(b"".join(lines))
+
+    monkeypatch.setattr(urllib.request, "urlopen", fake_urlopen)
+    monkeypatch.setattr(textllm, "TEST_MODE", False)
+    monkeypatch.setenv("TEXTLLM_TEST_MODE", "0")
+    monkeypatch.delitem(sys.modules, "litellm", raising=False)
+
+    chunks = list(
+        textllm.iter_completion_text(
+            model="openai/gpt-4o-mini",
+            messages=[{"role": "user", "content": "hello"}],
+            settings={
+                "textllm_backend": "openai-compat",
+                "api_base": "http://localhost:9/v1/",
+                "api_key": "sk-test",
+                "temperature": 0.5,
+            },
+        )
+    )
+    assert "".join(text for text, _ in chunks) == "Hello there"
+    assert chunks[-1][1] == {"total_tokens": 7}
+    assert "litellm" not in sys.modules
+
+    (request,) = requests
+    assert request.full_url == "http://localhost:9/v1/chat/completions"
+    assert request.get_header("Authorization") == "Bearer sk-test"
+    body = json.loads(request.data)
+    assert body["model"] == "gpt-4o-mini"
+    assert body["stream"] is True
+    assert body["temperature"] == 0.5
+    assert not any(key.startswith("textllm_") for key in body)
+    assert body["stream_options"] == {"include_usage": True}
+
+    # For endpoints that reject `stream_options`
+    settings = {"textllm_backend": "openai-compat", "textllm_stream_usage": False}
+    list(textllm.iter_completion_text(model="m", messages=[], settings=settings))
+    assert "stream_options" not in json.loads(requests[-1].data)
+
+    with pytest.raises(ValueError, match="Unknown textllm_backend"):
+        list(
+            textllm.iter_completion_text(
+                model="x", messages=[], settings={"textllm_backend": "nope"}
+            )
+        )
+
+
+@pytest.fixture
+def mock_server(request):
+    """A running `textllm_mock.MockServer`. Parametrize indirectly for options."""
+    options = {"record_requests": True} | getattr(request, "param", {})
+    with textllm_mock.MockServer(**options) as server:
+        yield server
+
+
+@pytest.fixture
+def live_backend(monkeypatch):
+    """Disable the deterministic test stream so requests reach a backend."""
+    monkeypatch.setattr(textllm, "TEST_MODE", False)
+    monkeypatch.setenv("TEXTLLM_TEST_MODE", "0")
+
+
+@pytest.mark.parametrize("backend", ["openai-compat", "litellm"])
+@pytest.mark.parametrize(
+    "mock_server", [{"tokens": 12, "chunk_tokens": 5}], indirect=True
+)
+def test_mock_server_end_to_end(live_backend, mock_server, tmp_path, backend):
+    if backend == "litellm":
+        pytest.importorskip("litellm")
+
+    path = tmp_path / "mock.md"
+    path.write_text(dedent(f"""\
+        # Mock
+
+        ```toml
+        model = "openai/mock-model"
+        api_base = "{mock_server.url}"
+        api_key = "sk-mock"
+        textllm_backend = "{backend}"
+        ```
+
+        --- User ---
+
+        Stream something
+        """))
+    convo = textllm.Conversation(path)
+    with Capture() as cap:
+        response = convo.chat()
+
+    expected = "".join(mock_server.reply_chunks()).strip()
+    assert response.content.strip() == cap.out.strip() == expected
+    assert response.usage_metadata["completion_tokens"] == 12
+    assert mock_server.stats == {"requests": 1, "chunks": 3}
+    (body,) = mock_server.requests
+    assert body["stream"] is True
+    assert body["messages"][-1] == {"role": "user", "content": "Stream something"}
+    assert f"--- Assistant ---  \n\n{expected} \n\n--- User ---" in path.read_text()
+
+
+@pytest.mark.parametrize(
+    "mock_server",
+    [
+        {
+            "ttft": 0.2,
+            "tokens": 6,
+            "tokens_per_sec": 50,
+            "usage": False,
+            "record_requests": False,
+        }
+    ],
+    indirect=True,
+)
+def test_mock_server_timing(live_backend, mock_server):
+    import time
+
+    t0 = time.perf_counter()
+    arrivals = []
+    for text, usage in textllm.iter_completion_text(
+        model="openai/mock-model",
+        messages=[{"role": "user", "content": "hi"}],
+        settings={"textllm_backend": "openai-compat", "api_base": mock_server.url},
+    ):
+        assert usage is None
+        if text:
+            arrivals.append(time.perf_counter() - t0)
+    assert len(arrivals) == 6
+    assert arrivals[0] >= 0.2
+    assert arrivals[-1] - arrivals[0] >= 5 / 50 * 0.9
+    assert mock_server.requests == []  # Not kept unless asked for
+
+
+@pytest.mark.parametrize(
+    "mock_server",
+    [{"error_rate": 1.0}, {"fail_after": 2}],
+    indirect=True,
+    ids=["http-500", "mid-stream"],
+)
+def test_mock_server_errors(live_backend, mock_server):
+    chunks = textllm.iter_completion_text(
+        model="openai/mock-model",
+        messages=[{"role": "user", "content": "hi"}],
+        settings={"textllm_backend": "openai-compat", "api_base": mock_server.url},
+    )
+    with pytest.raises(textllm.BackendError, match="Injected"):
+        list(chunks)
+    assert mock_server.stats["errors"] == 1
+
+
+@pytest.mark.parametrize("mock_server", [{"tokens": 8}], indirect=True)
+def test_usage_ledger_and_report(live_backend, mock_server, monkeypatch, tmp_path):
+    monkeypatch.setenv("TEXTLLM_USAGE_LEDGER", "1")
+    monkeypatch.setenv("TEXTLLM_CACHE_DIR", str(tmp_path / "cache"))
+    (tmp_path / "sub").mkdir()
+    for name in ["one.md", "sub/two.md"]:
+        (tmp_path / name).write_text(dedent(f"""\
+            ```toml
+            model = "openai/mock-model"
+            api_base = "{mock_server.url}"
+            textllm_backend = "openai-compat"
+            ```
+
+            --- User ---
+
+            Count my tokens
+            """))
+        textllm.Conversation(tmp_path / name).chat(print_stream=False)
+
+    body = mock_server.requests[0]
+    assert body["stream_options"] == {"include_usage": True}  # Usage was requested
+
+    ledger = tmp_path / textllm.USAGE_LEDGER_NAME
+    (entry,) = map(json.loads, ledger.read_text().splitlines())
+    assert entry["file"] == "one.md" and entry["purpose"] == "chat"
+    assert entry["completion_tokens"] == 8 and not entry["estimated"]
+    assert entry["prompt_tokens"] > 0
+
+    report = textllm.usage_report([str(tmp_path)], by="file")
+    assert set(report) == {"one.md", os.path.join("sub", "two.md")}
+    assert report["one.md"]["turns"] == 1
+    assert report["one.md"]["unpriced"] == 1  # LiteLLM is not imported
+
+    # Priced when reporting, e.g. calls made by a worker or without LiteLLM
+    def cost_per_token(*, model, prompt_tokens, completion_tokens):
+        return prompt_tokens * 1e-6, completion_tokens * 1e-5
+
+    with monkeypatch.context() as mp:
+        fake = types.SimpleNamespace(cost_per_token=cost_per_token)
+        mp.setitem(sys.modules, "litellm", fake)
+        priced = textllm.usage_report([str(tmp_path)], by="file")
+    assert priced["one.md"]["unpriced"] == 0
+    assert priced["one.md"]["cost"] == pytest.approx(
+        entry["prompt_tokens"] * 1e-6 + 8e-5
+    )
+    assert "unpriced_prompt_tokens" not in priced["one.md"]
+    assert textllm.usage_report([str(tmp_path)], by="file") == report
+
+    # Appended lines are read from the indexed offset; a partial line waits
+    index = textllm.DiskCache("usage-index")
+    key = textllm._sha256(str(ledger))
+    offset = json.loads(index.get(key))["offset"]
+    assert offset == ledger.stat().st_size
+    extra = dict(entry, model="other", completion_tokens=2, cost=0.5)
+    with open(ledger, "at") as fp:
+        fp.write(json.dumps(extra) + "\n" + '{"partial')
+    report = textllm.usage_report([str(tmp_path)])
+    assert report["other"]["completion_tokens"] == 2
+    assert report["openai/mock-model"]["turns"] == 2
+    assert json.loads(index.get(key))["offset"] < ledger.stat().st_size
+    assert textllm.usage_report([str(tmp_path)], use_index=False) == report
+
+    # A rewritten ledger is read from the start
+    ledger.write_text(json.dumps(extra) + "\n")
+    report = textllm.usage_report([str(ledger)])
+    assert list(report) == ["other"] and report["other"]["cost"] == 0.5
+
+    with Capture() as cap:
+        textllm.cli(["usage", str(tmp_path), "--by", "model"])
+    assert "other" in cap.out and "$0.5000" in cap.out
+    assert cap.out.splitlines()[-1].startswith("total")
+
+    # A conversation renamed by its title stays one file
+    renamed = tmp_path / "renamed"
+    renamed.mkdir()
+    monkeypatch.setattr(textllm, "TEST_MODE", True)
+    with Capture():
+        textllm.cli([str(renamed), "--prompt", "Name me"])
+    (path,) = renamed.glob("*.md")
+    assert path.name != textllm.DEFAULT_FILEPATH
+    with Capture():
+        textllm.cli([str(path), "--prompt", "Again"])
+        textllm.cli([str(renamed), "--prompt", "A new one"])
+    ledger = (renamed / textllm.USAGE_LEDGER_NAME).read_text()
+    assert f'"renamed": "{textllm.DEFAULT_FILEPATH}"' in ledger
+    report = textllm.usage_report([str(renamed)], by="file")
+    assert report[path.name]["turns"] == 3  # Title, chat, and chat
+    assert sum(row["turns"] for row in report.values()) == 5  # New one separate
+
+
+def test_cassette_record_and_replay(monkeypatch, tmp_path):
+    import time
+
+    def fake_backend(*, model, messages, settings):
+        for word in ["Taped ", "stream ", "reply"]:
+            time.sleep(0.05)
+            delta = types.SimpleNamespace(content=word)
+            yield types.SimpleNamespace(  # Like a LiteLLM chunk object
+                choices=[types.SimpleNamespace(delta=delta)],
+                usage=None,
+                model_dump=lambda mode, word=word: {
+                    "choices": [{"delta": {"content": word}}]
+                },
+            )
+        usage = {"total_tokens": 9}
+        yield types.SimpleNamespace(
+            choices=[],
+            usage=usage,
+            model_dump=lambda mode: {"choices": [], "usage": usage},
+        )
+
+    monkeypatch.setitem(textllm.BACKENDS, "fake", fake_backend)
+    monkeypatch.setattr(textllm, "TEST_MODE", False)
+    monkeypatch.setenv("TEXTLLM_TEST_MODE", "0")
+    cassette = tmp_path / "stream.jsonl"
+    request = dict(
+        model="openai/gpt-4o-mini",
+        messages=[{"role": "user", "content": "hello"}],
+        settings={"textllm_backend": "fake", "temperature": 0.5},
+    )
+
+    monkeypatch.setenv("TEXTLLM_RECORD", str(cassette))
+    live = list(textllm.iter_completion_text(**request))
+    assert live[-1] == ("", {"total_tokens": 9})
+    (record,) = map(json.loads, cassette.read_text().splitlines())
+    times = [seconds for seconds, _ in record["chunks"]]
+    assert times == sorted(times) and times[0] >= 0.05
+
+    monkeypatch.delenv("TEXTLLM_RECORD")
+    monkeypatch.setitem(textllm.BACKENDS, "fake", None)  # Must not be called
+    monkeypatch.setenv("TEXTLLM_REPLAY", str(cassette))
+
+    t0 = time.perf_counter()
+    assert list(textllm.iter_completion_text(**request)) == live
+    assert time.perf_counter() - t0 < 0.1  # Not paced by default
+
+    monkeypatch.setenv("TEXTLLM_REPLAY_SPEED", "1")
+    t0 = time.perf_counter()
+
+    async def areplay():
+        return [item async for item in textllm.aiter_completion_text(**request)]
+
+    assert asyncio.run(areplay()) == live
+    assert time.perf_counter() - t0 >= times[-1]
+
+    # Other requests are an error unless replaying any recording is allowed
+    request["messages"] = [{"role": "user", "content": "something else"}]
+    monkeypatch.setenv("TEXTLLM_REPLAY_SPEED", "0")
+    with pytest.raises(ValueError, match="No recording"):
+        list(textllm.iter_completion_text(**request))
+    monkeypatch.setenv("TEXTLLM_REPLAY_ANY", "1")
+    assert list(textllm.iter_completion_text(**request)) == live
+
+
+def test_parse_cache(monkeypatch, tmp_path, caplog):
+    monkeypatch.setenv("TEXTLLM_PARSE_CACHE", "1")
+    monkeypatch.setattr(textllm, "_PARSE_MEMO", textllm._SizedLRU(10_000))
+    caplog.set_level(logging.DEBUG, logger="textllm")
+
+    path = tmp_path / "cached.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "first question")
+
+    def parse():
+        caplog.clear()
+        convo = textllm.Conversation(path)
+        assert convo.parsed == textllm.loads(convo.text)
+        return convo, caplog.text
+
+    convo, log = parse()
+    assert "Parse cache miss" in log
+
+    with Capture():
+        convo.chat()
+    with path.open("at") as fp:
+        fp.write("second question\n\n\\--- Assistant ---\nescaped")
+
+    convo, log = parse()
+    assert "Parse cache hit" in log
+    assert [m["role"] for m in convo.parsed["conversation"]] == [
+        "system",
+        "user",
+        "assistant",
+        "user",
+    ]
+    assert convo.messages[-1]["content"].endswith("--- Assistant ---\nescaped")
+
+    # Appending again only parses from the last marker
+    with path.open("at") as fp:
+        fp.write(" more")
+    convo, log = parse()
+    assert "Parse cache hit" in log
+
+    # Editing the prefix invalidates the cache
+    path.write_text(path.read_text().replace("first question", "edited question"))
+    convo, log = parse()
+    assert "Parse cache miss" in log
+    assert convo.parsed["conversation"][1]["content"] == "edited question"
+
+    # Entries are bounded by the length of the cached prefix
+    (size,) = textllm._PARSE_MEMO.sizes.values()
+    assert size == path.read_text().rindex("--- User ---")
+    path.write_text(path.read_text() + "x" * 10_000 + "\n--- User ---\nlast")
+    convo, log = parse()
+    assert "Parse cache hit" in log  # From the previous, smaller prefix
+    assert textllm._PARSE_MEMO.sizes[os.path.abspath(path)] == size  # Not replaced
+
+
+def test_image_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("TEXTLLM_CACHE_DIR", str(tmp_path / "cache"))
+    shutil.copytree("testresources/img", tmp_path / "img")
+    path = tmp_path / "img" / "images.md"
+    path.write_text(dedent("""
+        --- User ---
+        ![](traeh.png)
+        ![](worra.jpg)
+        ![again](traeh.png)
+        """))
+
+    textllm._IMAGE_MEMO.clear()
+    expected = textllm.Conversation(path).request_messages()
+    blocks = expected[0]["content"]
+    assert blocks[1] == blocks[3]
+    assert blocks[1]["image_url"]["url"].startswith("data:image/png;base64,")
+
+    monkeypatch.setenv("TEXTLLM_IMAGE_CACHE", "1")
+    textllm._IMAGE_MEMO.clear()
+    assert textllm.Conversation(path).request_messages() == expected
+    # Two images, each with an index entry and a blob
+    cache = textllm.DiskCache("images")
+    assert len(list(cache.root.glob("*/*"))) == 4
+
+    # Cached entries are used, and corrupt ones are re-encoded
+    for blob in cache.root.glob("*/*"):
+        if blob.stat().st_size > 100:
+            blob.write_text("corrupt")
+    textllm._IMAGE_MEMO.clear()
+    assert textllm.Conversation(path).request_messages() == expected
+
+    # LRU eviction under a size cap
+    small = textllm.DiskCache("lru", max_bytes=25)
+    for n, key in enumerate(["aa1", "bb2", "cc3"], 1):
+        small.put(key, b"0123456789")
+        os.utime(small.path(key), ns=(n, n))  # Deterministic access order
+    assert small.get("aa1") is None
+    assert small.get("bb2") == small.get("cc3") == b"0123456789"
+
+    # The in-process cache is bounded by size, not by count
+    memo = textllm._SizedLRU(10)
+    memo.put("a", "x" * 6)
+    memo.put("b", "y" * 6)
+    assert memo.get("a") is None and memo.get("b") == "y" * 6
+    memo.put("c", "z" * 11)  # Too big to keep at all
+    assert memo.get("c") is None and len(memo) == 1
+    memo.put("d", {"any": "value"}, size=5)
+    assert memo.get("b") is None and memo.chars == 5
+
+
+def test_low_memory_peak(tmp_path):
+    """Peak traced memory of loading large text and image conversations."""
+    import tracemalloc
+
+    def traced(func):
+        tracemalloc.start()
+        try:
+            result = func()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return result, current, peak
+
+    log_line = "2026-10-18 12:00:00 INFO worker[42]: processed request in 12 ms\n"
+    path = tmp_path / "large.md"
+    with path.open("wt") as fp:
+        for ii in range(20):
+            fp.write(f"--- {['User', 'Assistant'][ii % 2]} ---\n\n{log_line * 1500}\n")
+    size = path.stat().st_size
+
+    normal, normal_kept, normal_peak = traced(lambda: textllm.Conversation(path))
+    lean, lean_kept, lean_peak = traced(
+        lambda: textllm.Conversation(path, low_memory=True)
+    )
+    assert lean.messages == normal.messages
+    assert lean.text == normal.text and lean.first_line == normal.first_line
+    assert lean_peak < 1.5 * size < normal_peak
+    assert lean_kept < 1.2 * size < normal_kept
+
+    # Images are only encoded when the request is built
+    for ii in range(4):
+        (tmp_path / f"img{ii}.png").write_bytes(os.urandom(256 * 1024))
+    path = tmp_path / "images.md"
+    images = "".join(f"![](img{ii}.png)\n" for ii in [0, 1, 2, 3, 0])
+    path.write_text(f"--- User ---\n\nLook\n{images}")
+    size = 4 * 256 * 1024
+
+    textllm._IMAGE_MEMO.clear()
+    normal, kept, _ = traced(lambda: textllm.Conversation(path))
+    assert kept < 0.05 * size
+    assert isinstance(normal.messages[0]["content"][1], textllm.LocalImage)
+    request, kept, _ = traced(normal.request_messages)
+    assert kept > size  # Data URLs are 4/3 larger
+    assert len(textllm._IMAGE_MEMO) == 4
+
+    # Low-memory requests do not stay in the in-process cache
+    textllm._IMAGE_MEMO.clear()
+    lean = textllm.Conversation(path, low_memory=True)
+    lean_request, _, peak = traced(lean.request_messages)
+    assert lean_request == request
+    assert len(textllm._IMAGE_MEMO) == 0
+    assert peak < 3 * size
+
+
+def test_images_are_encoded_lazily(monkeypatch, tmp_path):
+    shutil.copy("testresources/img/traeh.png", tmp_path)
+    encoded = []
+    monkeypatch.setattr(
+        textllm, "_encode_image", lambda path, *args: encoded.append(path) or "data:,"
+    )
+    textllm._IMAGE_MEMO.clear()
+
+    path = tmp_path / "lazy.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "Look\n![](traeh.png)\n")
+    textllm.cli([str(path), "--title", "only"])
+    assert not path.read_text().startswith(f"# {textllm.AUTO_TITLE}")
+
+    convo = textllm.Conversation(path)
+    convo.messages.append({"role": "assistant", "content": "Seen"})
+    with pytest.raises(textllm.NoUserMessageError):
+        convo.chat()
+    assert encoded == []  # Loading, titling, and validation never encode
+
+    convo.messages.pop()
+    with Capture():
+        convo.chat()
+    assert len(encoded) == 1
+
+    # Raw `messages` are encoded too, never sent as empty image blocks
+    sent = []
+
+    def fake_chunks(messages):
+        sent.append(messages)
+        yield "Seen"
+
+    async def afake_chunks(messages):
+        sent.append(messages)
+        yield "Seen"
+
+    with monkeypatch.context() as mp:
+        mp.setattr(textllm, "_iter_test_chunks", fake_chunks)
+        mp.setattr(textllm, "_aiter_test_chunks", afake_chunks)
+        convo.call_llm(convo.messages)
+        asyncio.run(convo.acall_llm(convo.messages))
+    assert len(sent) == 2
+    for messages in sent:
+        user = [message for message in messages if message["role"] == "user"]
+        assert user[-1]["content"][1] == {
+            "type": "image_url",
+            "image_url": {"url": "data:,"},
+        }
+
+    # A missing image fails before any request, including the title
+    calls = []
+    monkeypatch.setattr(
+        textllm, "iter_completion_text", lambda **kwargs: calls.append(kwargs)
+    )
+    path.write_text(textllm.CONFIG.TEMPLATE + "![](missing.png)\n")
+    convo = textllm.Conversation(path)
+    with pytest.raises(FileNotFoundError, match="missing.png"):
+        convo.chat(set_title=True)
+    assert calls == []
+
+
+def test_images_are_encoded_in_parallel(monkeypatch, tmp_path):
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    monkeypatch.setenv("TEXTLLM_IMAGE_CACHE", "0")  # Encode every time
+    for name in "abcd":
+        (tmp_path / f"{name}.png").write_bytes(name.encode() * 100_000)
+    barrier = None
+    threads = set()
+    encode_image = textllm._encode_image
+
+    def _encode_image(path, mime_type, options):
+        threads.add(threading.get_ident())
+        if barrier:
+            barrier.wait()  # Only passes if all distinct images run at once
+        return encode_image(path, mime_type, textllm.ImageOptions())  # No Pillow
+
+    monkeypatch.setattr(textllm, "_encode_image", _encode_image)
+
+    path = tmp_path / "many.md"
+    text = (
+        textllm.CONFIG.TEMPLATE
+        + "One\n![](c.png)\n![](a.png)\n![](b.png)\n"
+        + "\n--- Assistant ---\nSeen\n--- User ---\n"
+        + "Two\n![](a.png)\n![](d.png)\n"
+    )
+    path.write_text(text)
+    kw = dict(remember=False, workers=8)
+
+    # Plain encoding holds the GIL, so it stays on this thread
+    plain = textllm.resolve_images(textllm.Conversation(path).messages, **kw)
+    assert threads == {threading.get_ident()}
+
+    # Resized images are processed at once
+    path.write_text(text.replace("```toml\n", "```toml\ntextllm_image_max_edge = 9\n"))
+    messages = textllm.Conversation(path).messages
+    serial = textllm.resolve_images(messages, **kw | {"workers": 1})
+    barrier = threading.Barrier(4, timeout=10)
+    parallel = textllm.resolve_images(messages, **kw)
+    assert parallel == serial == plain
+
+    urls = [
+        block["image_url"]["url"]
+        for message in parallel
+        if isinstance(message["content"], list)
+        for block in message["content"]
+        if block["type"] == "image_url"
+    ]
+    order = [base64.b64decode(url.split(",", 1)[1])[:1].decode() for url in urls]
+    assert order == list("cabad")
+
+
+def test_response_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("TEXTLLM_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("TEXTLLM_RESPONSE_CACHE", "1")
+    monkeypatch.setattr(textllm, "RESPONSE_CACHE_STATS", textllm.Counter())
+    stats = textllm.RESPONSE_CACHE_STATS
+    calls = []
+
+    def fake_iter_completion_text(*, model, messages, settings):
+        calls.append(model)
+        yield "A long reply " * 20, None
+        yield "", {"prompt_tokens": 3, "completion_tokens": 60, "total_tokens": 63}
+
+    monkeypatch.setattr(textllm, "iter_completion_text", fake_iter_completion_text)
+    path = tmp_path / "cached.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "Same question every time")
+
+    def call(response_cache=None, **settings):
+        convo = textllm.Conversation(path, response_cache=response_cache)
+        with Capture() as cap:
+            response = convo.call_llm(convo.messages, print_stream=True, **settings)
+        return response, cap.out
+
+    first, out = call()
+    assert (len(calls), stats["miss"], stats["store"]) == (1, 1, 1)
+    again, out_again = call()
+    assert len(calls) == 1 and stats["hit"] == 1
+    assert again == first and out_again == out  # Replayed as the same stream
+
+    convo = textllm.Conversation(path)
+    again = asyncio.run(convo.acall_llm(convo.messages))
+    assert again == first and len(calls) == 1 and stats["hit"] == 2
+
+    call(temperature=0.1)  # Different request
+    assert len(calls) == 2
+    call("refresh")
+    assert len(calls) == 3 and stats["store"] == 3
+    call("off")
+    assert len(calls) == 4 and stats["store"] == 3
+
+    monkeypatch.setenv("TEXTLLM_RESPONSE_CACHE_TTL", "1e-9")  # Hours
+    call()
+    assert len(calls) == 5 and stats["expired"] == 1
+
+    # Counted exactly from `textllm batch` threads
+    stats.clear()
+    cache = textllm.ResponseCache()
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(cache.get, [f"missing{ii}" for ii in range(400)]))
+    assert stats == {"miss": 400}
+
+    monkeypatch.setenv("TEXTLLM_RESPONSE_CACHE", "0")
+    assert textllm.Conversation(path).response_cache == "off"
+    for flag, mode in [("--no-cache", "off"), ("--refresh-cache", "refresh")]:
+        with Capture():
+            convo = textllm.cli([str(path), "--title", "only", flag])
+        assert convo.response_cache == mode
+
+
+def test_image_downscaling(monkeypatch, tmp_path, caplog):
+    Image = pytest.importorskip("PIL.Image")
+    caplog.set_level(logging.DEBUG, logger="textllm")
+    monkeypatch.setenv("TEXTLLM_CACHE_DIR", str(tmp_path / "cache"))
+
+    Image.new("RGBA", (800, 400), (255, 0, 0, 255)).save(tmp_path / "big.png")
+    path = tmp_path / "big.md"
+    path.write_text(dedent("""
+        ```toml
+        textllm_image_max_edge = 100
+        textllm_image_format = "jpeg"
+        textllm_image_quality = 70
+        ```
+        --- User ---
+        ![](big.png)
+        """))
+
+    convo = textllm.Conversation(path)
+    url = convo.request_messages()[0]["content"][1]["image_url"]["url"]
+    header, data = url.split(",", 1)
+    assert header == "data:image/jpeg;base64"
+    with Image.open(io.BytesIO(base64.b64decode(data))) as img:
+        assert img.size == (100, 50)
+    assert "bytes saved" in caplog.text
+
+    # Resized images are kept on disk by default, so later runs skip Pillow
+    textllm._IMAGE_MEMO.clear()
+    with monkeypatch.context() as mp:
+        mp.setattr(textllm, "_shrink_image", None)
+        convo = textllm.Conversation(path)
+        assert convo.request_messages()[0]["content"][1]["image_url"]["url"] == url
+
+    # Transparency becomes white, and phone photos are turned upright
+    img = Image.new("RGBA", (800, 400), (255, 0, 0, 0))
+    exif = img.getexif()
+    exif[textllm.ORIENTATION_TAG] = 6  # Stored on its side
+    img.save(tmp_path / "big.png", exif=exif)
+    textllm._IMAGE_MEMO.clear()
+    convo = textllm.Conversation(path)
+    url = convo.request_messages()[0]["content"][1]["image_url"]["url"]
+    with Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))) as img:
+        assert img.size == (50, 100)
+        assert min(img.getpixel((25, 50))) > 240
+
+    # Without Pillow, the settings fail clearly rather than silently upload
+    textllm._IMAGE_MEMO.clear()
+    monkeypatch.setenv("TEXTLLM_IMAGE_CACHE", "0")
+    monkeypatch.setitem(sys.modules, "PIL", None)
+    with pytest.raises(ImportError, match="require Pillow"):
+        textllm.Conversation(path).request_messages()
+
+
+def test_externalize_images(monkeypatch, tmp_path):
+    def data_url(path, mime_type):
+        data = base64.b64encode(Path(path).read_bytes()).decode()
+        return f"data:{mime_type};base64,{data}"
+
+    png = data_url("testresources/img/traeh.png", "image/png")
+    jpeg = data_url("testresources/img/worra.jpg", "image/jpeg")
+    odd = data_url("testresources/img/traeh.png", "IMAGE/PNG")  # Not sent as is
+    broken = jpeg[:-1]
+
+    path = tmp_path / "pasted.md"
+    text = textllm.CONFIG.TEMPLATE + (
+        f"Look\n![a]({png})\n![b]( {jpeg} \"title\")\n"
+        f"```\n![]({png})\n```\n"
+        f"![]({odd})\n![]({broken})\n"
+        "\n--- Assistant ---\nSeen\n--- User ---\n"
+        f"  ![again]({png})\n"
+    )
+    path.write_text(text)
+    before = textllm.Conversation(path).request_messages()
+
+    assert textllm.externalize_images(path) == 3
+    images = sorted(p.name for p in (tmp_path / textllm.IMAGE_DIR_NAME).iterdir())
+    assert len(images) == 2  # The repeated PNG is stored once
+    assert {Path(name).suffix for name in images} == {".png", ".jpg"}
+
+    after = path.read_text()
+    assert after.count(f"![]({png})") == 1  # In the code block
+    assert f"![]({odd})" in after and f"![]({broken})" in after
+    assert '![b]( textllm-images/' in after and '.jpg "title")' in after
+    assert textllm.Conversation(path).request_messages() == before
+
+    # Nothing left to move, so the file is not rewritten
+    mtime = path.stat().st_mtime_ns
+    assert textllm.externalize_images(path) == 0
+    assert path.stat().st_mtime_ns == mtime
+
+    # Resizing settings would change what is sent
+    resized = tmp_path / "resized.md"
+    resized.write_text(
+        "```toml\ntextllm_image_max_edge = 10\n```\n"
+        f"--- User ---\n![]({png})\n"
+    )
+    assert textllm.externalize_images(resized) == 0
+    assert png in resized.read_text()
+
+    # The command, and the automatic mode before a chat
+    (tmp_path / "copy.md").write_text(text)
+    with Capture() as cap:
+        textllm.cli(["externalize", str(tmp_path / "copy.md"), "--dir", "img"])
+    assert "3 image(s)" in cap.out and len(list((tmp_path / "img").iterdir())) == 2
+
+    monkeypatch.setenv("TEXTLLM_EXTERNALIZE_IMAGES", "1")
+    path.write_text(text)
+    with Capture():
+        textllm.cli([str(path)])
+    assert path.read_text().count(png) == 1  # Only in the code block
+    assert path.read_text().rstrip().endswith("--- User ---")
+
+    # Batch runs too
+    batch = tmp_path / "batch"
+    batch.mkdir()
+    (batch / "one.md").write_text(text)
+    with Capture():
+        textllm.cli(["batch", str(batch), "--title", "off", "--no-journal"])
+    assert (batch / "one.md").read_text().count(png) == 1
+    assert len(list((batch / textllm.IMAGE_DIR_NAME).iterdir())) == 2
+
+    # A symlinked conversation stays a link; images go next to the link
+    linked = tmp_path / "linked"
+    linked.mkdir()
+    (linked / "real.md").write_text(text)
+    (tmp_path / "link.md").symlink_to(linked / "real.md")
+    assert textllm.externalize_images(tmp_path / "link.md") == 3
+    assert (tmp_path / "link.md").is_symlink()
+    assert (linked / "real.md").read_text().count(png) == 1
+    assert not (linked / textllm.IMAGE_DIR_NAME).exists()
+
+
+def test_batch(tmp_path):
+    for name in ["a", "b"]:
+        (tmp_path / f"{name}.md").write_text(
+            textllm.CONFIG.TEMPLATE + f"question for {name}"
+        )
+    (tmp_path / "answered.md").write_text(textllm.CONFIG.TEMPLATE)
+    (tmp_path / "notes.txt").write_text("--- User ---\nnot a conversation")
+    journal = tmp_path / "journal.jsonl"
+
+    argv = ["batch", str(tmp_path), "--jobs", "2", "--journal", str(journal)]
+    with Capture() as cap:
+        textllm.cli(argv + ["--title", "off"])
+    lines = cap.out.strip().splitlines()
+    assert sorted(line.split()[0] for line in lines[:-1]) == ["ok", "ok", "skipped"]
+    assert lines[-1].startswith("2 ok, 0 failed, 1 skipped, 0 already done")
+    for name in ["a", "b"]:
+        text = (tmp_path / f"{name}.md").read_text()
+        assert text.rstrip().endswith(
+            f"1 user messages. Last message ended with: {name}\n\n--- User ---"
+        )
+        assert text.startswith("# !!AUTO TITLE!!")
+
+    # Resume: finished files are skipped from the journal without being parsed
+    with Capture() as cap:
+        textllm.cli(argv)
+    assert "0 ok, 0 failed, 1 skipped, 2 already done" in cap.out
+
+    # Changed files are run again
+    with (tmp_path / "a.md").open("at") as fp:
+        fp.write("follow up")
+    with Capture() as cap:
+        textllm.cli(argv + ["--no-journal"])
+    assert "1 ok, 0 failed, 2 skipped, 0 already done" in cap.out
+    assert (tmp_path / "a.md").read_text().startswith("# title set automatically")
+
+
+@pytest.mark.parametrize("use_async", [False, True], ids=["sync", "async"])
+def test_chat_and_title_sync_and_async(tmp_path, use_async):
+    def run(method, *args, **kwargs):
+        if use_async:
+            return asyncio.run(getattr(convo, f"a{method}")(*args, **kwargs))
+        return getattr(convo, method)(*args, **kwargs)
+
+    path = tmp_path / "convo.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "Is this the same either way")
+    convo = textllm.Conversation(path)
+
+    run("set_title")
+    with Capture() as cap:
+        response = run("chat")
+    assert cap.out.strip() == "1 user messages. Last message ended with: way"
+    assert response.content == cap.out.strip()
+
+    text = path.read_text()
+    assert text.startswith("# title set automatically\n")
+    assert text.endswith(
+        "--- Assistant ---  \n\n"
+        "1 user messages. Last message ended with: way"
+        "\n\n--- User ---  \n\n"
+    )
+
+    with pytest.raises(textllm.NoUserMessageError):
+        run("chat")
+    response = run("call_llm", convo.messages, print_stream=False)
+    assert response.content == "2 user messages. Last message ended with: way"
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_failed_title_keeps_chat(monkeypatch, tmp_path, caplog, use_async):
+    test_chunks = textllm._iter_test_chunks
+    chat_error = None
+
+    def fake_chunks(messages):
+        if messages[0]["content"] == textllm.TITLE_SYSTEM_PROMPT:
+            raise textllm.BackendError("title model is down")
+        if chat_error:
+            raise chat_error
+        yield from test_chunks(messages)
+
+    async def afake_chunks(messages):
+        for text in fake_chunks(messages):
+            yield text
+
+    monkeypatch.setattr(textllm, "_iter_test_chunks", fake_chunks)
+    monkeypatch.setattr(textllm, "_aiter_test_chunks", afake_chunks)
+
+    def chat():
+        convo = textllm.Conversation(path)
+        with Capture():
+            if use_async:
+                return asyncio.run(convo.achat(set_title=True))
+            return convo.chat(set_title=True)
+
+    path = tmp_path / "convo.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "Answer anyway")
+    response = chat()
+    assert response.content.endswith("anyway")
+    text = path.read_text()
+    assert text.startswith(f"# {textllm.AUTO_TITLE}")
+    assert "--- Assistant ---  \n\n1 user messages" in text
+    assert "Could not set the title" in caplog.text
+
+    # The chat's own error is what is raised
+    path.write_text(textllm.CONFIG.TEMPLATE + "Fail both")
+    chat_error = textllm.WorkerError("chat failed")
+    with pytest.raises(textllm.WorkerError, match="chat failed"):
+        chat()
+
+
+def test_marker_escaper_matches_full_text():
+    import random
+
+    text = (
+        "--- User ---\nintro --- User --- inline\n--- assistant --- x\n"
+        "--- Sys\n--- System ---\n\n--- Developer ---\n--- user --\n"
+        "\\--- User ---\nend --- User ---"
+    )
+    expected = textllm.CONVO_PATTERN.sub(r"\\\1", text)
+    rng = random.Random(0)
+    for _ in range(200):
+        cuts = sorted(rng.sample(range(len(text)), rng.randint(0, 30)))
+        chunks = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+        escaper = textllm.MarkerEscaper()
+        got = "".join(map(escaper.feed, chunks)) + escaper.finish()
+        assert got == expected
+
+
+def test_stream_writer(tmp_path):
+    def fake_chunks(messages):
+        yield "First line\n--- "
+        yield "User --- is escaped\n"
+        raise KeyboardInterrupt
+
+    path = tmp_path / "stream.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "Tell me   \n\n\n")
+    text0 = path.read_text().rstrip()
+
+    # Written as it streams, not only at the end
+    writer = textllm.StreamWriter(path, flush_interval=0)
+    writer.write("partial ")
+    assert path.read_text() == text0 + "\n\n--- Assistant ---  \n\npartial "
+    writer.write("reply")
+    writer.close()
+    assert path.read_text().endswith("partial reply\n\n--- User ---  \n\n")
+
+    # Buffered until the flush interval or close
+    path.write_text(text0)
+    with textllm.StreamWriter(path, flush_interval=60) as writer:
+        writer.write("first ")
+        assert path.read_text().endswith("first ")  # The first text is not held
+        writer.write("buffered")
+        assert "buffered" not in path.read_text()
+    assert path.read_text().endswith("first buffered\n\n--- User ---  \n\n")
+
+    # An interrupted chat keeps the partial response and says so
+    path.write_text(text0)
+    convo = textllm.Conversation(path)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(textllm, "_iter_test_chunks", fake_chunks)
+        with Capture(), pytest.raises(KeyboardInterrupt):
+            convo.chat()
+    text = path.read_text()
+    assert text.startswith(text0)
+    assert text.endswith(
+        "--- Assistant ---  \n\n"
+        "First line\n\\--- User --- is escaped\n\n\n"
+        "[textllm: response interrupted (KeyboardInterrupt)]\n\n--- User ---  \n\n"
+    )
+    assistant = textllm.Conversation(path).messages[-1]
+    assert assistant["role"] == "assistant"
+    assert "--- User --- is escaped" in assistant["content"]
+
+    # Failing before any text leaves the file alone
+    path.write_text(text0)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(textllm, "_iter_test_chunks", lambda messages: iter([""]))
+        with Capture(), pytest.raises(ValueError, match="did not include text"):
+            textllm.Conversation(path).chat()
+    assert path.read_text() == text0
+
+
+def stalling_chunks(stalls, chunks=("One ", "two ", "three")):
+    """Fake `_iter_test_chunks` that sleeps `stalls[i]` seconds before chunk i"""
+
+    def fake(messages):
+        for ii, chunk in enumerate(chunks):
+            time.sleep(stalls.get(ii, 0))
+            yield chunk
+
+    async def afake(messages):
+        for ii, chunk in enumerate(chunks):
+            await asyncio.sleep(stalls.get(ii, 0))
+            yield chunk
+
+    return fake, afake
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_stream_deadlines(monkeypatch, tmp_path, use_async):
+    path = tmp_path / "slow.md"
+    text0 = textllm.CONFIG.TEMPLATE + "Hurry"
+
+    def chat(stalls, **settings):
+        path.write_text(
+            text0.replace(
+                "```toml\n",
+                "```toml\n" + "".join(f"{k} = {v}\n" for k, v in settings.items()),
+                1,
+            )
+        )
+        fake, afake = stalling_chunks(stalls)
+        monkeypatch.setattr(textllm, "_iter_test_chunks", fake)
+        monkeypatch.setattr(textllm, "_aiter_test_chunks", afake)
+        convo = textllm.Conversation(path)
+        with Capture():
+            if use_async:
+                return asyncio.run(convo.achat())
+            return convo.chat()
+
+    # Within every limit
+    limits = dict(
+        textllm_first_token_timeout=1, textllm_idle_timeout=1, textllm_total_timeout=5
+    )
+    assert chat({1: 0.05}, **limits).content == "One two three"
+
+    # No first token: nothing is written
+    with pytest.raises(textllm.StreamTimeout, match="no text after 0.1 s"):
+        chat({0: 1}, textllm_first_token_timeout=0.1)
+    assert "--- Assistant ---" not in path.read_text()
+
+    # Stalls mid-stream: the partial reply is kept and marked
+    started = time.monotonic()
+    with pytest.raises(textllm.StreamTimeout, match="no chunk for 0.1 s"):
+        chat({2: 1}, textllm_idle_timeout=0.1)
+    assert time.monotonic() - started < 0.9  # Did not wait for the stall
+    assert path.read_text().endswith(
+        "--- Assistant ---  \n\nOne two \n\n"
+        "[textllm: response interrupted (no chunk for 0.1 s)]\n\n--- User ---  \n\n"
+    )
+    assistant = textllm.Conversation(path).messages[-1]
+    assert assistant["role"] == "assistant" and "interrupted" in assistant["content"]
+
+    # Every chunk is in time but the whole is not
+    with pytest.raises(textllm.StreamTimeout, match="took over 0.15 s"):
+        chat({1: 0.1, 2: 0.1}, textllm_idle_timeout=1, textllm_total_timeout=0.15)
+    assert "One two \n\n[textllm: response interrupted" in path.read_text()
+
+    # Limits must be positive numbers, not TOML strings
+    with pytest.raises(ValueError, match="textllm_idle_timeout must be a positive"):
+        chat({}, textllm_idle_timeout='"30"')
+    with pytest.raises(ValueError, match="textllm_total_timeout must be a positive"):
+        chat({}, textllm_total_timeout=0)
+
+    # Other stream errors pass through unchanged, marked by their type even if
+    # they have a `reason` of their own
+    def broken(messages):
+        yield "One "
+        raise urllib.error.URLError("upstream")
+
+    monkeypatch.setattr(textllm, "_iter_test_chunks", broken)
+    path.write_text(text0)
+    convo = textllm.Conversation(path)
+    with Capture(), pytest.raises(urllib.error.URLError):
+        with textllm.StreamWriter(path, flush_interval=0) as writer:
+            convo.call_llm(convo.messages, sinks=[writer], textllm_idle_timeout=1)
+    assert "response interrupted (URLError)" in path.read_text()
+
+
+def test_stream_sinks(tmp_path):
+    class Stream(io.StringIO):
+        tty = False
+        writes = 0
+
+        def isatty(self):
+            return self.tty
+
+        def write(self, text):
+            self.writes += 1
+            return super().write(text)
+
+    # Piped output is block-buffered, TTY output is written promptly
+    piped = Stream()
+    with textllm.TerminalSink(piped) as sink:
+        for _ in range(1000):
+            sink.write("tok ")
+        assert piped.getvalue() == "\n"
+    assert piped.getvalue() == "\n" + "tok " * 1000 + "\n\n"
+    assert piped.writes < 10
+
+    tty = Stream()
+    tty.tty = True
+    sink = textllm.TerminalSink(tty)
+    assert tty.getvalue() == ""  # Nothing is written until the stream starts
+    with sink:
+        sink.write("first")
+        assert tty.getvalue() == "\nfirst"  # Not held back
+
+    # Sinks must implement `_emit()`
+    class Incomplete(textllm.Sink):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+    events = io.StringIO()
+    with textllm.JSONLinesSink(events, interval=60) as sink:
+        sink.write("a")
+        sink.write("b")
+        sink.write("c")
+    assert list(map(json.loads, events.getvalue().splitlines())) == [
+        {"type": "text", "text": "a"},
+        {"type": "text", "text": "bc"},  # Coalesced
+        {"type": "done"},
+    ]
+
+    # Chunk shape is detected once per stream
+    chunks = [{"choices": [{"delta": {"content": "x"}}]}] * 3
+    chunks.append({"choices": [], "usage": {"total_tokens": 1}})
+    assert list(textllm._read_chunks(chunks)) == [("x", None)] * 3 + [
+        ("", {"total_tokens": 1})
+    ]
+
+    # CLI event stream on stdout replaces the printed response
+    path = tmp_path / "events.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "Stream events")
+    with Capture() as cap:
+        textllm.cli([str(path), "--title", "off", "--events", "-"])
+    events = list(map(json.loads, cap.out.splitlines()))
+    assert events[-1] == {"type": "done"}
+    text = "".join(event.get("text", "") for event in events)
+    assert text == "1 user messages. Last message ended with: events"
+
+
+def test_stats_and_metrics_log(monkeypatch, tmp_path):
+    assert textllm.METRICS is None
+    assert textllm._phase("parse") is textllm._NO_PHASE  # Nothing to do when off
+
+    path = tmp_path / "stats.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "How long did this take")
+    metrics_log = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("TEXTLLM_METRICS_LOG", str(metrics_log))
+    for _ in range(2):
+        with Capture() as cap:
+            textllm.cli([str(path), "--stats", "--no-rename", "--prompt", "again"])
+    assert textllm.METRICS is None
+
+    assert "textllm stats:" in cap.err
+    assert "TTFT" in cap.err and "tokens/s" in cap.err
+
+    first, second = map(json.loads, metrics_log.read_text().splitlines())
+    assert {"env", "parse", "messages", "write"} <= set(first["phases"])
+    assert sorted(call["purpose"] for call in first["calls"]) == ["chat", "title"]
+    assert [call["purpose"] for call in second["calls"]] == ["chat"]  # Titled
+    (chat,) = second["calls"]
+    assert chat["ttft"] <= chat["total"] <= second["total"]
+    assert chat["tokens"] > 0 and chat["tokens_estimated"]
+
+
+def test_title_prompt_budget_and_model(monkeypatch, tmp_path):
+    huge = [
+        {"role": "system", "content": "S" * 1_000_000},
+        {"role": "user", "content": "first question " + "u" * 1_000_000},
+        {"role": "assistant", "content": "a" * 1_000_000 + " final answer"},
+        {"role": "user", "content": "x" * 1_000_000},
+    ]
+    for max_tokens in [100, 1000]:
+        prompt = textllm.title_prompt(huge, max_tokens=max_tokens)
+        assert textllm.estimate_tokens(prompt) <= max_tokens + 50  # + JSON overhead
+        excerpts = json.loads(prompt)
+        assert [e["role"] for e in excerpts] == ["system", "user", "assistant"]
+        assert excerpts[1]["content"].startswith("first question")
+        assert excerpts[1]["content"].endswith(" [...]")
+        assert excerpts[2]["content"].startswith("[...] ")
+        assert excerpts[2]["content"].endswith("final answer")
+
+        # Non-ASCII text stays within budget rather than being escaped
+        cjk = [{**m, "content": "漢字" * 500_000} for m in huge]
+        prompt = textllm.title_prompt(cjk, max_tokens=max_tokens)
+        assert textllm.estimate_tokens(prompt) <= max_tokens + 50
+        assert "漢字" in prompt
+
+    # Short conversations are sent whole
+    small = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "yo"}]
+    assert json.loads(textllm.title_prompt(small)) == small
+
+    calls = []
+
+    def fake_iter_completion_text(*, model, messages, settings):
+        calls.append((model, messages, settings))
+        yield "A Title", None
+
+    monkeypatch.setattr(textllm, "iter_completion_text", fake_iter_completion_text)
+    monkeypatch.setattr(textllm, "TEST_MODE", False)
+    monkeypatch.setenv("TEXTLLM_TEST_MODE", "0")
+    path = tmp_path / "budget.md"
+    path.write_text(
+        "# !!AUTO TITLE!!\n\n```toml\n"
+        'model = "big/model"\n'
+        'textllm_title_model = "small/model"\n'
+        "textllm_title_max_tokens = 200\n"
+        "```\n\n--- User ---\n\n" + "long paste " * 200_000
+    )
+    convo = textllm.Conversation(path)
+    convo.set_title()
+
+    ((model, messages, _),) = calls
+    assert model == "small/model"
+    assert textllm.estimate_tokens(messages[1]["content"]) <= 250
+    assert path.read_text().startswith("# A Title\n")
+
+
+def test_trim_context(monkeypatch, tmp_path, caplog):
+    def msg(role, n):
+        return {"role": role, "content": "x" * (4 * n)}  # n tokens + 4 overhead
+
+    messages = [msg("system", 10)]
+    for _ in range(5):
+        messages += [msg("user", 96), msg("assistant", 96)]  # 200 tokens per turn
+    copy = [m.copy() for m in messages]
+
+    assert textllm.trim_context(messages) is messages
+    assert textllm.trim_context(messages, max_tokens=10_000) is messages
+
+    trimmed = textllm.trim_context(messages, max_turns=2)
+    assert trimmed == [messages[0]] + messages[-4:]
+
+    trimmed = textllm.trim_context(messages, max_tokens=650)
+    assert trimmed == [messages[0]] + messages[-6:]  # 14 + 3 * 200
+    assert sum(map(textllm.message_tokens, trimmed)) <= 650
+    assert messages == copy  # Input unchanged
+
+    with caplog.at_level(logging.WARNING, logger="textllm"):
+        trimmed = textllm.trim_context(messages, max_tokens=100)
+    assert trimmed == [messages[0]] + messages[-2:]
+    assert "over the context budget" in caplog.text
+
+    # Images count as a flat estimate, not by URL size
+    image = {"type": "image_url", "image_url": {"url": "data:" + "A" * 100_000}}
+    content = [{"type": "text", "text": "abcd"}, image]
+    tokens = textllm.message_tokens({"role": "user", "content": content})
+    assert tokens == textllm.MESSAGE_TOKENS + 1 + textllm.IMAGE_TOKENS
+
+    # Only the request is trimmed
+    calls = []
+
+    def fake_iter_completion_text(*, model, messages, settings):
+        calls.append(messages)
+        yield "reply", None
+
+    monkeypatch.setattr(textllm, "iter_completion_text", fake_iter_completion_text)
+    path = tmp_path / "window.md"
+    turns = "".join(
+        f"--- User ---\n\nquestion {ii}\n\n--- Assistant ---\n\nanswer {ii}\n\n"
+        for ii in range(5)
+    )
+    path.write_text(
+        '# Window\n\n```toml\nmodel = "m"\ntextllm_context_turns = 2\n```\n\n'
+        "--- System ---\n\nBe brief\n\n" + turns + "--- User ---\n\nlast"
+    )
+    text0 = path.read_text()
+    convo = textllm.Conversation(path)
+    with caplog.at_level(logging.DEBUG, logger="textllm"):
+        convo.chat(print_stream=False)
+
+    (sent,) = calls
+    assert [m["content"] for m in sent] == [
+        "Be brief",
+        "question 4",
+        "answer 4",
+        "last",
+    ]
+    assert "dropped 4 oldest turn(s) (8 messages" in caplog.text
+    assert path.read_text().startswith(text0)
+    assert len(convo.messages) == 13
+
+
+def test_prompt_cache_breakpoints(monkeypatch, tmp_path, caplog):
+    ephemeral = {"cache_control": {"type": "ephemeral"}}
+    image = {"type": "image_url", "image_url": {"url": "https://x/y.png"}}
+    messages = [
+        {"role": "system", "content": "sys"},
+        {"role": "user", "content": "q1"},
+        {"role": "assistant", "content": "a1"},
+        {"role": "user", "content": [{"type": "text", "text": "q2"}, image]},
+        {"role": "assistant", "content": "a2"},
+        {"role": "user", "content": "q3"},
+    ]
+    copy = [m.copy() for m in messages]
+    marked = textllm.add_cache_breakpoints(messages)
+    assert messages == copy
+    assert marked[0]["content"] == [{"type": "text", "text": "sys"} | ephemeral]
+    assert marked[4]["content"] == [{"type": "text", "text": "a2"} | ephemeral]
+    assert [marked[ii] for ii in (1, 2, 3, 5)] == [messages[ii] for ii in (1, 2, 3, 5)]
+
+    # Only for supported providers and when enabled
+    path = tmp_path / "cache.md"
+    for model, enabled, expected in [
+        ("anthropic/claude", "true", True),
+        ("anthropic/claude", "false", False),
+        ("openai/gpt", "true", False),
+    ]:
+        path.write_text(
+            f'# Cache\n\n```toml\nmodel = "{model}"\n'
+            f"textllm_prompt_cache = {enabled}\n```\n\n"
+            "--- System ---\n\nsys\n\n--- User ---\n\nq1"
+        )
+        convo = textllm.Conversation(path)
+        assert (convo.request_messages() != convo.messages) == expected
+
+    # Cache usage is logged with the token counts
+    usage = {
+        "prompt_tokens": 100,
+        "completion_tokens": 5,
+        "total_tokens": 105,
+        "prompt_tokens_details": {"cached_tokens": 80},
+    }
+    assert textllm._cache_usage(usage) == (80, None)
+    with caplog.at_level(logging.DEBUG, logger="textllm"):
+        textllm.Conversation._llm_response(["hi"], usage)
+    assert "total 105, cache read 80, cache write None" in caplog.text
+    assert textllm._cache_usage({"prompt_tokens": 1}) == (None, None)
+
+
+@pytest.mark.parametrize("use_async", [False, True], ids=["sync", "async"])
+@pytest.mark.parametrize("slower", ["title", "chat"])
+def test_title_overlaps_chat(monkeypatch, tmp_path, use_async, slower):
+    import time
+
+    iter_test_chunks = textllm._iter_test_chunks
+
+    def latency(messages):
+        is_title = not any(msg["role"] == "user" for msg in messages)
+        return 0.4 if (slower == "title") == is_title else 0.2
+
+    def slow_chunks(messages):
+        time.sleep(latency(messages))
+        yield from iter_test_chunks(messages)
+
+    async def aslow_chunks(messages):
+        await asyncio.sleep(latency(messages))
+        for text in iter_test_chunks(messages):
+            yield text
+
+    monkeypatch.setattr(textllm, "_iter_test_chunks", slow_chunks)
+    monkeypatch.setattr(textllm, "_aiter_test_chunks", aslow_chunks)
+
+    path = tmp_path / "overlap.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "Do both at once")
+    convo = textllm.Conversation(path)
+
+    t0 = time.perf_counter()
+    with Capture():
+        if use_async:
+            asyncio.run(convo.achat(set_title=True))
+        else:
+            convo.chat(set_title=True)
+    assert time.perf_counter() - t0 < 0.55  # Not 0.6 if run one after the other
+
+    text = path.read_text()
+    assert text.startswith("# title set automatically\n")
+    assert "Do both at once\n\n--- Assistant ---" in text
+    assert text.endswith("ended with: once\n\n--- User ---  \n\n")
+    assert convo.text.startswith("# title set automatically\n")
+
+
+def test_achat_does_not_block_the_event_loop(monkeypatch, tmp_path):
+    import time
+
+    resolve_images = textllm.resolve_images
+
+    def slow_resolve_images(messages, **kwargs):
+        time.sleep(0.3)  # Like encoding a large image
+        return resolve_images(messages, **kwargs)
+
+    monkeypatch.setattr(textllm, "resolve_images", slow_resolve_images)
+
+    path = tmp_path / "loop.md"
+    path.write_text(textllm.CONFIG.TEMPLATE + "Keep the loop free")
+    convo = textllm.Conversation(path)
+
+    def hold_file_lock():  # Like a slow title write
+        with convo._file_lock:
+            time.sleep(1)
+
+    async def main():
+        gaps = []
+        holder = threading.Thread(target=hold_file_lock)
+        holder.start()
+        chat = asyncio.create_task(convo.achat(print_stream=False))
+        last = time.perf_counter()
+        while not chat.done():
+            await asyncio.sleep(0.01)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+        await chat
+        holder.join()
+        return max(gaps)
+
+    assert asyncio.run(main()) < 0.2
+    assert path.read_text().endswith("ended with: free\n\n--- User ---  \n\n")
+
+
+def test_aiter_completion_text_litellm_backend(monkeypatch):
+    async def fake_acompletion(*, model, messages, stream, **settings):
+        assert stream is True
+        assert settings == {"temperature": 0.5}
+
+        async def chunks():
+            yield {"choices": [{"delta": {"content": "async"}}]}
+            yield {"choices": [{"delta": {"content": " ok"}}], "usage": {"a": 1}}
+
+        return chunks()
+
+    fake_litellm = types.SimpleNamespace(acompletion=fake_acompletion)
+    monkeypatch.setitem(sys.modules, "litellm", fake_litellm)
+    monkeypatch.setenv("TEXTLLM_TEST_MODE", "0")
+    monkeypatch.setattr(textllm, "TEST_MODE", False)
+
+    async def collect(**settings):
+        return [
+            item
+            async for item in textllm.aiter_completion_text(
+                model="openai/gpt-4o-mini",
+                messages=[{"role": "user", "content": "hello"}],
+                settings={"temperature": 0.5} | settings,
+            )
+        ]
+
+    assert asyncio.run(collect()) == [("async", None), (" ok", {"a": 1})]
+    assert fake_litellm.suppress_debug_info is True
+
+    # Backends without an async version run in a thread
+    monkeypatch.setitem(
+        textllm.BACKENDS,
+        "sync-only",
+        lambda **kwargs: iter([{"choices": [{"delta": {"content": "thread"}}]}]),
+    )
+    assert asyncio.run(collect(textllm_backend="sync-only")) == [("thread", None)]
+
+
+def test_aiter_in_thread_closes_early(monkeypatch):
+    closed = threading.Event()
+    stalled = threading.Event()
+
+    def stream(stall=False):
+        try:
+            yield "one", None
+            if stall:
+                stalled.wait(10)
+            yield "two", None
+        finally:
+            closed.set()
+
+    async def first(chunks):
+        async for item in chunks:
+            return item
+
+    # The consumer stops after one item
+    assert asyncio.run(first(textllm._aiter_in_thread(stream))) == ("one", None)
+    assert closed.wait(5)
+
+    # A stalled read times out at once and the stream is closed once it returns
+    closed.clear()
+    chunks = textllm._aiter_in_thread(lambda: stream(stall=True))
+    deadlines = textllm.StreamDeadlines(idle=0.1)
+
+    async def collect():
+        return [item async for item in textllm._aiter_with_deadlines(chunks, deadlines)]
+
+    loop = asyncio.new_event_loop()  # `asyncio.run()` would wait for the read
+    try:
+        with pytest.raises(textllm.StreamTimeout):
+            loop.run_until_complete(collect())
+        assert not closed.is_set()
+        stalled.set()
+        assert closed.wait(5)
+    finally:
+        loop.close()
+
+
+def test_worker_forwarding(monkeypatch, tmp_path):
+    socket_path = str(tmp_path / "worker.sock")
+    server = textllm.WorkerServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    clean()
+    try:
+        monkeypatch.setenv("TEXTLLM_SOCKET", socket_path)
+        out, log = run_cli(["testdir/worker.md", "--prompt", "forwarded request"])
+        assert out.strip() == "1 user messages. Last message ended with: request"
+        assert f"Using textllm worker at {socket_path!r}" in log
+
+        async def collect():
+            return [
+                text
+                async for text, _ in textllm.aiter_completion_text(
+                    model="openai/gpt-4o-mini",
+                    messages=[{"role": "user", "content": "async request"}],
+                    settings={},
+                )
+            ]
+
+        assert "".join(asyncio.run(collect())).endswith("request")
+
+        # Never a socket others could have made or can use
+        os.chmod(socket_path, 0o666)
+        assert textllm._connect_worker() is None
+        os.chmod(socket_path, 0o600)
+        with monkeypatch.context() as mp:
+            mp.setattr(os, "getuid", lambda: os.stat(socket_path).st_uid + 1)
+            assert textllm._connect_worker() is None
+            assert "".join(asyncio.run(collect())).endswith("request")  # In-process
+        textllm._connect_worker().close()
+
+        with pytest.raises(ValueError, match="already listening"):
+            textllm.WorkerServer(socket_path)
+    finally:
+        server.shutdown()
+        server.server_close()
+        clean()
+
+    # Stopped worker: fall back to in-process calls
+    assert not os.path.exists(socket_path)
+    chunks = list(
+        textllm.iter_completion_text(
+            model="openai/gpt-4o-mini",
+            messages=[{"role": "user", "content": "hello there"}],
+            settings={},
+        )
+    )
+    assert "".join(text for text, _ in chunks).endswith("there")
+
+
 if __name__ == "__main__":
     # test_main()
     # test_auto_names()
@@ -1,22 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import abc
 import argparse
+import asyncio
 import base64
+import contextlib
+import glob
+import hashlib
+import importlib
+import io
 import itertools
 import json
 import logging
 import mimetypes
+import mmap
 import os
+import queue
 import re
 import shlex
 import shutil
+import socket
+import socketserver
 import subprocess
 import sys
+import threading
+import time
 import tomllib
-from dataclasses import dataclass
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import astuple, dataclass
 from datetime import datetime
-from functools import cached_property
+from functools import cached_property, partial
 from pathlib import Path
 
 os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
@@ -53,6 +68,13 @@ TEMPLATE_PLACEHOLDER_PATTERN = re.compile(
 )
 
 
+def _env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on"}
+
+
 # Environment variable configs for defaults
 class _DYNAMIC_ENV_CONFIG:
     @property
@@ -75,6 +97,82 @@ class _DYNAMIC_ENV_CONFIG:
     def TEXTLLM_TEMPLATE_FILE(self):
         return os.environ.get("TEXTLLM_TEMPLATE_FILE", None)
 
+    @property
+    def TEXTLLM_SOCKET(self):
+        # A private directory. Never a predictable name in a shared one like /tmp
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.path.expanduser(
+            "~/.cache"
+        )
+        default = os.path.join(runtime_dir, "textllm", "worker.sock")
+        return os.environ.get("TEXTLLM_SOCKET", default)
+
+    @property
+    def TEXTLLM_CACHE_DIR(self):
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        default = os.path.join(cache_home, "textllm")
+        return os.environ.get("TEXTLLM_CACHE_DIR") or default
+
+    @property
+    def TEXTLLM_PARSE_CACHE(self):
+        return _env_flag("TEXTLLM_PARSE_CACHE")
+
+    @property
+    def TEXTLLM_IMAGE_CACHE(self):
+        # None when unset: only resized or re-encoded images are cached
+        return _env_flag("TEXTLLM_IMAGE_CACHE", default=None)
+
+    @property
+    def TEXTLLM_IMAGE_CACHE_MB(self):
+        return float(os.environ.get("TEXTLLM_IMAGE_CACHE_MB", 500))
+
+    @property
+    def TEXTLLM_RESPONSE_CACHE(self):
+        return _env_flag("TEXTLLM_RESPONSE_CACHE")
+
+    @property
+    def TEXTLLM_RESPONSE_CACHE_TTL(self):
+        return float(os.environ.get("TEXTLLM_RESPONSE_CACHE_TTL", 0))
+
+    @property
+    def TEXTLLM_RESPONSE_CACHE_MB(self):
+        return float(os.environ.get("TEXTLLM_RESPONSE_CACHE_MB", 100))
+
+    @property
+    def TEXTLLM_RECORD(self):
+        return os.environ.get("TEXTLLM_RECORD") or None
+
+    @property
+    def TEXTLLM_REPLAY(self):
+        return os.environ.get("TEXTLLM_REPLAY") or None
+
+    @property
+    def TEXTLLM_REPLAY_ANY(self):
+        return _env_flag("TEXTLLM_REPLAY_ANY")
+
+    @property
+    def TEXTLLM_REPLAY_SPEED(self):
+        return float(os.environ.get("TEXTLLM_REPLAY_SPEED", 0))
+
+    @property
+    def TEXTLLM_FLUSH_INTERVAL(self):
+        return float(os.environ.get("TEXTLLM_FLUSH_INTERVAL", 0.5))
+
+    @property
+    def TEXTLLM_METRICS_LOG(self):
+        return os.environ.get("TEXTLLM_METRICS_LOG") or None
+
+    @property
+    def TEXTLLM_LOW_MEMORY(self):
+        return _env_flag("TEXTLLM_LOW_MEMORY")
+
+    @property
+    def TEXTLLM_USAGE_LEDGER(self):
+        return _env_flag("TEXTLLM_USAGE_LEDGER")
+
+    @property
+    def TEXTLLM_EXTERNALIZE_IMAGES(self):
+        return _env_flag("TEXTLLM_EXTERNALIZE_IMAGES")
+
     @property
     def TEMPLATE_VALUES(self):
         return dict(
@@ -114,9 +212,25 @@ Provide an appropriate, concise title for this conversation. The conversation is
 - Your goal is to extract the key point and intent of the conversation
 - Make sure the title is also appropriate for a filename. Spaces are acceptable.
 - Reply with ONLY the title and nothing else!
+
+Long messages are excerpted; "[...]" marks removed text.
 """
 
+TITLE_MAX_TOKENS = 1000
+
+# Rough characters per token for budgeting without a provider tokenizer
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1000  # Flat estimate per image. Providers vary with size and detail
+MESSAGE_TOKENS = 4  # Per-message framing overhead
+
 MAX_FILENAME_CHAR = 240
+IMAGE_WORKERS = 8  # Default `textllm_image_workers`
+IMAGE_MEMO_MB = 64  # In-process cache of encoded images
+PARSE_MEMO_MB = 64  # In-process cache of parsed conversations
+ORIENTATION_TAG = 0x0112  # EXIF
+IMAGE_DIR_NAME = "textllm-images"  # Next to the conversation. `textllm externalize`
+
+INTERRUPTED_MARKER = "[textllm: response interrupted ({reason})]"
 
 FLAG2ROLE = {
     "--- system ---": "system",
@@ -129,9 +243,39 @@ CONVO_PATTERN = re.compile(
     "(" + "|".join("^" + re.escape(flag) for flag in FLAG2ROLE) + ")",
     flags=re.DOTALL | re.MULTILINE | re.IGNORECASE,
 )
+ESCAPED_FLAGS = tuple(rf"\{flag}" for flag in FLAG2ROLE)
+
+IMAGE_PATTERN = re.compile(
+    r"""
+    ^               # Start of a line
+    !\[             # Literal '![', start of markdown image
+    (.*?)           # Non-greedy capture for the alt text (optional)
+    \]              # Literal closing bracket
+    \(\s*           # Literal '(', start of URL, allowing optional whitespace
+    (.*?)           # Non-greedy capture for the URL
+    \s*             # Allow optional whitespace
+    (?:             # Non-capturing group for optional title
+        "           # Opening quote for title
+        (.*?)       # Non-greedy capture for the title text
+        "           # Closing quote for title
+    )?              # Title is optional
+    \)              # Literal closing parenthesis
+    \s*$            # Allow optional whitespace till the end of the line
+    """,
+    re.VERBOSE,
+)
+
+DATA_URL_PATTERN = re.compile(r"data:([\w.+-]+/[\w.+-]+);base64,", re.IGNORECASE)
 
 DEFAULT_FILEPATH = "New Conversation.md"
 
+TEXTLLM_SETTING_PREFIX = "textllm_"
+DEFAULT_BACKEND = "litellm"
+
+# LiteLLM provider prefixes that take explicit `cache_control` breakpoints.
+# Others (e.g. OpenAI) cache automatically or not at all.
+PROMPT_CACHE_PROVIDERS = {"anthropic", "bedrock", "vertex_ai", "openrouter"}
+
 TEST_MODE = False
 
 
@@ -227,6 +371,66 @@ def _chunk_usage(chunk):
         return getattr(chunk, "usage", None)
 
 
+def _read_dict_chunk(chunk):
+    choices = chunk.get("choices")
+    delta = choices[0].get("delta") if choices else None
+    return (delta or {}).get("content") or "", chunk.get("usage")
+
+
+def _read_object_chunk(chunk):
+    choices = chunk.choices
+    delta = getattr(choices[0], "delta", None) if choices else None
+    return getattr(delta, "content", None) or "", getattr(chunk, "usage", None)
+
+
+def _chunk_reader(chunk):
+    """Pick a `(text, usage)` reader for a stream based on its first chunk.
+
+    Chunks in one stream all have the same shape, so it is detected once rather
+    than probed with exceptions on every chunk like `_chunk_text()` does.
+    """
+    if isinstance(chunk, dict):
+        return _read_dict_chunk
+    if hasattr(chunk, "choices"):
+        return _read_object_chunk
+    return lambda chunk: (_chunk_text(chunk), _chunk_usage(chunk))
+
+
+def _read_chunks(chunks):
+    """Yield `(text, usage)` for raw stream chunks."""
+    read = None
+    for chunk in chunks:
+        read = read or _chunk_reader(chunk)
+        yield read(chunk)
+
+
+async def _aread_chunks(chunks):
+    """Async version of `_read_chunks()`."""
+    read = None
+    async for chunk in chunks:
+        read = read or _chunk_reader(chunk)
+        yield read(chunk)
+
+
+def _cache_usage(usage):
+    """Return `(cache_read, cache_write)` prompt-cache token counts or None.
+
+    Anthropic-style usage reports `cache_read_input_tokens` and
+    `cache_creation_input_tokens`. OpenAI-style usage reports reads as
+    `prompt_tokens_details.cached_tokens`.
+    """
+
+    def get(obj, key):
+        if isinstance(obj, dict):
+            return obj.get(key)
+        return getattr(obj, key, None)
+
+    cache_read = get(usage, "cache_read_input_tokens")
+    if cache_read is None and (details := get(usage, "prompt_tokens_details")):
+        cache_read = get(details, "cached_tokens")
+    return cache_read, get(usage, "cache_creation_input_tokens")
+
+
 def _configure_litellm(litellm):
     """Keep LiteLLM diagnostics out of the streamed CLI response."""
 
@@ -235,353 +439,2239 @@ def _configure_litellm(litellm):
 
 
 def iter_completion_text(*, model, messages, settings):
-    if _test_mode_enabled():
-        log.info("Using deterministic test chat model")
-        for text in _iter_test_chunks(messages):
-            yield text, None
-        return
+    """Stream `(text, usage)` tuples for a chat completion.
 
-    import litellm
-
-    _configure_litellm(litellm)
+    The request is forwarded to a running `textllm serve` worker when one is
+    listening on `$TEXTLLM_SOCKET`. Otherwise it runs in-process with the backend
+    named by the `textllm_backend` setting (see `BACKENDS`). `textllm_*` settings
+    are never passed to the backend.
+    """
+    if sock := _connect_worker():
+        request = _worker_request(model=model, messages=messages, settings=settings)
+        if request:
+            yield from _iter_worker_completion(sock, request)
+            return
+        sock.close()
 
-    stream = litellm.completion(
+    yield from _iter_local_completion(
         model=model,
         messages=messages,
-        stream=True,
-        **settings,
+        settings=settings,
+        test_mode=_test_mode_enabled(),
     )
-    for chunk in stream:
-        text = _chunk_text(chunk)
-        usage = _chunk_usage(chunk)
-        yield text, usage
-
-
-def _content_blocks(content):
-    if isinstance(content, list):
-        return content.copy()
-    return [{"type": "text", "text": content}]
 
 
-def _merge_content(first, second):
-    if isinstance(first, str) and isinstance(second, str):
-        return f"{first}\n\n{second}"
+def _iter_local_completion(*, model, messages, settings, test_mode):
+    settings, options = _backend_settings(settings)
+    backend = _backend_name(options)
+    request = dict(model=model, messages=messages, settings=settings)
 
-    blocks = _content_blocks(first)
-    if blocks and blocks[-1].get("type") == "text":
-        blocks[-1] = blocks[-1].copy()
-        blocks[-1]["text"] = f"{blocks[-1].get('text', '')}\n\n"
+    if CONFIG.TEXTLLM_REPLAY:
+        chunks = Cassette(CONFIG.TEXTLLM_REPLAY).replay(**request)
+    elif test_mode:
+        log.info("Using deterministic test chat model")
+        for text in _iter_test_chunks(messages):
+            yield text, None
+        return
     else:
-        blocks.append({"type": "text", "text": "\n\n"})
-    blocks.extend(_content_blocks(second))
-    return blocks
-
+        log.debug(f"Using {backend!r} backend")
+        t0 = time.perf_counter()
+        chunks = BACKENDS[backend](**request)
+        if CONFIG.TEXTLLM_RECORD:
+            chunks = Cassette(CONFIG.TEXTLLM_RECORD).record(chunks, t0, **request)
 
-def merge_message_runs(messages):
-    """Merge adjacent messages with the same role.
-
-    This mirrors the LangChain behavior textllm used before the LiteLLM
-    migration while keeping messages as provider-friendly dictionaries.
-    """
-    merged = []
-    for message in messages:
-        if merged and merged[-1]["role"] == message["role"]:
-            merged[-1] = {
-                "role": merged[-1]["role"],
-                "content": _merge_content(
-                    merged[-1]["content"],
-                    message["content"],
-                ),
-            }
-            continue
-        merged.append(message.copy())
-    return merged
+    yield from _read_chunks(chunks)
 
 
-class Conversation:
-    """Read, parse, update, and optionally rename a textllm conversation file.
+async def aiter_completion_text(*, model, messages, settings):
+    """Async version of `iter_completion_text()`.
 
-    Parameters
-    ----------
-    filepath : str or path-like
-        Path to a Markdown conversation file in textllm format.
+    Backends registered with `asynchronous=True` are awaited directly. Other
+    backends are run in a worker thread so the event loop is never blocked.
     """
+    if sock := await asyncio.to_thread(_connect_worker):  # `connect()` blocks
+        request = _worker_request(model=model, messages=messages, settings=settings)
+        if request:
+            async for item in _aiter_worker_completion(sock, request):
+                yield item
+            return
+        sock.close()
 
-    def __init__(self, filepath):
-        self.filepath = self.filepath0 = filepath
-
-        # Read and strip trailing whitespace before parsing.
-        with open(self.filepath, "rt") as fp:
-            self.text = fp.read().rstrip()
+    settings, options = _backend_settings(settings)
+    backend = _backend_name(options)
+    request = dict(model=model, messages=messages, settings=settings)
 
-        self.parsed = loads(self.text)
-        self.messages = self.process_conversation()
+    if CONFIG.TEXTLLM_REPLAY:
+        chunks = Cassette(CONFIG.TEXTLLM_REPLAY).areplay(**request)
+    elif _test_mode_enabled():
+        log.info("Using deterministic test chat model")
+        async for text in _aiter_test_chunks(messages):
+            yield text, None
+        return
+    else:
+        log.debug(f"Using {backend!r} backend (async)")
+        t0 = time.perf_counter()
+        if backend in ASYNC_BACKENDS:
+            chunks = ASYNC_BACKENDS[backend](**request)
+        else:
+            stream_chunks = BACKENDS[backend]
+            chunks = _aiter_in_thread(lambda: iter(stream_chunks(**request)))
+        if CONFIG.TEXTLLM_RECORD:
+            chunks = Cassette(CONFIG.TEXTLLM_RECORD).arecord(chunks, t0, **request)
 
-    def call_llm(self, messages, *, print_stream=False, **new_settings):
-        """Call the configured chat model.
+    async for item in _aread_chunks(chunks):
+        yield item
 
-        Parameters
-        ----------
-        messages : list
-            OpenAI-style message dictionaries to send to the model.
-        print_stream : bool, optional
-            Whether to print response chunks to stdout while collecting them.
-        **new_settings
-            Settings that override the conversation settings for this call.
 
-        Returns
-        -------
-        LLMResponse
-            Normalized model response.
-        """
-        settings = self.settings.copy() | new_settings
-        log.debug(f"Settings {settings}")
+async def _aiter_test_chunks(messages):
+    for text in _iter_test_chunks(messages):
+        await asyncio.sleep(0)  # Yield control like a real stream
+        yield text
 
-        model = settings.pop("model")  # Will KeyError if not set as expected
-        log.debug(f"{model = }")
 
-        content = []
-        usage_metadata = None
-        if print_stream:
-            print("\n", end="", flush=True)
-        for chunk_text, chunk_usage in iter_completion_text(
-            model=model,
-            messages=messages,
-            settings=settings,
-        ):
-            content.append(chunk_text)
-            if chunk_usage:
-                usage_metadata = chunk_usage
-            if print_stream:
-                print(chunk_text, end="", flush=True)
-        if print_stream:
-            print("\n\n", end="", flush=True)
+async def _aiter_in_thread(make_iterator):
+    """Iterate a blocking iterator from async code, one thread hop per item.
 
-        response_text = "".join(content)
-        if not response_text:
-            raise ValueError("Model stream did not include text content")
+    If the consumer stops early (or is cancelled), the iterator is closed, so
+    an HTTP response is not left open. That happens in a daemon thread once
+    any read in progress returns, so a stalled read never blocks the caller.
+    """
+    iterator = await asyncio.to_thread(make_iterator)
+    lock = threading.Lock()  # A generator can't be closed while it runs
+    done = object()
 
-        response = LLMResponse(
-            content=response_text,
-            usage_metadata=usage_metadata,
-        )
+    def step():
+        with lock:
+            return next(iterator, done)
 
-        try:
-            usage = response.usage_metadata
-            input_tokens = usage.get("input_tokens", usage.get("prompt_tokens"))
-            output_tokens = usage.get("output_tokens", usage.get("completion_tokens"))
-            total_tokens = usage.get("total_tokens")
-            logtxt = (
-                f"tokens: "
-                f"prompt {input_tokens}, "
-                f"completion {output_tokens}, "
-                f"total {total_tokens}"
-            )
-            log.debug(logtxt)
-        except AttributeError:
-            # Usage details are provider-dependent in streamed responses.
-            pass
+    def close():
+        with lock:
+            getattr(iterator, "close", lambda: None)()
 
-        return response
+    try:
+        while (item := await asyncio.to_thread(step)) is not done:
+            yield item
+    finally:
+        threading.Thread(target=close, name="textllm-close", daemon=True).start()
 
-    def chat(self, require_user_prompt=True):
-        """Append one assistant response to the conversation file.
 
-        Parameters
-        ----------
-        require_user_prompt : bool, optional
-            Require the current conversation to end with a user message.
+@dataclass(frozen=True)
+class StreamDeadlines:
+    """Time limits for a model stream, in seconds. None is no limit.
 
-        Raises
-        ------
-        NoUserMessageError
-            If `require_user_prompt` is true and the conversation does not end
-            with a user message.
-        """
-        if require_user_prompt and (
-            not self.messages or self.messages[-1]["role"] != "user"
-        ):
-            raise NoUserMessageError("Must have a new user message")
+    Built from the `textllm_first_token_timeout`, `textllm_idle_timeout`, and
+    `textllm_total_timeout` settings.
 
-        response = self.call_llm(messages=self.messages, print_stream=True)
+    Attributes
+    ----------
+    first_token : float or None
+        From the request to the first text, including connecting.
+    idle : float or None
+        Between chunks (and from the request to the first one).
+    total : float or None
+        From the request to the end of the stream.
+    """
 
-        # Not really needed but in case I do more with it later
-        self.messages.append({"role": "assistant", "content": response.content})
+    first_token: float | None = None
+    idle: float | None = None
+    total: float | None = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        _, options = split_settings(settings)
+        limits = {}
+        for field, name in [
+            ("first_token", "textllm_first_token_timeout"),
+            ("idle", "textllm_idle_timeout"),
+            ("total", "textllm_total_timeout"),
+        ]:
+            limit = options.get(name)
+            if limit is not None and (
+                isinstance(limit, bool)
+                or not isinstance(limit, (int, float))
+                or limit <= 0
+            ):
+                raise ValueError(f"{name} must be a positive number. Got {limit!r}")
+            limits[field] = limit
+        return cls(**limits)
 
-        # Add escapes to flags in the content
-        content = response.content
-        content = CONVO_PATTERN.sub(r"\\\1", content)
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in astuple(self))
 
-        with open(self.filepath, "r+") as file:
-            # Move to the last non-white space up to 100
-            # characters
-            file.seek(0, 2)  # Move to the end of the file
-            file_length = file.tell()
+    def next_wait(self, started, last_chunk, got_text):
+        """Return `(seconds, reason)` until the earliest deadline for the next
+        chunk, or `(None, None)` if there is none. Times are `time.monotonic()`.
+        """
+        limits = []
+        if self.first_token is not None and not got_text:
+            reason = f"no text after {self.first_token:g} s"
+            limits.append((started + self.first_token, reason))
+        if self.idle is not None:
+            limits.append((last_chunk + self.idle, f"no chunk for {self.idle:g} s"))
+        if self.total is not None:
+            limits.append((started + self.total, f"took over {self.total:g} s"))
+        if not limits:
+            return None, None
+        deadline, reason = min(limits)
+        return max(deadline - time.monotonic(), 0), reason
+
+
+def _iter_with_deadlines(chunks, deadlines):
+    """Yield `(text, usage)` items from `chunks`, raising `StreamTimeout` when
+    a deadline in `deadlines` passes.
+
+    The stream is read in a daemon thread so a stalled read can be abandoned.
+    It stops and closes `chunks` at its next item.
+    """
+    items = queue.Queue()
+    stop = threading.Event()
+    done = object()
 
-            MX = 100
-            for _ in range(MX):
-                if file_length == 0:
-                    break
-                file.seek(file_length - 1)
-                if not file.read(1).isspace():
-                    file.seek(file_length)  # Move forward character
+    def read():
+        try:
+            for item in chunks:
+                if stop.is_set():
                     break
-                file_length -= 1
+                items.put(item)
+        except BaseException as exc:  # Re-raised in the caller
+            items.put(exc)
+        finally:
+            getattr(chunks, "close", lambda: None)()
+            items.put(done)
+
+    threading.Thread(target=read, name="textllm-stream", daemon=True).start()
+    started = last_chunk = time.monotonic()
+    got_text = False
+    try:
+        while True:
+            wait, reason = deadlines.next_wait(started, last_chunk, got_text)
+            try:
+                item = items.get(timeout=wait)
+            except queue.Empty:
+                raise StreamTimeout(reason) from None
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            last_chunk = time.monotonic()
+            got_text = got_text or bool(item[0])
+            yield item
+    finally:
+        stop.set()
+
+
+async def _aiter_with_deadlines(chunks, deadlines):
+    """Async version of `_iter_with_deadlines()`. A missed deadline cancels
+    the pending read."""
+    started = last_chunk = time.monotonic()
+    got_text = False
+    try:
+        while True:
+            wait, reason = deadlines.next_wait(started, last_chunk, got_text)
+            # Not `wait_for()`, which can't tell its timeout from the stream's
+            read = asyncio.ensure_future(anext(chunks))
+            if not (await asyncio.wait({read}, timeout=wait))[0]:
+                read.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await read
+                raise StreamTimeout(reason)
+            try:
+                item = read.result()
+            except StopAsyncIteration:
+                return
+            last_chunk = time.monotonic()
+            got_text = got_text or bool(item[0])
+            yield item
+    finally:
+        await chunks.aclose()
+
+
+def _backend_settings(settings):
+    """`split_settings()`, with `textllm_stream_usage = false` applied."""
+    settings, options = split_settings(settings)
+    if options.get("textllm_stream_usage") is False:
+        settings["stream_options"] = None  # Dropped by `_with_stream_usage()`
+    return settings, options
+
+
+def _backend_name(options):
+    backend = options.get("textllm_backend", DEFAULT_BACKEND)
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown textllm_backend {backend!r}. Choose from {sorted(BACKENDS)}"
+        )
+    return backend
 
-            else:
-                log.debug(
-                    f"Did not find a non-whitespace character within the last {MX} "
-                    "characters."
-                )
-            file.write("\n\n--- Assistant ---  \n\n")
-            file.write(content)
-            file.write("\n\n--- User ---  \n\n")
 
-            log.info(f"Updated {self.filepath!r}")
+def split_settings(settings):
+    """Separate pass-through settings from textllm-owned `textllm_*` settings.
 
-    def set_title(self):
-        """Replace the auto-title marker with a generated title when present."""
-        top, rest = self.text.split("\n", 1)
-        if AUTO_TITLE not in top:
-            log.debug(f"{AUTO_TITLE!r} not found in first line.")
-            return  # This will happen nearly every time but the first
+    Parameters
+    ----------
+    settings : dict
+        Merged conversation settings, without `model`.
 
-        new = [
-            {"role": "system", "content": TITLE_SYSTEM_PROMPT},
-            {"role": "user", "content": json.dumps(self.parsed["conversation"])},
-        ]
+    Returns
+    -------
+    tuple
+        `(passthrough, options)` dictionaries. Only `passthrough` may be sent to
+        a backend.
+    """
+    passthrough, options = {}, {}
+    for key, value in settings.items():
+        if key.startswith(TEXTLLM_SETTING_PREFIX):
+            options[key] = value
+        else:
+            passthrough[key] = value
+    return passthrough, options
 
-        if _test_mode_enabled():  # For testing, I don't want to provide this
-            del new[1]
 
-        response = self.call_llm(messages=new)
-        title = response.content
+########################################
+############### Backends ###############
+########################################
+BACKENDS = {}
+ASYNC_BACKENDS = {}
 
-        top = top.replace(AUTO_TITLE, title)
-        self.text = f"{top}\n{rest}"
-        with open(self.filepath, "wt") as fp:
-            fp.write(self.text)
-        log.info(f"Set title to {title!r}")
 
-    @cached_property
-    def settings(self):
-        """dict: Conversation settings merged onto template defaults."""
-        defaults = Conversation.read_settings(CONFIG.TEMPLATE)
-        return defaults | self.parsed["settings"]
+def register_backend(name, *, asynchronous=False):
+    """Register a streaming backend under `name` for `textllm_backend`.
 
-    @staticmethod
-    def read_settings(text):
-        """Read the first TOML fenced code block from Markdown text.
+    A backend is called with keyword arguments `model`, `messages`, and
+    `settings` (pass-through settings only) and returns an iterable of
+    OpenAI-style streaming chunks, either dictionaries or objects. With
+    `asynchronous=True`, it is instead an async generator used by
+    `aiter_completion_text()`. Every async backend must also have a
+    synchronous one.
+    """
 
-        Parameters
-        ----------
-        text : str
-            Markdown text that may contain a TOML fenced code block.
+    def decorator(func):
+        (ASYNC_BACKENDS if asynchronous else BACKENDS)[name] = func
+        return func
 
-        Returns
-        -------
-        dict
-            Parsed TOML settings, or an empty dictionary when none are found.
-        """
-        pattern = re.compile(
-            r"""
-                ^```          # Start of line with fenced code block
-                \s*           # Optional whitespace
-                (?:toml)?     # Optional designation as TOML
-                \s*$          # Optional whitespace to end of line
-                \n            # At least one new line
-                (.*?)         # Actual TOML code (non-greedy)
-                \n            # New line before closing fence
-                ^```          # Closing fence on its own line
-                \s*$          # Optional whitespace to end of line
-            """,
-            flags=re.VERBOSE | re.DOTALL | re.MULTILINE | re.IGNORECASE,
-        )
+    return decorator
 
-        if match := pattern.search(text):  # First one only
-            toml_content = match.group(1).strip()
-            return tomllib.loads(toml_content)
 
-        return {}
+class BackendError(RuntimeError):
+    """Error returned by a model endpoint."""
 
-    @staticmethod
-    def loads(text):
-        """Parse textllm Markdown into title, settings, top matter, and messages.
 
-        Parameters
-        ----------
-        text : str
-            Markdown conversation text.
+class StreamTimeout(TimeoutError):
+    """The model stream missed a `StreamDeadlines` deadline.
 
-        Returns
-        -------
-        dict
-            Parsed conversation data with `title`, `settings`, `top`, and
-            `conversation` keys.
-        """
-        res = {}
+    `reason` says which, e.g. "no chunk for 30 s", and is what
+    `INTERRUPTED_MARKER` shows after any partial response.
+    """
 
-        split_text = CONVO_PATTERN.split(text)
+    def __init__(self, reason):
+        super().__init__(f"Model stream timed out: {reason}")
+        self.reason = reason
 
-        # Split will split at the flags. If the first item is a flag, then there is no
-        # top matter. If it isn't a flag, the first item is top matter.
-        if split_text[0].lower() not in FLAG2ROLE:
-            top = split_text.pop(0)
-        else:
-            top = ""
 
-        res["title"] = top.split("\n")[0].strip().strip("#").strip()
-        res["settings"] = Conversation.read_settings(top)
-        res["top"] = top
+def _with_stream_usage(settings, supported=True):
+    """Ask for a final usage chunk (`stream_options`) unless the settings say.
 
-        re_role = re.compile("--- (.*) ---")
-        res["conversation"] = conversation = []
-        for flag, msg in grouper(split_text, 2):
-            msg = msg.strip()
-            if not msg:
-                continue  # Empty or blank
+    OpenAI-style endpoints only report usage for streams that request it. An
+    explicit `stream_options` setting is left alone. `stream_options = None`
+    (from `textllm_stream_usage = false`) sends none at all.
+    """
+    if settings.get("stream_options", False) is None:
+        return {k: v for k, v in settings.items() if k != "stream_options"}
+    if not supported or "stream_options" in settings:
+        return settings
+    return settings | {"stream_options": {"include_usage": True}}
 
-            # Clean up and unescape
-            msg_lines = []
-            for line in msg.strip().split("\n"):
-                if any(line.lower().startswith(rf"\{flag}") for flag in FLAG2ROLE):
-                    line = line[1:]
-                msg_lines.append(line)
 
-            role = re_role.findall(flag)[0].lower()  # Must be a flag from initial split
-            content = "\n".join(msg_lines)
+def _litellm_stream_usage(litellm, model):
+    """Whether LiteLLM accepts `stream_options` for `model`'s provider."""
+    try:
+        params = litellm.get_supported_openai_params(model=model)
+    except Exception:  # Unknown providers raise
+        return False
+    return "stream_options" in (params or ())
 
-            conversation.append({"role": role, "content": content})
 
-        return res
+@register_backend("litellm")
+def _litellm_stream(*, model, messages, settings):
+    with _phase("import"):
+        import litellm
 
-    def process_conversation(self):
-        """Convert parsed conversation blocks into OpenAI-style messages.
+    _configure_litellm(litellm)
+
+    return litellm.completion(
+        model=model,
+        messages=messages,
+        stream=True,
+        **_with_stream_usage(settings, _litellm_stream_usage(litellm, model)),
+    )
+
+
+@register_backend("litellm", asynchronous=True)
+async def _litellm_astream(*, model, messages, settings):
+    # The first import can take seconds. Keep it off the event loop.
+    with _phase("import"):
+        litellm = await asyncio.to_thread(importlib.import_module, "litellm")
+
+    _configure_litellm(litellm)
+
+    stream = await litellm.acompletion(
+        model=model,
+        messages=messages,
+        stream=True,
+        **_with_stream_usage(settings, _litellm_stream_usage(litellm, model)),
+    )
+    async for chunk in stream:
+        yield chunk
+
+
+@register_backend("openai-compat")
+def _openai_compat_stream(*, model, messages, settings):
+    """Stream from an OpenAI-compatible endpoint with only the standard library.
+
+    `api_base` (or `base_url`) and `api_key` are read from the settings and
+    fall back to `$OPENAI_BASE_URL`/`$OPENAI_API_BASE` and `$OPENAI_API_KEY`.
+    An `openai/` provider prefix is removed from the model name.
+    """
+    import urllib.error
+    import urllib.request
+
+    settings = settings.copy()
+    api_base = (
+        settings.pop("api_base", None)
+        or settings.pop("base_url", None)
+        or os.environ.get("OPENAI_BASE_URL")
+        or os.environ.get("OPENAI_API_BASE")
+        or "https://api.openai.com/v1"
+    )
+    api_key = settings.pop("api_key", None) or os.environ.get("OPENAI_API_KEY")
+    timeout = settings.pop("timeout", 600)
+
+    headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    headers |= settings.pop("extra_headers", None) or {}
+
+    body = _with_stream_usage(settings) | dict(
+        model=model.removeprefix("openai/"),
+        messages=messages,
+        stream=True,
+    )
+    url = api_base.rstrip("/") + "/chat/completions"
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode("utf-8"),
+        headers=headers,
+        method="POST",
+    )
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as E:
+        detail = E.read().decode("utf-8", errors="replace").strip()
+        raise BackendError(f"{url} returned HTTP {E.code}: {detail}") from E
+
+    with response:
+        for line in response:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue  # Blank separators, comments, and event names
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                return
+            chunk = json.loads(data)
+            if "error" in chunk:
+                raise BackendError(f"{url} streamed an error: {chunk['error']}")
+            yield chunk
+
+
+########################################
+############# END Backends #############
+########################################
+
+
+########################################
+############### Cassettes ##############
+########################################
+class Cassette:
+    """Record and replay raw backend stream chunks.
+
+    A cassette is a JSON-lines file with one line per completed request:
+    `{"key", "model", "chunks": [[seconds, chunk], ...]}` where `seconds` is the
+    time since the request started and `chunk` the raw chunk as a dictionary.
+    Set `$TEXTLLM_RECORD` to append streams to a cassette and `$TEXTLLM_REPLAY`
+    to serve them instead of calling a backend. Replayed chunks are read the
+    same way as live ones. A request without a matching recording is an error
+    unless `$TEXTLLM_REPLAY_ANY` is set, in which case the recordings are
+    replayed in order.
+
+    Parameters
+    ----------
+    path : str or path-like
+        Cassette file.
+    speed : float, optional
+        Replay pacing. 0 replays without delay, 1 in real time, 2 twice as
+        fast. Defaults to `$TEXTLLM_REPLAY_SPEED`.
+    """
+
+    _write_lock = threading.Lock()
+    _positions = {}  # Fallback replay position per path
+
+    def __init__(self, path, *, speed=None):
+        self.path = Path(path)
+        self.speed = CONFIG.TEXTLLM_REPLAY_SPEED if speed is None else speed
+
+    def record(self, chunks, t0, *, model, messages, settings):
+        """Pass `chunks` through and append them to the cassette at the end."""
+        recorded = []
+        for chunk in chunks:
+            recorded.append([time.perf_counter() - t0, _jsonable_chunk(chunk)])
+            yield chunk
+        self._append(model, messages, settings, recorded)
+
+    async def arecord(self, chunks, t0, *, model, messages, settings):
+        """Async version of `record()`."""
+        recorded = []
+        async for chunk in chunks:
+            recorded.append([time.perf_counter() - t0, _jsonable_chunk(chunk)])
+            yield chunk
+        await asyncio.to_thread(self._append, model, messages, settings, recorded)
+
+    def replay(self, *, model, messages, settings):
+        """Yield the recorded chunks for this request, paced by `speed`."""
+        t0 = time.perf_counter()
+        for seconds, chunk in self._find(model, messages, settings):
+            if (delay := self._delay(seconds, t0)) > 0:
+                time.sleep(delay)
+            yield chunk
+
+    async def areplay(self, *, model, messages, settings):
+        """Async version of `replay()`."""
+        t0 = time.perf_counter()
+        for seconds, chunk in self._find(model, messages, settings):
+            if (delay := self._delay(seconds, t0)) > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+
+    def _delay(self, seconds, t0):
+        """Time to wait before the chunk recorded `seconds` into the stream."""
+        if not self.speed:
+            return 0
+        return seconds / self.speed - (time.perf_counter() - t0)
+
+    def _append(self, model, messages, settings, recorded):
+        line = json.dumps(
+            {
+                "key": ResponseCache.key(model, messages, settings),
+                "model": model,
+                "chunks": recorded,
+            }
+        )
+        with self._write_lock, open(self.path, "at") as fp:
+            fp.write(line + "\n")
+        log.debug(f"Recorded {len(recorded)} chunks to {str(self.path)!r}")
+
+    def _find(self, model, messages, settings):
+        """Chunks recorded for this exact request.
+
+        Falls back to the next recording in order if `$TEXTLLM_REPLAY_ANY` is
+        set and raises ValueError otherwise.
+        """
+        with open(self.path, "rt") as fp:
+            records = [json.loads(line) for line in fp if line.strip()]
+        if not records:
+            raise ValueError(f"Cassette {str(self.path)!r} is empty")
+
+        key = ResponseCache.key(model, messages, settings)
+        for record in records:
+            if record["key"] == key:
+                log.debug(f"Replaying recorded stream from {str(self.path)!r}")
+                return record["chunks"]
+
+        if not CONFIG.TEXTLLM_REPLAY_ANY:
+            raise ValueError(
+                f"No recording of this request in {str(self.path)!r}. "
+                "Set $TEXTLLM_REPLAY_ANY to replay the recordings in order"
+            )
+        with self._write_lock:
+            position = self._positions.get(self.path, 0)
+            self._positions[self.path] = position + 1
+        log.info(
+            f"No recording of this request in {str(self.path)!r}. "
+            f"Replaying recording {position % len(records)}"
+        )
+        return records[position % len(records)]["chunks"]
+
+
+def _jsonable_chunk(chunk):
+    """Convert a raw stream chunk into a plain dictionary."""
+    if isinstance(chunk, dict):
+        return chunk
+    if hasattr(chunk, "model_dump"):
+        return chunk.model_dump(mode="json")
+    return json.loads(json.dumps(chunk, default=vars))
+
+
+########################################
+############ END Cassettes #############
+########################################
+
+
+########################################
+############### Metrics ################
+########################################
+METRICS = None  # The active `Metrics` or None when metrics are off
+_NO_PHASE = contextlib.nullcontext()
+
+
+class Metrics:
+    """Phase timings and per-call latency for one textllm invocation.
+
+    Enabled by `--stats` or `$TEXTLLM_METRICS_LOG` via `start_metrics()`. When
+    disabled, `_phase()` returns a shared null context so instrumentation costs
+    only an attribute check.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the block to phase `name`."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def add_call(
+        self, *, purpose, model, started, first_token, ended, content, usage
+    ):
+        """Record one model call. Times are `time.perf_counter()` values."""
+        usage = _jsonable_usage(usage) or {}
+        tokens = usage.get("completion_tokens", usage.get("output_tokens"))
+        call = {
+            "purpose": purpose,
+            "model": model,
+            "ttft": None if first_token is None else first_token - started,
+            "stream": None if first_token is None else ended - first_token,
+            "total": ended - started,
+            "chars": len(content),
+            "tokens": tokens or estimate_tokens(content),
+            "tokens_estimated": not tokens,
+        }
+        if call["stream"]:
+            call["tokens_per_sec"] = call["tokens"] / call["stream"]
+        with self._lock:
+            self.calls.append(call)
+
+    def as_dict(self):
+        return {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "total": time.perf_counter() - self.started,
+            "phases": self.phases,
+            "calls": self.calls,
+        }
+
+    def report(self):
+        """Human-readable summary."""
+        data = self.as_dict()
+        lines = ["textllm stats:"]
+        for name, seconds in data["phases"].items():
+            lines.append(f"  {name:<10} {1000 * seconds:9.1f} ms")
+        for call in data["calls"]:
+            line = f"  {call['purpose']:<10} {1000 * call['total']:9.1f} ms"
+            if call["ttft"] is not None:
+                line += f"  (TTFT {1000 * call['ttft']:.1f} ms"
+                if rate := call.get("tokens_per_sec"):
+                    approx = "~" if call["tokens_estimated"] else ""
+                    line += f", {approx}{rate:.1f} tokens/s"
+                line += ")"
+            lines.append(line)
+        lines.append(f"  {'total':<10} {1000 * data['total']:9.1f} ms")
+        return "\n".join(lines)
+
+    def record(self, path):
+        """Append the metrics as one JSON line to `path`."""
+        with open(path, "at") as fp:
+            fp.write(json.dumps(self.as_dict()) + "\n")
+
+
+def start_metrics(started=None):
+    """Start collecting metrics for this process and return the `Metrics`.
+
+    `started` is the `time.perf_counter()` value to measure the total from.
+    """
+    global METRICS
+    METRICS = Metrics()
+    if started is not None:
+        METRICS.started = started
+    return METRICS
+
+
+def _phase(name):
+    return METRICS.phase(name) if METRICS else _NO_PHASE
+
+
+########################################
+############# END Metrics ##############
+########################################
+
+
+########################################
+############# Usage Ledger #############
+########################################
+USAGE_LEDGER_NAME = ".textllm-usage.jsonl"
+USAGE_FIELDS = ("turns", "prompt_tokens", "completion_tokens", "cached_tokens", "cost")
+USAGE_INDEX_FORMAT = 2  # Bump when the indexed totals change
+_LEDGER_LOCK = threading.Lock()
+
+
+def usage_tokens(usage):
+    """Normalize provider usage into prompt, completion, and cached token counts.
+
+    Returns a dictionary with `prompt_tokens`, `completion_tokens`,
+    `cached_tokens` (prompt-cache reads), and `cache_write_tokens`. Counts the
+    provider did not report are None.
+    """
+    usage = _jsonable_usage(usage) or {}
+    cache_read, cache_write = _cache_usage(usage)
+    return {
+        "prompt_tokens": usage.get("prompt_tokens", usage.get("input_tokens")),
+        "completion_tokens": usage.get(
+            "completion_tokens", usage.get("output_tokens")
+        ),
+        "cached_tokens": cache_read,
+        "cache_write_tokens": cache_write,
+    }
+
+
+def usage_cost(model, tokens, *, load=False):
+    """Cost in USD from LiteLLM's local cost map, or None if unknown.
+
+    Unless `load` is set, LiteLLM is only consulted when it is already
+    imported, so recording usage never adds its import time to a call made with
+    another backend or a warm worker. `usage_report()` prices those calls.
+    """
+    litellm = sys.modules.get("litellm")
+    if litellm is None and load:
+        try:
+            litellm = importlib.import_module("litellm")
+        except ImportError:
+            return None
+        _configure_litellm(litellm)
+    if litellm is None or tokens["prompt_tokens"] is None:
+        return None
+    try:
+        prompt_cost, completion_cost = litellm.cost_per_token(
+            model=model,
+            prompt_tokens=tokens["prompt_tokens"],
+            completion_tokens=tokens["completion_tokens"] or 0,
+        )
+    except Exception as E:  # Unknown models raise provider-specific errors
+        log.debug(f"No cost for {model!r}: {E}")
+        return None
+    return prompt_cost + completion_cost
+
+
+def record_usage(filepath, *, model, purpose, content, usage):
+    """Append one model call to the usage ledger next to `filepath`.
+
+    The ledger is a JSON-lines file named `USAGE_LEDGER_NAME` in the
+    conversation's directory with one line per call. When the provider did not
+    report usage, the completion tokens are estimated from the text and the
+    line is marked `"estimated": true`.
+    """
+    tokens = usage_tokens(usage)
+    estimated = tokens["completion_tokens"] is None
+    if estimated:
+        tokens["completion_tokens"] = estimate_tokens(content)
+    entry = {
+        "time": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "file": os.path.basename(filepath),
+        "purpose": purpose,
+        "model": model,
+        **tokens,
+        "cost": usage_cost(model, tokens),
+        "estimated": estimated,
+    }
+    ledger = os.path.join(os.path.dirname(os.path.abspath(filepath)), USAGE_LEDGER_NAME)
+    try:
+        with _LEDGER_LOCK, open(ledger, "at") as fp:
+            fp.write(json.dumps(entry) + "\n")  # One write per line for O_APPEND
+    except OSError as E:
+        log.warning(f"Could not write usage ledger {ledger}: {E}")
+
+
+def record_rename(old, new):
+    """Note in the usage ledger that conversation `old` is now `new`.
+
+    `textllm usage` then reports the earlier calls under the new name, so a
+    conversation renamed by its title is one file in `--by file` reports.
+    """
+    entry = {
+        "time": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "renamed": os.path.basename(old),
+        "to": os.path.basename(new),
+    }
+    ledger = os.path.join(os.path.dirname(os.path.abspath(new)), USAGE_LEDGER_NAME)
+    if not os.path.exists(ledger):  # No calls were recorded here
+        return
+    try:
+        with _LEDGER_LOCK, open(ledger, "at") as fp:
+            fp.write(json.dumps(entry) + "\n")
+    except OSError as E:
+        log.warning(f"Could not write usage ledger {ledger}: {E}")
+
+
+def _rename_groups(groups, old, new):
+    """Move the totals of file `old` in `_read_ledger()` groups to `new`."""
+    for group in [group for group in groups if group.split("\t")[0] == old]:
+        renamed = "\t".join([new, *group.split("\t")[1:]])
+        totals = Counter(groups.pop(group))
+        totals.update(groups.get(renamed, {}))
+        groups[renamed] = totals
+
+
+def _ledger_group(entry, by):
+    if by == "day":
+        return entry.get("time", "")[:10]
+    return entry.get(by) or ""
+
+
+def _add_usage(totals, entry):
+    totals["turns"] += 1
+    for field in USAGE_FIELDS[1:]:
+        totals[field] += entry.get(field) or 0
+    if entry.get("cost") is None:  # Priced by `usage_report()` if it can be
+        totals["unpriced"] += 1
+        totals["unpriced_prompt_tokens"] += entry.get("prompt_tokens") or 0
+        totals["unpriced_completion_tokens"] += entry.get("completion_tokens") or 0
+
+
+def _price_unpriced(totals, model):
+    """Add the cost of `totals`' unpriced calls, now that LiteLLM may load."""
+    prompt = totals.pop("unpriced_prompt_tokens", 0)
+    completion = totals.pop("unpriced_completion_tokens", 0)
+    if not totals["unpriced"]:
+        return
+    tokens = {"prompt_tokens": prompt, "completion_tokens": completion}
+    if (cost := usage_cost(model, tokens, load=True)) is not None:
+        totals["cost"] += cost
+        totals["unpriced"] = 0
+
+
+def _read_ledger(path, use_index=True):
+    """Per-file, model, day, and purpose usage totals for one ledger.
+
+    With `use_index`, the totals and the byte offset read so far are kept in
+    the `usage-index` disk cache. Ledgers are append-only, so a later call only
+    reads the lines added since. A ledger that shrank or whose first line
+    changed is read again from the start. Rename lines (`record_rename()`)
+    move the totals read so far to the new file name.
+    """
+    cache = DiskCache("usage-index")
+    key = _sha256(os.path.abspath(path))
+    index = {"offset": 0, "head": None, "groups": {}}
+    if use_index and (data := cache.get(key)):
+        try:
+            index = json.loads(data)
+        except ValueError:
+            pass
+
+    with open(path, "rb") as fp:
+        head = _sha256(fp.readline())
+        if (
+            index["head"] != head
+            or index.get("format") != USAGE_INDEX_FORMAT
+            or os.fstat(fp.fileno()).st_size < index["offset"]
+        ):
+            index = {
+                "offset": 0,
+                "head": head,
+                "groups": {},
+                "format": USAGE_INDEX_FORMAT,
+            }
+        fp.seek(index["offset"])
+        data = fp.read()
+
+    data = data[: data.rfind(b"\n") + 1]  # A partial last line is read next time
+    groups = index["groups"]
+    for line in data.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            log.debug(f"Skipping bad line in {path}")
+            continue
+        if "renamed" in entry:
+            _rename_groups(groups, entry["renamed"], entry.get("to", ""))
+            continue
+        group = "\t".join(
+            _ledger_group(entry, by) for by in ("file", "model", "day", "purpose")
+        )
+        totals = Counter(groups.get(group, {}))
+        _add_usage(totals, entry)
+        groups[group] = totals
+    index["offset"] += len(data)
+
+    if use_index and data:
+        cache.put(key, json.dumps(index).encode("utf-8"))
+    return groups
+
+
+def usage_report(paths, *, by="model", use_index=True):
+    """Aggregate the usage ledgers under `paths`.
+
+    Parameters
+    ----------
+    paths : list of str
+        Directories, searched recursively for `USAGE_LEDGER_NAME`, or ledger
+        files.
+    by : {"model", "file", "day", "purpose"}, optional
+        How to group the totals. Files are reported relative to `paths`.
+    use_index : bool, optional
+        Use and update the incremental index in `$TEXTLLM_CACHE_DIR`.
+
+    Returns
+    -------
+    dict
+        Group name to a `Counter` of `USAGE_FIELDS` and `unpriced` (calls with
+        no known cost). Calls recorded without a cost, such as those made
+        without LiteLLM loaded, are priced here from LiteLLM's cost map.
+    """
+    ledgers = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                if USAGE_LEDGER_NAME in filenames:
+                    ledgers.append((path, os.path.join(dirpath, USAGE_LEDGER_NAME)))
+        else:
+            ledgers.append((os.path.dirname(path), path))
+
+    position = ("file", "model", "day", "purpose").index(by)
+    report = defaultdict(Counter)
+    for root, ledger in ledgers:
+        folder = os.path.relpath(os.path.dirname(ledger), root or ".")
+        for group, totals in _read_ledger(ledger, use_index).items():
+            totals = Counter(totals)
+            _price_unpriced(totals, model=group.split("\t")[1])
+            name = group.split("\t")[position]
+            if by == "file":
+                name = os.path.normpath(os.path.join(folder, name))
+            report[name].update(totals)
+    return dict(report)
+
+
+########################################
+########### END Usage Ledger ###########
+########################################
+
+
+########################################
+############# Warm Worker ##############
+########################################
+class WorkerError(RuntimeError):
+    """Error reported by a `textllm serve` worker."""
+
+
+def _jsonable_usage(usage):
+    """Convert provider usage objects into plain dictionaries."""
+    if usage is None or isinstance(usage, dict):
+        return usage
+    if hasattr(usage, "model_dump"):
+        return usage.model_dump()
+    try:
+        return dict(usage)
+    except (TypeError, ValueError):
+        return None
+
+
+def _worker_request(*, model, messages, settings):
+    """Encode a completion request for the worker or None if it can't be."""
+    try:
+        request = json.dumps(
+            dict(
+                model=model,
+                messages=messages,
+                settings=settings,
+                test_mode=_test_mode_enabled(),
+            )
+        )
+    except (TypeError, ValueError) as E:
+        log.debug(f"Request is not JSON serializable for the worker: {E}")
+        return None
+    return request.encode("utf-8") + b"\n"
+
+
+def _connect_worker():
+    """Return a connected socket to a running worker or None."""
+    socket_path = CONFIG.TEXTLLM_SOCKET
+    if not socket_path or not hasattr(socket, "AF_UNIX"):
+        return None
+    try:
+        stat = os.stat(socket_path)
+    except OSError:
+        return None
+    # Requests hold the conversation and settings (maybe `api_key`) and the
+    # reply is written to the file, so only talk to this user's own worker
+    if hasattr(os, "getuid") and (
+        stat.st_uid != os.getuid() or stat.st_mode & 0o077
+    ):
+        log.warning(
+            f"Not using worker socket {socket_path!r}: it must be owned by you "
+            "and not accessible to others. Running in-process"
+        )
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as E:
+        sock.close()
+        log.debug(f"No worker at {socket_path!r} ({E}). Running in-process")
+        return None
+    log.info(f"Using textllm worker at {socket_path!r}")
+    return sock
+
+
+def _iter_worker_completion(sock, request):
+    with sock, sock.makefile("rb") as fp:
+        sock.sendall(request)
+        for line in fp:
+            if (item := _worker_event(line)) is None:
+                return
+            yield item
+    raise WorkerError("Worker closed the connection before the stream finished")
+
+
+async def _aiter_worker_completion(sock, request):
+    reader, writer = await asyncio.open_unix_connection(sock=sock, limit=2**24)
+    try:
+        writer.write(request)
+        await writer.drain()
+        while line := await reader.readline():
+            if (item := _worker_event(line)) is None:
+                return
+            yield item
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    raise WorkerError("Worker closed the connection before the stream finished")
+
+
+def _worker_event(line):
+    """Decode one worker event into `(text, usage)` or None when done."""
+    event = json.loads(line)
+    if "error" in event:
+        raise WorkerError(event["error"])
+    if event.get("done"):
+        return None
+    return event["text"], event.get("usage")
+
+
+class _WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return  # Connection probe from a starting worker
+        try:
+            request = json.loads(line)
+            log.debug(f"Worker request for model {request['model']!r}")
+            for text, usage in _iter_local_completion(
+                model=request["model"],
+                messages=request["messages"],
+                settings=request["settings"],
+                test_mode=request.get("test_mode", False),
+            ):
+                self._send(text=text, usage=_jsonable_usage(usage))
+            self._send(done=True)
+        except (BrokenPipeError, ConnectionResetError):
+            log.debug("Client disconnected mid-stream")
+        except Exception as E:
+            log.error(f"Worker request failed: {E}")
+            try:
+                self._send(error=f"{type(E).__name__}: {E}")
+            except OSError:
+                pass
+
+    def _send(self, **event):
+        self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class WorkerServer(getattr(socketserver, "ThreadingUnixStreamServer", object)):
+    """Long-lived worker that keeps LiteLLM imported between CLI calls.
+
+    Parameters
+    ----------
+    socket_path : str
+        Unix socket path to listen on. A stale socket file is replaced but a
+        live worker is never displaced.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        Path(socket_path).parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                log.debug(f"Removing stale socket {socket_path!r}")
+                os.unlink(socket_path)
+            else:
+                raise ValueError(f"A worker is already listening on {socket_path!r}")
+            finally:
+                probe.close()
+
+        super().__init__(socket_path, _WorkerHandler)
+        os.chmod(socket_path, 0o600)  # The worker holds the user's API keys
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def serve(socket_path):
+    """Run a warm worker on `socket_path` until interrupted.
+
+    Parameters
+    ----------
+    socket_path : str
+        Unix socket path to listen on.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("The textllm worker requires Unix socket support")
+
+    if not _test_mode_enabled():
+        try:
+            import litellm
+        except ImportError as E:
+            log.warning(f"Could not preload LiteLLM: {E}")
+        else:
+            _configure_litellm(litellm)
+
+    server = WorkerServer(socket_path)
+    log.info(f"textllm worker listening on {socket_path!r}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Stopping textllm worker")
+    finally:
+        server.server_close()
+
+
+########################################
+########### END Warm Worker ############
+########################################
+
+
+def estimate_tokens(text):
+    """Estimate the token count of `text` without a provider tokenizer."""
+    return -(-len(text) // CHARS_PER_TOKEN)  # Ceiling division
+
+
+_PINNED_ROLES = {"system", "developer"}
+
+
+def message_tokens(message):
+    """Estimate the tokens one OpenAI-style message adds to a request.
+
+    Image blocks count as a flat `IMAGE_TOKENS` rather than by the size of
+    their (possibly base64) URL.
+    """
+    content = message["content"]
+    if isinstance(content, str):
+        return MESSAGE_TOKENS + estimate_tokens(content)
+
+    tokens = MESSAGE_TOKENS
+    for block in content:
+        if block.get("type") == "text":
+            tokens += estimate_tokens(block.get("text", ""))
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def trim_context(messages, *, max_tokens=None, max_turns=None):
+    """Drop the oldest turns so a request fits a context budget.
+
+    A turn starts at a user message and includes the replies after it. System
+    and developer messages and the latest turn are always kept. The input is not
+    modified.
+
+    Parameters
+    ----------
+    messages : list
+        OpenAI-style message dictionaries.
+    max_tokens : int, optional
+        Drop the oldest turns until the estimated request size is at most this.
+    max_turns : int, optional
+        Keep only the last `max_turns` turns.
+
+    Returns
+    -------
+    list
+        The messages to send.
+    """
+    if not max_tokens and not max_turns:
+        return messages
+
+    counts = [message_tokens(message) for message in messages]  # Count once
+
+    # Start index of each turn. Anything before the first user message that is
+    # not pinned belongs to the first turn.
+    starts = [ii for ii, msg in enumerate(messages) if msg["role"] == "user"]
+    if not starts:
+        return messages
+    starts[0] = 0
+    turns = [range(a, b) for a, b in zip(starts, starts[1:] + [len(messages)])]
+
+    def turn_tokens(turn):
+        return sum(
+            counts[ii] for ii in turn if messages[ii]["role"] not in _PINNED_ROLES
+        )
+
+    drop = max(len(turns) - max_turns, 0) if max_turns else 0
+    if max_tokens:
+        total = sum(counts) - sum(turn_tokens(turn) for turn in turns[:drop])
+        while drop < len(turns) - 1 and total > max_tokens:
+            total -= turn_tokens(turns[drop])
+            drop += 1
+        if total > max_tokens:
+            log.warning(
+                f"Latest turn alone is ~{total} tokens, over the context budget "
+                f"of {max_tokens}. Sending it anyway"
+            )
+
+    if not drop:
+        return messages
+
+    dropped = {ii for turn in turns[:drop] for ii in turn}
+    dropped -= {ii for ii in dropped if messages[ii]["role"] in _PINNED_ROLES}
+    kept = [msg for ii, msg in enumerate(messages) if ii not in dropped]
+    log.debug(
+        f"Context: dropped {drop} oldest turn(s) ({len(dropped)} messages, "
+        f"~{sum(counts[ii] for ii in dropped)} tokens). "
+        f"Sending {len(kept)} messages "
+        f"(~{sum(counts) - sum(counts[ii] for ii in dropped)} tokens)"
+    )
+    return kept
+
+
+def add_cache_breakpoints(messages):
+    """Mark the stable prefix of a request for provider prompt caching.
+
+    The last leading system/developer message and the last assistant message
+    before the new prompt get an ephemeral `cache_control` marker on
+    their last content block. String content is converted to a text block. The
+    input is not modified.
+
+    Parameters
+    ----------
+    messages : list
+        OpenAI-style message dictionaries.
+
+    Returns
+    -------
+    list
+        Messages with at most two cache breakpoints.
+    """
+    marks = []
+    leading = 0
+    while leading < len(messages) and messages[leading]["role"] in _PINNED_ROLES:
+        leading += 1
+    if leading:
+        marks.append(leading - 1)
+    for ii in reversed(range(leading, len(messages) - 1)):  # Not the new prompt
+        if messages[ii]["role"] == "assistant":
+            marks.append(ii)
+            break
+
+    marked = messages.copy()
+    for ii in marks:
+        blocks = _content_blocks(messages[ii]["content"])
+        if not blocks:
+            continue
+        blocks[-1] = blocks[-1] | {"cache_control": {"type": "ephemeral"}}
+        marked[ii] = messages[ii] | {"content": blocks}
+    log.debug(f"Prompt cache breakpoints on messages {marks}")
+    return marked
+
+
+def title_prompt(conversation, max_tokens=TITLE_MAX_TOKENS):
+    """Build the JSON conversation excerpt sent for title generation.
+
+    Only the head of the first system/developer and user messages and the
+    tail of the last assistant reply are included, each trimmed so the total
+    stays within `max_tokens` regardless of conversation size.
+
+    Parameters
+    ----------
+    conversation : list
+        Parsed conversation messages (`loads()["conversation"]`).
+    max_tokens : int, optional
+        Approximate token budget for the message contents.
+
+    Returns
+    -------
+    str
+        JSON list of `{"role", "content"}` excerpts.
+    """
+
+    def first(roles, messages=conversation):
+        return next((m for m in messages if m["role"] in roles), None)
+
+    # (message, share of the budget, keep the tail rather than the head)
+    parts = [
+        (first({"system", "developer"}), 0.15, False),
+        (first({"user"}), 0.6, False),
+        (first({"assistant"}, reversed(conversation)), 0.25, True),
+    ]
+    parts = [part for part in parts if part[0]]
+    total_share = sum(share for _, share, _ in parts)
+
+    excerpts = []
+    for message, share, tail in parts:
+        limit = int(max_tokens * CHARS_PER_TOKEN * share / total_share)
+        content = message["content"]
+        if len(content) > limit:
+            keep = max(limit - len(" [...]"), 0)
+            if tail:
+                content = f"[...] {content[len(content) - keep:]}"
+            else:
+                content = f"{content[:keep]} [...]"
+        excerpts.append({"role": message["role"], "content": content})
+    # Escaping non-ASCII text would multiply its length past the budget
+    return json.dumps(excerpts, ensure_ascii=False)
+
+
+def _content_blocks(content):
+    if isinstance(content, list):
+        return content.copy()
+    return [{"type": "text", "text": content}]
+
+
+@dataclass(slots=True)
+class _MessageRun:
+    """Adjacent messages with the same role, merged in linear time.
+
+    Consecutive strings are collected in `texts` and joined once. After the
+    first list content, everything is kept as `blocks`, where a "\n\n"
+    separator is added to the previous text block (or as its own block after
+    an image) before the next message's blocks.
+    """
+
+    first: dict
+    texts: list | None = None
+    blocks: list | None = None
+    count: int = 1
+
+    def __post_init__(self):
+        if isinstance(content := self.first["content"], str):
+            self.texts = [content]
+        else:
+            self.blocks = content.copy()
+
+    def add(self, content):
+        self.count += 1
+        if self.blocks is None:
+            if isinstance(content, str):
+                self.texts.append(content)
+                return
+            self.blocks = [{"type": "text", "text": "\n\n".join(self.texts) + "\n\n"}]
+            self.texts = None
+        elif self.blocks and self.blocks[-1].get("type") == "text":
+            last = self.blocks[-1].copy()
+            last["text"] = f"{last.get('text', '')}\n\n"
+            self.blocks[-1] = last
+        else:
+            self.blocks.append({"type": "text", "text": "\n\n"})
+        self.blocks.extend(_content_blocks(content))
+
+    def message(self):
+        if self.count == 1:
+            return self.first.copy()
+        if self.blocks is None:
+            return {"role": self.first["role"], "content": "\n\n".join(self.texts)}
+        return {"role": self.first["role"], "content": self.blocks}
+
+
+def merge_message_runs(messages):
+    """Merge adjacent messages with the same role.
+
+    This mirrors the LangChain behavior textllm used before the LiteLLM
+    migration while keeping messages as provider-friendly dictionaries. Strings
+    are joined with a blank line. If any message in a run has content blocks,
+    the run becomes blocks. Each run is joined once, so long runs take
+    linear time.
+    """
+    runs = []
+    for message in messages:
+        if runs and runs[-1].first["role"] == message["role"]:
+            runs[-1].add(message["content"])
+        else:
+            runs.append(_MessageRun(message))
+    return [run.message() for run in runs]
+
+
+class MarkerEscaper:
+    """Incrementally escape role markers in streamed text.
+
+    Feeding chunks gives the same result as escaping the joined text with
+    `CONVO_PATTERN` at once. An incomplete line that could still become a marker is
+    held back until it can be decided.
+    """
+
+    def __init__(self):
+        self.pending = ""
+        self.line_start = True
+
+    def feed(self, text):
+        """Return the escaped text that is safe to write so far."""
+        text, self.pending = self.pending + text, ""
+        out = []
+        if not self.line_start:  # No marker before the next newline
+            head, newline, text = text.partition("\n")
+            out.append(head + newline)
+            if not newline:
+                return "".join(out)
+            self.line_start = True
+
+        body, newline, tail = text.rpartition("\n")
+        if newline:
+            out.append(CONVO_PATTERN.sub(r"\\\1", body + newline))
+        lowtail = tail.lower()
+        if tail and any(flag.startswith(lowtail) for flag in FLAG2ROLE):
+            self.pending = tail
+        else:
+            out.append(CONVO_PATTERN.sub(r"\\\1", tail))
+            self.line_start = not tail
+        return "".join(out)
+
+    def finish(self):
+        """Return whatever is still held back."""
+        text, self.pending = self.pending, ""
+        return CONVO_PATTERN.sub(r"\\\1", text)
+
+
+class Sink(abc.ABC):
+    """Destination for streamed response text with time/size coalescing.
+
+    `write()` buffers text and emits it once `interval` seconds have passed
+    since the last emit or `max_chars` are buffered. `close()` emits the rest.
+    Subclasses implement `_emit(text)` and optionally `_finish(interrupted)`,
+    which returns any closing text. Used as a context manager, an exception
+    counts as an interruption.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Seconds between emits. 0 emits every write.
+    max_chars : int, optional
+        Emit once this many characters are buffered.
+    """
+
+    def __init__(self, *, interval=0, max_chars=64 * 1024):
+        self.interval = interval
+        self.max_chars = max_chars
+        self.buffer = []
+        self.buffered = 0
+        self.last_emit = 0.0  # The first write is emitted after any interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(interrupted=self._interruption(exc_type, exc))
+
+    @staticmethod
+    def _interruption(exc_type, exc):
+        """Reason a stream that raised `exc` stopped, or None if it did not."""
+        if isinstance(exc, StreamTimeout):
+            return exc.reason
+        return exc_type.__name__ if exc_type else None
+
+    def write(self, text):
+        if not text:
+            return
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if (
+            self.buffered >= self.max_chars
+            or time.monotonic() - self.last_emit >= self.interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self._emit("".join(self.buffer))
+            self.buffer.clear()
+            self.buffered = 0
+        self.last_emit = time.monotonic()
+
+    def close(self, *, interrupted=None):
+        """Emit everything. `interrupted` is the reason the stream stopped early."""
+        if text := self._finish(interrupted):
+            self.buffer.append(text)
+        self.flush()
+
+    @abc.abstractmethod
+    def _emit(self, text):
+        """Write out coalesced `text`."""
+
+    def _finish(self, interrupted):
+        return ""
+
+
+class NullSink(Sink):
+    """Discard the stream. Useful to measure stream overhead."""
+
+    def write(self, text):
+        pass
+
+    def _emit(self, text):
+        pass
+
+
+class TerminalSink(Sink):
+    """Print the stream, surrounded by blank lines.
+
+    On a TTY text is flushed every 50 ms so it stays responsive. Otherwise (a
+    pipe or file) it is block-buffered and written in 8 KB pieces. The leading
+    blank line is written on entering the context, not on construction.
+
+    Parameters
+    ----------
+    stream : file-like, optional
+        Defaults to the current `sys.stdout`.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        try:
+            tty = self.stream.isatty()
+        except (AttributeError, ValueError):
+            tty = False
+        super().__init__(interval=0.05 if tty else float("inf"), max_chars=8192)
+
+    def __enter__(self):
+        self.stream.write("\n")
+        return self
+
+    def _emit(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+    def _finish(self, interrupted):
+        return "\n\n"
+
+
+class JSONLinesSink(Sink):
+    """Write the stream as JSON-lines events.
+
+    Each emit is `{"type": "text", "text": ...}` and the stream ends with
+    `{"type": "done"}` or `{"type": "interrupted", "reason": ...}`.
+
+    Parameters
+    ----------
+    fp : file-like
+        Text file to write to. It is flushed but not closed.
+    interval : float, optional
+        Seconds between events.
+    """
+
+    def __init__(self, fp, *, interval=0.1):
+        super().__init__(interval=interval)
+        self.fp = fp
+
+    def _emit(self, text):
+        self._event({"type": "text", "text": text})
+
+    def close(self, *, interrupted=None):
+        self.flush()
+        if interrupted:
+            self._event({"type": "interrupted", "reason": interrupted})
+        else:
+            self._event({"type": "done"})
+
+    def _event(self, event):
+        self.fp.write(json.dumps(event) + "\n")
+        self.fp.flush()
+
+
+class StreamWriter(Sink):
+    """Append an assistant response to a conversation file as it streams.
+
+    Nothing is written until the first text arrives, so a request that fails
+    outright leaves the file untouched. Then the `--- Assistant ---` header is
+    written and escaped text is appended at most every `flush_interval`
+    seconds. `close()` writes the `--- User ---` block, preceded by
+    `INTERRUPTED_MARKER` if the stream did not finish.
+
+    Parameters
+    ----------
+    filepath : str or path-like
+        Conversation file.
+    lock : threading.Lock, optional
+        Held for each write so other writers (the title) do not interleave.
+    flush_interval : float, optional
+        Seconds between writes. 0 writes every chunk. Defaults to
+        `$TEXTLLM_FLUSH_INTERVAL`.
+    """
+
+    def __init__(self, filepath, *, lock=None, flush_interval=None):
+        if flush_interval is None:
+            flush_interval = CONFIG.TEXTLLM_FLUSH_INTERVAL
+        super().__init__(interval=flush_interval)
+        self.filepath = filepath
+        self.lock = lock or threading.Lock()
+        self.escaper = MarkerEscaper()
+        self.file = None
+
+    def write(self, text):
+        if not text:
+            return
+        if self.file is None:
+            self._start()
+        super().write(self.escaper.feed(text))
+
+    def close(self, *, interrupted=None):
+        if self.file is None:
+            return
+        super().close(interrupted=interrupted)
+        self.file.close()
+        self.file = None
+        log.info(f"Updated {self.filepath!r}")
+
+    def _emit(self, text):
+        with _phase("write"), self.lock:
+            self.file.write(text)
+            self.file.flush()
+
+    def _finish(self, interrupted):
+        text = self.escaper.finish()
+        if interrupted:
+            text += "\n\n" + INTERRUPTED_MARKER.format(reason=interrupted)
+            log.warning(f"Response interrupted ({interrupted}). Kept partial text")
+        return text + "\n\n--- User ---  \n\n"
+
+    def _start(self):
+        with _phase("write"), self.lock:
+            with open(self.filepath, "r+") as file:
+                # Drop trailing whitespace, looking back up to 100 characters
+                file.seek(0, 2)  # Move to the end of the file
+                file_length = file.tell()
+
+                MX = 100
+                for _ in range(MX):
+                    if file_length == 0:
+                        break
+                    file.seek(file_length - 1)
+                    if not file.read(1).isspace():
+                        break
+                    file_length -= 1
+                else:
+                    log.debug(
+                        "Did not find a non-whitespace character within the last "
+                        f"{MX} characters."
+                    )
+                file.truncate(file_length)
+            # Append mode so a concurrent title rewrite can't misplace chunks
+            self.file = open(self.filepath, "at")
+            self.file.write("\n\n--- Assistant ---  \n\n")
+            self.file.flush()
+
+
+class AsyncStreamWriter(StreamWriter):
+    """`StreamWriter` for async code that does its file I/O in a thread.
+
+    `write()` only queues the text. A single worker thread escapes, buffers,
+    and writes it in order, so neither the file nor `lock` (which a title write
+    may hold) ever blocks the event loop. Use it as an async context manager;
+    leaving the context waits for the queued writes and closes the file.
+    """
+
+    def __init__(self, filepath, **kwargs):
+        super().__init__(filepath, **kwargs)
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._error = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose(interrupted=self._interruption(exc_type, exc))
+
+    def write(self, text):
+        if text:
+            self._pool.submit(self._run, super().write, text)
+
+    async def aclose(self, *, interrupted=None):
+        """Finish the queued writes, then `close()` the file."""
+        close = partial(super().close, interrupted=interrupted)
+        try:
+            await asyncio.wrap_future(self._pool.submit(self._run, close))
+        finally:
+            self._pool.shutdown(wait=False)
+        if self._error is not None:
+            raise self._error
+
+    def _run(self, func, *args):
+        # Stop writing after an error; it is raised by `aclose()`
+        if self._error is not None:
+            return
+        try:
+            func(*args)
+        except Exception as error:
+            self._error = error
+
+
+class Conversation:
+    """Read, parse, update, and optionally rename a textllm conversation file.
+
+    Parameters
+    ----------
+    filepath : str or path-like
+        Path to a Markdown conversation file in textllm format.
+    response_cache : {"on", "off", "refresh"}, optional
+        Whether model calls use the `ResponseCache`. "refresh" skips reading it
+        but stores the new response. Defaults to "on" if
+        `$TEXTLLM_RESPONSE_CACHE` is set and "off" otherwise.
+    low_memory : bool, optional
+        Parse straight from the file without keeping its text, and do not keep
+        encoded images in the in-process cache after a request is built. For
+        very large files. Defaults to `$TEXTLLM_LOW_MEMORY`. The parse cache is
+        not used.
+
+    Notes
+    -----
+    Local images in `messages` are `LocalImage` blocks that are only read and
+    encoded by `request_messages()`, so loading, validating, and titling a
+    conversation never encodes images. `check_images()` verifies they exist.
+    """
+
+    def __init__(self, filepath, *, response_cache=None, low_memory=None):
+        self.filepath = self.filepath0 = filepath
+        if response_cache is None:
+            response_cache = "on" if CONFIG.TEXTLLM_RESPONSE_CACHE else "off"
+        self.response_cache = response_cache
+        if low_memory is None:
+            low_memory = CONFIG.TEXTLLM_LOW_MEMORY
+        self.low_memory = low_memory
+
+        self._file_lock = threading.Lock()  # Title writes vs. response appends
+        with _phase("parse"):
+            if low_memory:
+                self._text = None
+                with open(self.filepath, "rt") as fp:
+                    self.first_line = fp.readline().rstrip()
+                    fp.seek(0)
+                    self.parsed = parse_lines(fp)
+            else:
+                # Read and strip trailing whitespace before parsing.
+                with open(self.filepath, "rt") as fp:
+                    self._text = fp.read().rstrip()
+                self.first_line = self._text.partition("\n")[0].rstrip()
+
+                if CONFIG.TEXTLLM_PARSE_CACHE:
+                    self.parsed = cached_loads(self.filepath, self._text)
+                else:
+                    self.parsed = loads(self._text)
+        with _phase("messages"):
+            self.messages = self.process_conversation()
+
+    @property
+    def text(self):
+        """str: File text with trailing whitespace removed.
+
+        In low-memory mode this is read from the file on every access.
+        """
+        if self._text is not None:
+            return self._text
+        with open(self.filepath, "rt") as fp:
+            return fp.read().rstrip()
+
+    def call_llm(
+        self, messages, *, print_stream=False, sinks=(), purpose="chat", **new_settings
+    ):
+        """Call the configured chat model.
+
+        Parameters
+        ----------
+        messages : list
+            OpenAI-style message dictionaries to send to the model. Any
+            `LocalImage` blocks (as in `messages`) are encoded first.
+        print_stream : bool, optional
+            Whether to print response chunks to stdout (a `TerminalSink`) while
+            collecting them.
+        sinks : list of Sink, optional
+            Also write response chunks to these as they arrive. The caller
+            closes them.
+        purpose : str, optional
+            Label for metrics, e.g. "chat" or "title".
+        **new_settings
+            Settings that override the conversation settings for this call.
+
+        Returns
+        -------
+        LLMResponse
+            Normalized model response.
+
+        Raises
+        ------
+        StreamTimeout
+            If the stream misses a `StreamDeadlines` deadline. A `StreamWriter`
+            context, as in `chat()`, then keeps the partial response.
+        """
+        messages = self._resolve_images(messages)  # As is if already encoded
+        model, settings = self._call_settings(new_settings)
+        key, cached = self._cached_response(model, messages, settings)
+        if cached:
+            chunks = _iter_cached_chunks(cached)
+        else:
+            chunks = iter_completion_text(
+                model=model,
+                messages=messages,
+                settings=settings,
+            )
+            deadlines = StreamDeadlines.from_settings(settings)
+            if deadlines.enabled:
+                chunks = _iter_with_deadlines(chunks, deadlines)
+
+        content = []
+        usage_metadata = None
+        started, first_token = time.perf_counter(), None
+        terminal = TerminalSink() if print_stream else NullSink()
+        sinks = [*sinks, terminal]
+        with terminal:
+            for chunk_text, chunk_usage in chunks:
+                if first_token is None and chunk_text:
+                    first_token = time.perf_counter()
+                content.append(chunk_text)
+                if chunk_usage:
+                    usage_metadata = chunk_usage
+                for sink in sinks:
+                    sink.write(chunk_text)
+
+        if METRICS:
+            METRICS.add_call(
+                purpose=purpose,
+                model=model,
+                started=started,
+                first_token=first_token,
+                ended=time.perf_counter(),
+                content="".join(content),
+                usage=usage_metadata,
+            )
+        response = self._llm_response(content, usage_metadata)
+        if not cached and CONFIG.TEXTLLM_USAGE_LEDGER:
+            record_usage(
+                self.filepath,
+                model=model,
+                purpose=purpose,
+                content=response.content,
+                usage=usage_metadata,
+            )
+        if key and not cached:
+            ResponseCache().put(key, response)
+        return response
+
+    async def acall_llm(
+        self, messages, *, print_stream=False, sinks=(), purpose="chat", **new_settings
+    ):
+        """Async version of `call_llm()`."""
+        messages = await asyncio.to_thread(self._resolve_images, messages)
+        model, settings = self._call_settings(new_settings)
+        key, cached = await asyncio.to_thread(
+            self._cached_response, model, messages, settings
+        )
+        if cached:
+            chunks = _aiter_cached_chunks(cached)
+        else:
+            chunks = aiter_completion_text(
+                model=model,
+                messages=messages,
+                settings=settings,
+            )
+            deadlines = StreamDeadlines.from_settings(settings)
+            if deadlines.enabled:
+                chunks = _aiter_with_deadlines(chunks, deadlines)
+
+        content = []
+        usage_metadata = None
+        started, first_token = time.perf_counter(), None
+        terminal = TerminalSink() if print_stream else NullSink()
+        sinks = [*sinks, terminal]
+        with terminal:
+            async for chunk_text, chunk_usage in chunks:
+                if first_token is None and chunk_text:
+                    first_token = time.perf_counter()
+                content.append(chunk_text)
+                if chunk_usage:
+                    usage_metadata = chunk_usage
+                for sink in sinks:
+                    sink.write(chunk_text)
+
+        if METRICS:
+            METRICS.add_call(
+                purpose=purpose,
+                model=model,
+                started=started,
+                first_token=first_token,
+                ended=time.perf_counter(),
+                content="".join(content),
+                usage=usage_metadata,
+            )
+        response = self._llm_response(content, usage_metadata)
+        if not cached and CONFIG.TEXTLLM_USAGE_LEDGER:
+            await asyncio.to_thread(
+                record_usage,
+                self.filepath,
+                model=model,
+                purpose=purpose,
+                content=response.content,
+                usage=usage_metadata,
+            )
+        if key and not cached:
+            await asyncio.to_thread(ResponseCache().put, key, response)
+        return response
+
+    def _cached_response(self, model, messages, settings):
+        """Return `(key, response)` from the response cache.
+
+        `key` is None when the cache is off and `response` is None on a miss.
+        """
+        if self.response_cache == "off":
+            return None, None
+        cache = ResponseCache()
+        key = cache.key(model, messages, settings)
+        if self.response_cache == "refresh":
+            log.debug(f"Refreshing response cache entry {key[:12]}")
+            return key, None
+        return key, cache.get(key)
+
+    def _call_settings(self, new_settings):
+        settings = self.settings.copy() | new_settings
+        log.debug(f"Settings {settings}")
+
+        model = settings.pop("model")  # Will KeyError if not set as expected
+        log.debug(f"{model = }")
+        return model, settings
+
+    @staticmethod
+    def _llm_response(content, usage_metadata):
+        response_text = "".join(content)
+        if not response_text:
+            raise ValueError("Model stream did not include text content")
+
+        response = LLMResponse(
+            content=response_text,
+            usage_metadata=usage_metadata,
+        )
+
+        try:
+            usage = response.usage_metadata
+            input_tokens = usage.get("input_tokens", usage.get("prompt_tokens"))
+            output_tokens = usage.get("output_tokens", usage.get("completion_tokens"))
+            total_tokens = usage.get("total_tokens")
+            logtxt = (
+                f"tokens: "
+                f"prompt {input_tokens}, "
+                f"completion {output_tokens}, "
+                f"total {total_tokens}"
+            )
+            cache_read, cache_write = _cache_usage(usage)
+            if cache_read is not None or cache_write is not None:
+                logtxt += f", cache read {cache_read}, cache write {cache_write}"
+            log.debug(logtxt)
+        except AttributeError:
+            # Usage details are provider-dependent in streamed responses.
+            pass
+
+        return response
+
+    def chat(
+        self, require_user_prompt=True, *, print_stream=True, set_title=False, sinks=()
+    ):
+        """Append one assistant response to the conversation file.
+
+        Parameters
+        ----------
+        require_user_prompt : bool, optional
+            Require the current conversation to end with a user message.
+        print_stream : bool, optional
+            Whether to print response chunks to stdout while collecting them.
+        set_title : bool, optional
+            Also run `set_title()`, concurrently with the chat request. Both
+            file writes are serialized and this returns after both finish. A
+            failed title is logged and leaves the marker in place.
+        sinks : list of Sink, optional
+            Additional destinations for the streamed response, such as a
+            `JSONLinesSink`. The caller closes them.
+
+        Returns
+        -------
+        LLMResponse
+            The appended response.
+
+        Raises
+        ------
+        NoUserMessageError
+            If `require_user_prompt` is true and the conversation does not end
+            with a user message.
+        FileNotFoundError
+            If a local image is missing. Raised before any model call.
+        """
+        self.check_images()  # Before any request, including the title
+        if set_title and self.needs_title:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                title = pool.submit(self.set_title)
+                try:
+                    return self.chat(
+                        require_user_prompt, print_stream=print_stream, sinks=sinks
+                    )
+                finally:
+                    # Never let the title replace the reply or the chat's error
+                    if error := title.exception():
+                        log.error(f"Could not set the title: {error!r}")
+
+        self._check_user_prompt(require_user_prompt)
+        with StreamWriter(self.filepath, lock=self._file_lock) as writer:
+            response = self.call_llm(
+                messages=self.request_messages(),
+                print_stream=print_stream,
+                sinks=[writer, *sinks],
+            )
+        self.messages.append({"role": "assistant", "content": response.content})
+        return response
+
+    async def achat(
+        self, require_user_prompt=True, *, print_stream=True, set_title=False, sinks=()
+    ):
+        """Async version of `chat()`."""
+        self.check_images()
+        if set_title and self.needs_title:
+            title = asyncio.create_task(self.aset_title())
+            try:
+                return await self.achat(
+                    require_user_prompt, print_stream=print_stream, sinks=sinks
+                )
+            finally:
+                try:
+                    await title
+                except Exception as error:
+                    log.error(f"Could not set the title: {error!r}")
+
+        self._check_user_prompt(require_user_prompt)
+        # Encoding images can take a while, so build the request in a thread
+        messages = await asyncio.to_thread(self.request_messages)
+        async with AsyncStreamWriter(self.filepath, lock=self._file_lock) as writer:
+            response = await self.acall_llm(
+                messages=messages,
+                print_stream=print_stream,
+                sinks=[writer, *sinks],
+            )
+        self.messages.append({"role": "assistant", "content": response.content})
+        return response
+
+    def request_messages(self):
+        """Return `messages` as sent: trimmed, with images encoded, and with
+        cache breakpoints.
+
+        Only the request is changed; the file always keeps the full history.
+        See `trim_context()`, `resolve_images()`, and `add_cache_breakpoints()`.
+        """
+        _, options = split_settings(self.settings)
+        messages = trim_context(
+            self.messages,
+            max_tokens=options.get("textllm_context_tokens"),
+            max_turns=options.get("textllm_context_turns"),
+        )
+        messages = self._resolve_images(messages)
+        if options.get("textllm_prompt_cache"):
+            provider = self.settings["model"].partition("/")[0]
+            if (
+                provider in PROMPT_CACHE_PROVIDERS
+                and _backend_name(options) == "litellm"
+            ):
+                messages = add_cache_breakpoints(messages)
+            else:
+                log.debug(f"No prompt cache breakpoints for provider {provider!r}")
+        return messages
+
+    def _resolve_images(self, messages):
+        """`resolve_images()` with this conversation's settings."""
+        _, options = split_settings(self.settings)
+        return resolve_images(
+            messages,
+            remember=not self.low_memory,
+            workers=options.get("textllm_image_workers", IMAGE_WORKERS),
+        )
+
+    def check_images(self):
+        """Raise FileNotFoundError if a local image in `messages` is missing.
+
+        This only checks the files, so it is cheap even for many large images.
+        """
+        for message in self.messages:
+            if isinstance(message["content"], list):
+                for block in message["content"]:
+                    if isinstance(block, LocalImage):
+                        block.check()
+
+    def _check_user_prompt(self, require_user_prompt):
+        if require_user_prompt and (
+            not self.messages or self.messages[-1]["role"] != "user"
+        ):
+            raise NoUserMessageError("Must have a new user message")
+
+    def set_title(self):
+        """Replace the auto-title marker with a generated title when present."""
+        if not (messages := self._title_messages()):
+            return
+        response = self.call_llm(
+            messages=messages, purpose="title", **self._title_settings()
+        )
+        self._write_title(response.content)
+
+    async def aset_title(self):
+        """Async version of `set_title()`. The file write runs in a thread."""
+        if not (messages := self._title_messages()):
+            return
+        response = await self.acall_llm(
+            messages=messages, purpose="title", **self._title_settings()
+        )
+        await asyncio.to_thread(self._write_title, response.content)
+
+    @property
+    def needs_title(self):
+        """bool: Whether the first line contains the auto-title marker."""
+        return AUTO_TITLE in self.first_line
+
+    def _title_messages(self):
+        if not self.needs_title:
+            log.debug(f"{AUTO_TITLE!r} not found in first line.")
+            return None  # This will happen nearly every time but the first
+
+        _, options = split_settings(self.settings)
+        max_tokens = options.get("textllm_title_max_tokens", TITLE_MAX_TOKENS)
+        excerpt = title_prompt(self.parsed["conversation"], max_tokens)
+        new = [
+            {"role": "system", "content": TITLE_SYSTEM_PROMPT},
+            {"role": "user", "content": excerpt},
+        ]
+
+        if _test_mode_enabled():  # For testing, I don't want to provide this
+            del new[1]
+        return new
+
+    def _title_settings(self):
+        _, options = split_settings(self.settings)
+        if title_model := options.get("textllm_title_model"):
+            log.debug(f"Using title model {title_model!r}")
+            return {"model": title_model}
+        return {}
+
+    def _write_title(self, title):
+        # Re-read rather than write `self.text` so a response appended while the
+        # title was generated is kept.
+        with self._file_lock:
+            with open(self.filepath, "rt") as fp:
+                top, sep, rest = fp.read().partition("\n")
+            with open(self.filepath, "wt") as fp:
+                fp.write(top.replace(AUTO_TITLE, title) + sep + rest)
+
+            self.first_line = self.first_line.replace(AUTO_TITLE, title)
+            if self._text is not None:
+                top, sep, rest = self._text.partition("\n")
+                self._text = top.replace(AUTO_TITLE, title) + sep + rest
+        log.info(f"Set title to {title!r}")
+
+    @cached_property
+    def settings(self):
+        """dict: Conversation settings merged onto template defaults."""
+        defaults = Conversation.read_settings(CONFIG.TEMPLATE)
+        return defaults | self.parsed["settings"]
+
+    @staticmethod
+    def read_settings(text):
+        """Read the first TOML fenced code block from Markdown text.
+
+        Parameters
+        ----------
+        text : str
+            Markdown text that may contain a TOML fenced code block.
+
+        Returns
+        -------
+        dict
+            Parsed TOML settings, or an empty dictionary when none are found.
+        """
+        pattern = re.compile(
+            r"""
+                ^```          # Start of line with fenced code block
+                \s*           # Optional whitespace
+                (?:toml)?     # Optional designation as TOML
+                \s*$          # Optional whitespace to end of line
+                \n            # At least one new line
+                (.*?)         # Actual TOML code (non-greedy)
+                \n            # New line before closing fence
+                ^```          # Closing fence on its own line
+                \s*$          # Optional whitespace to end of line
+            """,
+            flags=re.VERBOSE | re.DOTALL | re.MULTILINE | re.IGNORECASE,
+        )
+
+        if match := pattern.search(text):  # First one only
+            toml_content = match.group(1).strip()
+            return tomllib.loads(toml_content)
+
+        return {}
+
+    @staticmethod
+    def loads(text):
+        """Parse textllm Markdown into title, settings, top matter, and messages.
+
+        Parameters
+        ----------
+        text : str
+            Markdown conversation text.
+
+        Returns
+        -------
+        dict
+            Parsed conversation data with `title`, `settings`, `top`, and
+            `conversation` keys. See `parse_lines()`.
+        """
+        return parse_lines(io.StringIO(text, newline="\n"))
+
+    def process_conversation(self):
+        """Convert parsed conversation blocks into OpenAI-style messages.
 
         Returns
         -------
         list
             Merged message dictionaries with Markdown images converted to image
-            URL content blocks.
+            URL content blocks. Local images are unencoded `LocalImage` blocks.
         """
+        image_options = ImageOptions.from_settings(self.settings)
         conversation = []
         for item in self.parsed["conversation"]:
             flag = f"--- {item['role']} ---"
-            msg = item["content"]
-
-            # Clean up and unescape
-            msg_lines = []
-            for line in msg.strip().split("\n"):
-                if any(line.lower().startswith(rf"\{flag}") for flag in FLAG2ROLE):
-                    line = line[1:]
-                msg_lines.append(line)
-
-            msg, img_urls = process_msg_for_images(msg_lines)
+            img_urls = item.get("images", [])  # Extracted by `parse_lines()`
 
             if img_urls:
-                content = [{"type": "text", "text": msg}]
+                content = [{"type": "text", "text": item["text"]}]
             else:
-                content = msg
+                content = item["content"]
 
             for img_url in img_urls:
                 content_item = {"type": "image_url"}
@@ -592,55 +2682,812 @@ class Conversation:
                     content_item["image_url"] = {"url": img_url}
                     log.debug(f"Found 'data:<...>' URL")
                 else:
-                    # Need to load it relative to the file
+                    # Relative to the file. Encoded when the request is built
                     img_path = os.path.join(os.path.dirname(self.filepath), img_url)
-                    mime_type, _ = mimetypes.guess_type(img_path)
-                    with open(img_path, "rb") as fp:
-                        data = fp.read()
-                        img_data = base64.b64encode(data).decode("utf-8")
-                        content_item["image_url"] = {
-                            "url": f"data:{mime_type};base64,{img_data}"
-                        }
-                    log.debug(f"Found image {img_path!r}, {len(data)} bytes")
+                    content_item = LocalImage(img_path, image_options)
                 content.append(content_item)
 
             conversation.append({"role": FLAG2ROLE[flag.lower()], "content": content})
 
-        return merge_message_runs(conversation)
+        return merge_message_runs(conversation)
+
+    def rename_by_title(self):
+        """Rename the conversation file from its title when safe to do so."""
+        dirname = os.path.dirname(self.filepath)
+        ext = os.path.splitext(self.filepath)[1]
+
+        # Compute the new name without worrying about duplicates
+        title = self.first_line
+
+        if AUTO_TITLE in title:  # BEFORE cleaning it
+            log.warning(f"{AUTO_TITLE!r} in title. Not renaming!")
+            return
+
+        # Clean the current for possible "<name> (n).<ext>"
+        cleaned_filepath = clean_filepath(self.filepath)
+        cleaned_filename = os.path.basename(cleaned_filepath)
+        log.debug(f"{cleaned_filename = }")
+
+        # Create a filename from the title
+        title_based_filename = title2filename(title, ext=ext)
+        title_based_filepath = os.path.join(dirname, title_based_filename)
+        log.debug(f"{title_based_filename = }")
+        if cleaned_filename == title_based_filename:
+            log.debug("Already named by title. No action needed")
+            return
+
+        title_based_filepath = uniqueify_filepath(title_based_filepath)
+        shutil.move(self.filepath, title_based_filepath)
+        if CONFIG.TEXTLLM_USAGE_LEDGER:
+            record_rename(self.filepath, title_based_filepath)
+
+        log.info(f"Rename by title {self.filepath!r} --> {title_based_filepath!r}")
+        self.filepath = title_based_filepath
+
+
+loads = Conversation.loads
+
+
+def parse_lines(lines):
+    """Parse textllm Markdown from lines in a single pass.
+
+    This is `loads()` for any iterable of lines, such as an open file, so the
+    text never has to be held as one string. Each line is inspected once: role
+    markers start messages, escaped markers are unescaped, and standalone image
+    lines outside fenced code blocks are collected for `process_conversation()`.
+
+    Parameters
+    ----------
+    lines : iterable of str
+        Lines as read from a text file, each ending in "\n" except maybe the
+        last. Lines must only be split at "\n".
+
+    Returns
+    -------
+    dict
+        `title`, `settings`, `top` (the text before the first role marker), and
+        `conversation`, a list of `{"role", "content"}` dictionaries with
+        surrounding whitespace stripped. Messages with images also have `images`
+        (their URLs) and `text` (the content without the image lines).
+    """
+    top = []
+    conversation = []
+    role = None
+    for line in lines:
+        if line.startswith("---") and (match := CONVO_PATTERN.match(line)):
+            if role is not None:
+                _add_message(conversation, role, msg_lines, text_lines, images)
+            role = match.group(1)[4:-4].lower()
+            msg_lines, text_lines, images = [], [], []
+            started = in_code_block = False
+            line = line[match.end() :]
+        elif role is None:
+            top.append(line)
+            continue
+
+        if line.endswith("\n"):
+            line = line[:-1]
+        if not started:  # Strip leading whitespace from the message
+            if not line.strip():
+                continue
+            line = line.lstrip()
+            started = True
+
+        if line.startswith("\\---") and line.lower().startswith(ESCAPED_FLAGS):
+            line = line[1:]
+        msg_lines.append(line)
+
+        if "```" in line and line.lstrip().startswith("```"):
+            in_code_block = not in_code_block
+        elif (
+            not in_code_block
+            and line.startswith("![")
+            and (match := IMAGE_PATTERN.match(line))
+        ):
+            images.append((len(msg_lines) - 1, match.group(2)))
+            continue
+        text_lines.append(line)
+
+    if role is not None:
+        _add_message(conversation, role, msg_lines, text_lines, images)
+
+    top = "".join(top)
+    return {
+        "title": top.split("\n", 1)[0].strip().strip("#").strip(),
+        "settings": Conversation.read_settings(top),
+        "top": top,
+        "conversation": conversation,
+    }
+
+
+def _add_message(conversation, role, lines, text_lines, images):
+    """Strip trailing whitespace from a parsed message and add it if not empty."""
+    if not lines:
+        return
+    while not lines[-1].strip():  # Blank lines are in both lists
+        lines.pop()
+        text_lines.pop()
+    lines[-1] = lines[-1].rstrip()
+    if not images:
+        conversation.append({"role": role, "content": "\n".join(lines)})
+        return
+
+    if images[-1][0] != len(lines) - 1:  # Last line is text
+        text_lines[-1] = lines[-1]
+    conversation.append(
+        {
+            "role": role,
+            "content": "\n".join(lines),
+            "text": "\n".join(text_lines),
+            "images": [url for _, url in images],
+        }
+    )
+
+
+########################################
+############### Caching ################
+########################################
+class DiskCache:
+    """File-per-key cache in a namespace under `$TEXTLLM_CACHE_DIR`.
+
+    Caches only ever hold derived data. Failing to read or write them is logged
+    and otherwise ignored.
+
+    Parameters
+    ----------
+    name : str
+        Subdirectory (namespace) of the cache directory.
+    max_bytes : int, optional
+        Size cap for the namespace. When a write exceeds it, the least recently
+        used entries are evicted.
+    """
+
+    def __init__(self, name, *, max_bytes=None):
+        self.root = Path(CONFIG.TEXTLLM_CACHE_DIR) / name
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return self.root / key[:2] / key
+
+    def get(self, key):
+        """Return the cached bytes for `key` or None."""
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        if self.max_bytes is not None:
+            try:
+                os.utime(path)  # Mark as recently used
+            except OSError:
+                pass
+        return data
+
+    def put(self, key, data):
+        """Atomically store `data` (bytes) under `key`."""
+        path = self.path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Unique per thread too; threads may store the same content at once
+            tmp = path.with_name(
+                f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        except OSError as E:
+            log.debug(f"Could not write cache {path}: {E}")
+            return
+        if self.max_bytes is not None:
+            self.evict()
+
+    def delete(self, key):
+        try:
+            self.path(key).unlink()
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove least recently used entries until under `max_bytes`."""
+        entries = []
+        for path in self.root.glob("*/*"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            log.debug(f"Evicted cache entry {path}")
+
+
+def _sha256(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def _last_marker_offset(text, start=0):
+    """Offset of the last role marker at or after `start`, or None."""
+    offset = None
+    for match in CONVO_PATTERN.finditer(text, start):
+        offset = match.start()
+    return offset
+
+
+def cached_loads(filepath, text):
+    """Like `loads()` but only parse what was appended since the last call.
+
+    The parsed messages *before* the last role marker are kept in memory with
+    the offset and hash of that prefix, so this only helps programs that load
+    the same file repeatedly, such as editor integrations using textllm as a
+    library. If the prefix of `text`
+    still matches, only the tail starting at that marker is parsed. Any edit to
+    the prefix invalidates the entry, so the file remains the source of truth.
+    Entries are bounded by `PARSE_MEMO_MB` of prefix text.
+
+    Parameters
+    ----------
+    filepath : str or path-like
+        Conversation path. Used only as the cache key.
+    text : str
+        Full (stripped) conversation text.
+
+    Returns
+    -------
+    dict
+        Same as `loads(text)`.
+    """
+    key = os.path.abspath(filepath)
+
+    start = 0
+    entry = _PARSE_MEMO.get(key)
+    if (
+        entry
+        and len(text) >= entry["offset"]
+        and _sha256(text[: entry["offset"]]) == entry["sha256"]
+    ):
+        start = entry["offset"]
+        tail = loads(text[start:])
+        parsed = {k: entry[k] for k in ("title", "settings", "top")}
+        parsed["conversation"] = entry["conversation"] + tail["conversation"]
+        log.debug(f"Parse cache hit. Parsed {len(text) - start} of {len(text)} chars")
+    else:
+        parsed = loads(text)
+        log.debug("Parse cache miss")
+
+    offset = _last_marker_offset(text, start)
+    if offset is None or offset == start:
+        return parsed  # Nothing new to cache
+
+    # The last block may still grow. Cache everything before it.
+    nlast = len(loads(text[offset:])["conversation"])
+    conversation = parsed["conversation"]
+    entry = parsed | dict(
+        offset=offset,
+        sha256=_sha256(text[:offset]),
+        conversation=conversation[: len(conversation) - nlast],
+    )
+    _PARSE_MEMO.put(key, entry, size=offset)
+    return parsed
+
+
+@dataclass(frozen=True)
+class ImageOptions:
+    """Optional resizing and re-encoding of local images before upload.
+
+    Built from the `textllm_image_max_edge`, `textllm_image_format`, and
+    `textllm_image_quality` settings. Requires Pillow when enabled.
+    """
+
+    max_edge: int | None = None
+    format: str | None = None
+    quality: int = 85
+
+    @classmethod
+    def from_settings(cls, settings):
+        _, options = split_settings(settings)
+        return cls(
+            max_edge=options.get("textllm_image_max_edge"),
+            format=options.get("textllm_image_format"),
+            quality=options.get("textllm_image_quality", cls.quality),
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.max_edge or self.format)
+
+
+def image_data_url(img_path, options=ImageOptions(), *, remember=True):
+    """Read a local image and return it as a base64 `data:` URL.
+
+    Recent images (up to `IMAGE_MEMO_MB` of URLs) are kept, so repeated
+    references within a process are usually encoded once. With
+    `$TEXTLLM_IMAGE_CACHE` set, encoded URLs are also kept in a content-addressed
+    disk cache keyed by path, size, modification time, and `options`.
+
+    Parameters
+    ----------
+    img_path : str or path-like
+        Image file path.
+    options : ImageOptions, optional
+        Resizing and re-encoding to apply before encoding.
+    remember : bool, optional
+        Keep the URL in the in-process cache of recent images. Pass False to
+        not keep large URLs alive after use.
+
+    Returns
+    -------
+    str
+        `data:<mime>;base64,...` URL.
+    """
+    stat = os.stat(img_path)
+    mime_type, _ = mimetypes.guess_type(img_path)
+    key = (os.path.realpath(img_path), stat.st_size, stat.st_mtime_ns, mime_type)
+    key += (options,)
+    log.debug(f"Found image {str(img_path)!r}, {stat.st_size} bytes")
+    if remember and (url := _IMAGE_MEMO.get(key)):
+        return url
+    url = _encoded_image(*key)
+    if remember:
+        _IMAGE_MEMO.put(key, url)
+    return url
+
+
+class _SizedLRU:
+    """Thread-safe least-recently-used cache bounded by the total length of
+    its values rather than their number. `put()` can give a size for values
+    that are not strings.
+
+    Parameters
+    ----------
+    max_chars : int
+        Total length to keep. Longer values are not kept at all.
+    """
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.chars = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        with self.lock:
+            if (value := self.items.get(key)) is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value, *, size=None):
+        """Keep `value`, counted as `size` characters (default `len(value)`)."""
+        size = len(value) if size is None else size
+        if size > self.max_chars:
+            return
+        with self.lock:
+            if key in self.items:
+                self.chars -= self.sizes.pop(key)
+                del self.items[key]
+            self.items[key] = value
+            self.sizes[key] = size
+            self.chars += size
+            while self.chars > self.max_chars:
+                old, _ = self.items.popitem(last=False)
+                self.chars -= self.sizes.pop(old)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.chars = 0
+
+
+# Recent data URLs. Bounded by size so `textllm serve` and `textllm batch` do not
+# keep hundreds of MB of images alive; the disk cache holds more.
+_IMAGE_MEMO = _SizedLRU(IMAGE_MEMO_MB * 1024 * 1024)
+
+# Parsed conversation prefixes for `cached_loads()`, bounded by prefix length
+_PARSE_MEMO = _SizedLRU(PARSE_MEMO_MB * 1024 * 1024)
+
+
+def _encoded_image(realpath, size, mtime_ns, mime_type, options):
+    # Arguments are the cache key. `size` and `mtime_ns` are otherwise unused.
+    use_cache = CONFIG.TEXTLLM_IMAGE_CACHE
+    if use_cache is None:
+        use_cache = options.enabled  # Pillow work is worth keeping across runs
+    if not use_cache:
+        return _encode_image(realpath, mime_type, options)
+
+    cache = DiskCache(
+        "images",
+        max_bytes=int(CONFIG.TEXTLLM_IMAGE_CACHE_MB * 1024 * 1024),
+    )
+    index_key = _sha256(f"{realpath}\0{size}\0{mtime_ns}\0{mime_type}\0{options}")
+    if (blob_key := cache.get(index_key)) and (data := cache.get(blob_key.decode())):
+        if _sha256(data) == blob_key.decode():
+            log.debug(f"Image cache hit for {realpath!r}")
+            return data.decode("utf-8")
+        log.debug(f"Image cache entry for {realpath!r} failed verification")
+        cache.delete(blob_key.decode())
+
+    url = _encode_image(realpath, mime_type, options)
+    data = url.encode("utf-8")
+    blob_key = _sha256(data)
+    cache.put(blob_key, data)
+    cache.put(index_key, blob_key.encode())
+    return url
+
+
+def _encode_image(path, mime_type, options):
+    with open(path, "rb") as fp:
+        if options.enabled:
+            data, mime_type = _shrink_image(fp.read(), mime_type, options)
+            img_data = base64.b64encode(data)
+        elif os.fstat(fp.fileno()).st_size:
+            # Encode from a memory map so the raw bytes are not copied to the heap
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                img_data = base64.b64encode(data)
+        else:
+            img_data = b""  # Empty files cannot be mapped
+    return f"data:{mime_type};base64,{img_data.decode('utf-8')}"
+
+
+class LocalImage(dict):
+    """An `image_url` content block for a local image, encoded by `resolve()`.
+
+    Until resolved the block only holds the path, so messages do not keep the
+    (large) data URL and nothing is read until a request is built. See
+    `resolve_images()`.
+    """
+
+    def __init__(self, path, options=ImageOptions()):
+        super().__init__(type="image_url")
+        self.path = path
+        self.options = options
+
+    def check(self):
+        """Raise FileNotFoundError if the image file does not exist."""
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f"Image file not found: {self.path!r}")
+
+    def resolve(self, *, remember=True):
+        """Return the equivalent `image_url` block with a data URL."""
+        url = image_data_url(self.path, self.options, remember=remember)
+        return {"type": "image_url", "image_url": {"url": url}}
+
+
+def resolve_images(messages, *, remember=True, workers=IMAGE_WORKERS):
+    """Replace `LocalImage` blocks with encoded `image_url` blocks.
+
+    Messages without them are returned as is, so this is cheap when there are
+    none. Distinct images that are resized or re-encoded (`ImageOptions`) are
+    processed on a thread pool no larger than the CPU count, since Pillow
+    releases the GIL. Others are encoded in turn: base64 encoding holds the
+    GIL and a pool only added overhead. The input is not modified and the
+    order of blocks is kept.
+
+    Parameters
+    ----------
+    messages : list
+        OpenAI-style message dictionaries.
+    remember : bool, optional
+        Passed to `image_data_url()`. Repeated images are encoded once either
+        way.
+    workers : int, optional
+        Maximum number of resized images processed at once. 1 processes them
+        in order on the calling thread.
+
+    Returns
+    -------
+    list
+        Messages ready to send.
+    """
+    pending = {}
+    for message in messages:
+        if isinstance(message["content"], list):
+            for block in message["content"]:
+                if isinstance(block, LocalImage):
+                    pending.setdefault((block.path, block.options), block)
+
+    if not pending:
+        return list(messages)
+
+    def resolve(block):
+        return block.resolve(remember=remember)
+
+    urls = {}
+    with _phase("images"):
+        # Only Pillow releases the GIL for long enough to gain from threads
+        shrink = [key for key, block in pending.items() if block.options.enabled]
+        workers = min(workers, len(shrink), os.cpu_count() or 1)
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                blocks = pool.map(resolve, (pending[key] for key in shrink))
+                urls.update(zip(shrink, blocks))
+        for key, block in pending.items():
+            if key not in urls:
+                urls[key] = resolve(block)
+
+    resolved = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list) and any(
+            isinstance(block, LocalImage) for block in content
+        ):
+            content = [
+                urls[block.path, block.options]
+                if isinstance(block, LocalImage)
+                else block
+                for block in content
+            ]
+            message = message | {"content": content}
+        resolved.append(message)
+    return resolved
+
+
+def _shrink_image(data, mime_type, options):
+    """Downscale and/or re-encode image bytes per `options`.
+
+    Returns
+    -------
+    tuple
+        `(data, mime_type)`. The original is kept if processing would not
+        resize, convert, or shrink it.
+    """
+    try:
+        from PIL import Image, ImageOps  # pip install pillow
+    except ImportError as E:
+        raise ImportError(
+            "textllm_image_* settings require Pillow. Install with "
+            "'pip install textllm[images]'"
+        ) from E
+
+    with Image.open(io.BytesIO(data)) as img:
+        source_format = img.format
+        target_format = (options.format or source_format or "PNG").upper()
+        target_format = {"JPG": "JPEG"}.get(target_format, target_format)
+
+        # Apply the EXIF orientation (phone photos) since it is not kept
+        rotated = img.getexif().get(ORIENTATION_TAG, 1) != 1
+        if rotated:
+            img = ImageOps.exif_transpose(img)
+        resized = bool(options.max_edge) and max(img.size) > options.max_edge
+        if resized:
+            img.thumbnail((options.max_edge, options.max_edge))
+        if target_format == "JPEG" and img.mode not in {"RGB", "L"}:
+            # Flatten onto white. A plain convert("RGB") makes transparency black
+            img = img.convert("RGBA")
+            flat = Image.new("RGB", img.size, (255, 255, 255))
+            flat.paste(img, mask=img.getchannel("A"))
+            img = flat
+
+        buffer = io.BytesIO()
+        save_kwargs = {}
+        if target_format in {"JPEG", "WEBP"}:
+            save_kwargs["quality"] = options.quality
+        img.save(buffer, format=target_format, **save_kwargs)
+
+    new = buffer.getvalue()
+    if (
+        not resized
+        and not rotated
+        and target_format == source_format
+        and len(new) >= len(data)
+    ):
+        log.debug("Re-encoding did not shrink image. Keeping original")
+        return data, mime_type
+
+    log.debug(
+        f"Image {len(data)} -> {len(new)} bytes as {target_format} "
+        f"({len(data) - len(new)} bytes saved)"
+    )
+    return new, Image.MIME.get(target_format, mime_type)
+
+
+def externalize_images(filepath, *, directory=IMAGE_DIR_NAME):
+    """Move embedded `data:` URL images into sidecar files.
+
+    Standalone image lines in messages with a base64 `data:` URL are replaced
+    by a relative link to `<directory>/<sha256><ext>` next to the conversation,
+    so parsing and rewriting the file no longer handles the encoded bytes. The
+    file is streamed line by line and only rewritten if something moved.
+
+    An image is only moved if sending it again as a local file gives the same
+    `data:` URL: the MIME type must be what the new file extension maps back to
+    and the base64 must be canonical. Otherwise, or when the conversation
+    resizes local images (`textllm_image_max_edge` or `textllm_image_format`),
+    it is left in place.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        Conversation file.
+    directory : str, optional
+        Directory for the images, relative to the conversation file.
+
+    Returns
+    -------
+    int
+        Number of images moved.
+    """
+    filepath = Path(filepath)
+    image_dir = filepath.parent / directory  # Links are relative to the file read
+    # Rewrite the target of a symlinked conversation rather than the link itself
+    target = Path(os.path.realpath(filepath))
+    tmp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    top = []
+    count = 0
+    in_message = started = in_code_block = False
+    try:
+        # newline="" so lines that are not changed are written back exactly
+        with open(filepath, "rt", newline="") as src, open(
+            tmp, "wt", newline=""
+        ) as dst:
+            for line in src:
+                head = ""
+                if line.startswith("---") and (match := CONVO_PATTERN.match(line)):
+                    if not in_message:
+                        settings = Conversation.read_settings(CONFIG.TEMPLATE)
+                        settings |= Conversation.read_settings("".join(top))
+                        if ImageOptions.from_settings(settings).enabled:
+                            log.warning(
+                                f"{str(filepath)!r} resizes local images. "
+                                "Not externalizing"
+                            )
+                            return 0
+                    in_message = True
+                    started = in_code_block = False
+                    head, line = line[: match.end()], line[match.end() :]
+                elif not in_message:
+                    top.append(line)
+
+                # Mirrors `parse_lines()` so only lines it reads as images change
+                if in_message and (started or line.strip()):
+                    if not started:
+                        body = line.lstrip()
+                        head, line = head + line[: len(line) - len(body)], body
+                        started = True
+                    if "```" in line and line.lstrip().startswith("```"):
+                        in_code_block = not in_code_block
+                    elif (
+                        not in_code_block
+                        and line.startswith("![")
+                        and (match := IMAGE_PATTERN.match(line))
+                        and (name := _externalize_image(match.group(2), image_dir))
+                    ):
+                        link = f"{directory}/{name}"
+                        line = line[: match.start(2)] + link + line[match.end(2) :]
+                        count += 1
+                dst.write(head + line)
+
+        if count:
+            shutil.copymode(target, tmp)
+            os.replace(tmp, target)
+            log.info(f"Moved {count} image(s) from {str(filepath)!r} to {directory!r}")
+        return count
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _externalize_image(url, image_dir):
+    """Write a `data:` URL image to `image_dir` and return its file name.
+
+    Returns None, leaving the image embedded, if it is not a base64 `data:` URL
+    that `image_data_url()` would reproduce exactly from the file.
+    """
+    if not (match := DATA_URL_PATTERN.match(url)):
+        return None
+    mime_type, payload = match.group(1), url[match.end() :]
+    ext = mimetypes.guess_extension(mime_type)
+    if not ext or mimetypes.guess_type(f"image{ext}")[0] != mime_type:
+        log.warning(f"No file type for {mime_type!r}. Keeping the image inline")
+        return None
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except ValueError:
+        log.warning(f"Invalid base64 {mime_type!r} image. Keeping it inline")
+        return None
+    if base64.b64encode(data).decode("ascii") != payload:
+        log.warning(f"Non-canonical base64 {mime_type!r} image. Keeping it inline")
+        return None
+
+    name = _sha256(data) + ext
+    path = image_dir / name
+    if not path.exists():  # Content-addressed, so an existing file is the same
+        image_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{name}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    return name
+
+
+RESPONSE_CACHE_STATS = Counter()  # "hit", "miss", "expired", and "store" counts
+_RESPONSE_CACHE_STATS_LOCK = threading.Lock()  # `textllm batch` runs threads
 
-    def rename_by_title(self):
-        """Rename the conversation file from its title when safe to do so."""
-        dirname = os.path.dirname(self.filepath)
-        ext = os.path.splitext(self.filepath)[1]
 
-        # Compute the new name without worrying about duplicates
-        title, *_ = self.text.split("\n", 1)
+def _count_response_cache(*events):
+    with _RESPONSE_CACHE_STATS_LOCK:
+        RESPONSE_CACHE_STATS.update(events)
 
-        if AUTO_TITLE in title:  # BEFORE cleaning it
-            log.warning(f"{AUTO_TITLE!r} in title. Not renaming!")
-            return
 
-        # Clean the current for possible "<name> (n).<ext>"
-        cleaned_filepath = clean_filepath(self.filepath)
-        cleaned_filename = os.path.basename(cleaned_filepath)
-        log.debug(f"{cleaned_filename = }")
+class ResponseCache:
+    """On-disk cache of complete model responses.
 
-        # Create a filename from the title
-        title_based_filename = title2filename(title, ext=ext)
-        title_based_filepath = os.path.join(dirname, title_based_filename)
-        log.debug(f"{title_based_filename = }")
-        if cleaned_filename == title_based_filename:
-            log.debug("Already named by title. No action needed")
-            return
+    Entries are keyed on a canonical hash of the model, the messages as sent,
+    and the pass-through settings, so any change to the request is a miss.
+    `textllm_*` settings are not part of the key. Configured by
+    `$TEXTLLM_RESPONSE_CACHE_TTL` (hours, 0 for no expiry) and
+    `$TEXTLLM_RESPONSE_CACHE_MB` (size cap with LRU eviction).
+    """
 
-        title_based_filepath = uniqueify_filepath(title_based_filepath)
-        shutil.move(self.filepath, title_based_filepath)
+    def __init__(self):
+        self.disk = DiskCache(
+            "responses", max_bytes=CONFIG.TEXTLLM_RESPONSE_CACHE_MB * 1024 * 1024
+        )
+        self.ttl = CONFIG.TEXTLLM_RESPONSE_CACHE_TTL * 3600
 
-        log.info(f"Rename by title {self.filepath!r} --> {title_based_filepath!r}")
-        self.filepath = title_based_filepath
+    @staticmethod
+    def key(model, messages, settings):
+        passthrough, _ = split_settings(settings)
+        request = {"model": model, "messages": messages, "settings": passthrough}
+        return _sha256(json.dumps(request, sort_keys=True, default=str))
+
+    def get(self, key):
+        """Return the cached `LLMResponse` for `key` or None."""
+        data = self.disk.get(key)
+        try:
+            entry = json.loads(data)
+        except (TypeError, ValueError):  # Missing (None) or corrupt
+            _count_response_cache("miss")
+            log.debug(f"Response cache miss {key[:12]}")
+            return None
+
+        if self.ttl and time.time() - entry["created"] > self.ttl:
+            _count_response_cache("expired", "miss")
+            log.debug(f"Response cache entry {key[:12]} expired")
+            self.disk.delete(key)
+            return None
+
+        _count_response_cache("hit")
+        log.info(f"Response cache hit {key[:12]}. The model was not called")
+        return LLMResponse(content=entry["content"], usage_metadata=entry["usage"])
+
+    def put(self, key, response):
+        entry = {
+            "created": time.time(),
+            "content": response.content,
+            "usage": _jsonable_usage(response.usage_metadata),
+        }
+        self.disk.put(key, json.dumps(entry).encode("utf-8"))
+        _count_response_cache("store")
+        log.debug(f"Stored response cache entry {key[:12]}")
+
+
+def _iter_cached_chunks(response, size=64):
+    """Replay a cached response as `(text, usage)` stream chunks."""
+    text = response.content
+    for start in range(0, len(text), size):
+        yield text[start : start + size], None
+    yield "", response.usage_metadata
+
+
+async def _aiter_cached_chunks(response):
+    for item in _iter_cached_chunks(response):
+        yield item
 
 
-loads = Conversation.loads
+########################################
+############# END Caching ##############
+########################################
 
 
 def file_edit(filepath, *, prompt, editor):
@@ -695,183 +3542,605 @@ def file_edit(filepath, *, prompt, editor):
     return True
 
 
-def process_msg_for_images(lines):
-    """Separate Markdown image references from message text.
+def process_msg_for_images(lines):
+    """Separate Markdown image references from message text.
+
+    Parameters
+    ----------
+    lines : list of str
+        Message lines to inspect.
+
+    Returns
+    -------
+    tuple
+        `(text, image_urls)` where `text` excludes standalone Markdown image
+        lines outside fenced code blocks.
+    """
+    in_code_block = False
+    final_lines = []
+    image_urls = []
+
+    for line in lines:
+        # Check for start or end of a fenced code block
+        if line.strip().startswith("```"):
+            in_code_block = not in_code_block
+            final_lines.append(line)
+            continue
+
+        # If inside a code block, just keep the line
+        if in_code_block:
+            final_lines.append(line)
+            continue
+
+        # If not inside a code block, check for images
+        match = IMAGE_PATTERN.match(line)
+        if match:
+            # Capture the URL from the image line
+            url = match.group(2)
+            image_urls.append(url)
+        else:
+            # Keep lines that are not image lines
+            final_lines.append(line)
+
+    # Return the processed text and list of image URLs
+    return "\n".join(final_lines), image_urls
+
+
+########################################
+############ Filename Utils ############
+########################################
+def clean_filepath(filepath):
+    """Remove a numeric duplicate suffix from a path.
+
+    Parameters
+    ----------
+    filepath : str or path-like
+        Path that may end with a duplicate suffix like ` (1)`.
+
+    Returns
+    -------
+    str
+        Path with the duplicate suffix removed before the extension.
+    """
+    base, ext = os.path.splitext(filepath)
+    cleaned_filepath = re.sub(r" \(\d+\)$", "", base) + ext
+    return cleaned_filepath
+
+
+def title2filename(title, ext=".md"):
+    """Convert a Markdown title to a filesystem-safe filename.
+
+    Parameters
+    ----------
+    title : str
+        Conversation title, with or without a leading Markdown heading marker.
+    ext : str, optional
+        Extension to append to the filename.
+
+    Returns
+    -------
+    str
+        Sanitized filename.
+    """
+    invalid_chars = set(
+        "\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\x0c\r\x0e\x0f\x10\x11\x12\x13"
+        '\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f"*/:<>?\\|'
+    )
+    title = title.strip().strip("#").strip()
+    title = "".join(c for c in title if c not in invalid_chars)
+    title = title[: (MAX_FILENAME_CHAR - len(ext))]
+    title = title + ext
+    return title
+
+
+def uniqueify_filepath(filepath):
+    """Return a non-existing path by adding a numeric suffix when needed.
+
+    Parameters
+    ----------
+    filepath : str or path-like
+        Desired path.
+
+    Returns
+    -------
+    str
+        `filepath`, or a suffixed variant, that does not already exist.
+
+    Raises
+    ------
+    ValueError
+        If no unique path is found within 99 suffix attempts.
+    """
+    filepath0 = filepath
+    dirname, filename = os.path.split(filepath)
+    base, ext = os.path.splitext(filename)
+
+    c = 0
+    while os.path.exists(filepath):
+        c += 1
+        if c >= 100:
+            raise ValueError(f"Too many for {filepath0!r}")
+
+        new = f"{base} ({c}){ext}"
+        filepath = os.path.join(dirname, new)
+    log.debug(f"{filepath0!r} required {c} iterations for unique name: {filepath!r}")
+    return filepath
+
+
+########################################
+########## END Filename Utils ##########
+########################################
+
+
+def grouper(iterable, n, *, fillvalue=None):
+    """Collect data into fixed-length chunks.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Values to group.
+    n : int
+        Chunk size.
+    fillvalue : object, optional
+        Value used to pad the last chunk.
+
+    Returns
+    -------
+    iterator
+        Iterator of `n`-tuples.
+    """
+    iterators = [iter(iterable)] * n
+    return itertools.zip_longest(*iterators, fillvalue="")
+
+
+class NoUserMessageError(ValueError):
+    """Error when a conversation does not end with a user message."""
+
+
+NoHumanMessageError = NoUserMessageError
+
+
+def _setup_logging(verbosity, *, logfile=None):
+    """Configure the textllm logger for a command and return the console level.
+
+    Parameters
+    ----------
+    verbosity : int
+        Net `-v` minus `-q` count.
+    logfile : str, optional
+        Conversation path used to name the test-mode debug log.
+    """
+    # Define logging levels
+    levels = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
+    level_index = verbosity + 2  # +1: WARNING, +2: INFO
+    level_index = max(0, min(level_index, len(levels) - 1))  # Always keep ERROR
+
+    log.setLevel(logging.DEBUG)  # Highest. Handler will set lower
+    fmt = logging.Formatter(
+        "%(asctime)s:%(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(fmt)
+    console_handler.setLevel(levels[level_index])
+
+    log.handlers.clear()
+    log.addHandler(console_handler)
+    if _test_mode_enabled():
+        logfile = f"{logfile}.log" if logfile else "log"
+        try:
+            os.makedirs(os.path.dirname(logfile))
+        except OSError:
+            pass
+        file_handler = logging.FileHandler(logfile, mode="w")
+        file_handler.setFormatter(fmt)
+        file_handler.setLevel(logging.DEBUG)
+        log.addHandler(file_handler)
+
+    return levels[level_index]
+
+
+def _load_environment(env=None):
+    """Load environment files in textllm's documented order.
+
+    Parameters
+    ----------
+    env : str, optional
+        Additional environment file from `--env`. Loaded last.
+    """
+    # Load the environment. Can be in three possible places (a,b,c below)
+    if CONFIG.TEXTLLM_ENV_PATH:  # (a) Specified environment variable with the path
+        if load_dotenv(CONFIG.TEXTLLM_ENV_PATH, override=True):
+            log.debug(f"Loaded env from ${CONFIG.TEXTLLM_ENV_PATH = }")
+        else:
+            log.info(f"Could not load env from specified ${CONFIG.TEXTLLM_ENV_PATH = }")
+    if load_dotenv(override=True):  # (b) a .env file
+        log.debug(f"Loaded env from a found '.env' file")
+    if env:  # (c) specified --env at the command line
+        if load_dotenv(env, override=True):
+            log.debug(f"Loaded env from args {env!r}")
+        else:
+            log.info(f"env file {env!r} not loaded or found")
+
+
+def serve_cli(argv):
+    """Run `textllm serve`.
+
+    Parameters
+    ----------
+    argv : list of str
+        Arguments after the `serve` command.
+    """
+    parser = argparse.ArgumentParser(
+        prog="textllm serve",
+        description="""
+            Run a long-lived worker that keeps LiteLLM imported. textllm calls
+            forward their model request to it when it is running and fall back to
+            in-process calls otherwise.
+            """,
+    )
+    parser.add_argument(
+        "--socket",
+        default=CONFIG.TEXTLLM_SOCKET,
+        help="[%(default)s] Unix socket to listen on. Defaults to $TEXTLLM_SOCKET",
+    )
+    parser.add_argument(
+        "--env",
+        help="""
+            Specify an additional environment file to load. The worker uses its own
+            environment, including API keys, for every forwarded request.""",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="count", default=0, help="Decrease Verbosity"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Increase Verbosity"
+    )
+    args = parser.parse_args(argv)
+
+    _setup_logging(args.verbose - args.quiet, logfile=args.socket)
+    _load_environment(args.env)
+    serve(args.socket)
+
+
+def find_conversations(patterns):
+    """Expand directories and glob patterns into conversation file paths.
 
     Parameters
     ----------
-    lines : list of str
-        Message lines to inspect.
+    patterns : list of str
+        Directories (their `*.md` files are used), glob patterns (`**` is
+        recursive), or file paths.
 
     Returns
     -------
-    tuple
-        `(text, image_urls)` where `text` excludes standalone Markdown image
-        lines outside fenced code blocks.
+    list of str
+        Sorted, de-duplicated file paths.
     """
-    # Regex to capture markdown images
-    image_regex = re.compile(
-        r"""
-        ^               # Start of a line
-        !\[             # Literal '![', start of markdown image
-        (.*?)           # Non-greedy capture for the alt text (optional)
-        \]              # Literal closing bracket
-        \(\s*           # Literal '(', start of URL, allowing optional whitespace
-        (.*?)           # Non-greedy capture for the URL
-        \s*             # Allow optional whitespace
-        (?:             # Non-capturing group for optional title
-            "           # Opening quote for title
-            (.*?)       # Non-greedy capture for the title text
-            "           # Closing quote for title
-        )?              # Title is optional
-        \)              # Literal closing parenthesis
-        \s*$            # Allow optional whitespace till the end of the line
-        """,
-        re.VERBOSE,
-    )
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.update(str(path) for path in Path(pattern).glob("*.md"))
+        else:
+            paths.update(glob.glob(pattern, recursive=True))
+    return sorted(path for path in paths if os.path.isfile(path))
 
-    in_code_block = False
-    final_lines = []
-    image_urls = []
 
-    for line in lines:
-        # Check for start or end of a fenced code block
-        if line.strip().startswith("```"):
-            in_code_block = not in_code_block
-            final_lines.append(line)
-            continue
+@dataclass
+class BatchResult:
+    """Outcome of one file in `textllm batch`."""
 
-        # If inside a code block, just keep the line
-        if in_code_block:
-            final_lines.append(line)
-            continue
+    path: str
+    status: str  # "ok", "error", "skipped", or "done" (from the journal)
+    seconds: float = 0.0
+    chars: int = 0
+    error: str | None = None
 
-        # If not inside a code block, check for images
-        match = image_regex.match(line)
-        if match:
-            # Capture the URL from the image line
-            url = match.group(2)
-            image_urls.append(url)
-        else:
-            # Keep lines that are not image lines
-            final_lines.append(line)
 
-    # Return the processed text and list of image URLs
-    return "\n".join(final_lines), image_urls
+def _batch_chat(path, *, title):
+    t0 = time.perf_counter()
+    try:
+        if CONFIG.TEXTLLM_EXTERNALIZE_IMAGES:
+            externalize_images(path)
+        convo = Conversation(path)
+        if not convo.messages or convo.messages[-1]["role"] != "user":
+            return BatchResult(path, "skipped")
+        response = convo.chat(print_stream=False, set_title=title)
+    except Exception as E:
+        log.debug(f"{path!r} failed", exc_info=True)
+        return BatchResult(path, "error", time.perf_counter() - t0, error=str(E))
+    return BatchResult(path, "ok", time.perf_counter() - t0, len(response.content))
 
 
-########################################
-############ Filename Utils ############
-########################################
-def clean_filepath(filepath):
-    """Remove a numeric duplicate suffix from a path.
+def run_batch(paths, *, jobs=4, journal=None, title=True):
+    """Chat every conversation in `paths` that ends with a user message.
+
+    Files are run concurrently on a thread pool of `jobs` workers. Each
+    response is appended to its own file exactly as `Conversation.chat()`
+    does. Completed files are recorded in the optional JSON-lines `journal` with
+    a hash of their new contents, so rerunning a crashed batch skips files that
+    are unchanged since they completed.
 
     Parameters
     ----------
-    filepath : str or path-like
-        Path that may end with a duplicate suffix like ` (1)`.
+    paths : list of str
+        Conversation files.
+    jobs : int, optional
+        Maximum number of concurrent model calls.
+    journal : str or path-like, optional
+        Journal file to resume from and append to.
+    title : bool, optional
+        Whether to replace `!!AUTO TITLE!!` before chatting.
 
     Returns
     -------
-    str
-        Path with the duplicate suffix removed before the extension.
+    list of BatchResult
+        Results in completion order.
     """
-    base, ext = os.path.splitext(filepath)
-    cleaned_filepath = re.sub(r" \(\d+\)$", "", base) + ext
-    return cleaned_filepath
+    done = {}
+    if journal and os.path.exists(journal):
+        with open(journal, "rt") as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Partial line from a crash
+                if entry.get("status") == "ok":
+                    done[entry["path"]] = entry["sha256"]
+
+    results = []
+    pending = []
+    for path in paths:
+        sha256 = done.get(os.path.abspath(path))
+        if sha256 and sha256 == _sha256(Path(path).read_bytes()):
+            results.append(BatchResult(path, "done"))
+        else:
+            pending.append(path)
 
+    lock = threading.Lock()
 
-def title2filename(title, ext=".md"):
-    """Convert a Markdown title to a filesystem-safe filename.
+    def record(result):
+        print(
+            f"{result.status:<7} {result.path} ({result.seconds:.1f}s)"
+            + (f": {result.error}" if result.error else ""),
+            flush=True,
+        )
+        if not journal or result.status == "done":
+            return
+        entry = dict(
+            path=os.path.abspath(result.path),
+            status=result.status,
+            seconds=round(result.seconds, 3),
+            time=datetime.now().astimezone().isoformat(),
+            error=result.error,
+        )
+        if result.status == "ok":
+            entry["sha256"] = _sha256(Path(result.path).read_bytes())
+        with open(journal, "at") as fp:
+            fp.write(json.dumps(entry) + "\n")
+
+    for result in results:
+        record(result)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [pool.submit(_batch_chat, path, title=title) for path in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            with lock:
+                record(result)
+                results.append(result)
+
+    return results
+
+
+def batch_cli(argv):
+    """Run `textllm batch`.
 
     Parameters
     ----------
-    title : str
-        Conversation title, with or without a leading Markdown heading marker.
-    ext : str, optional
-        Extension to append to the filename.
-
-    Returns
-    -------
-    str
-        Sanitized filename.
+    argv : list of str
+        Arguments after the `batch` command.
     """
-    invalid_chars = set(
-        "\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\x0c\r\x0e\x0f\x10\x11\x12\x13"
-        '\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f"*/:<>?\\|'
+    parser = argparse.ArgumentParser(
+        prog="textllm batch",
+        description="""
+            Chat every conversation file that ends with a user message, several at a
+            time. Each response is appended to its own file. Responses are not
+            printed; a status line is printed per file.
+            """,
     )
-    title = title.strip().strip("#").strip()
-    title = "".join(c for c in title if c not in invalid_chars)
-    title = title[: (MAX_FILENAME_CHAR - len(ext))]
-    title = title + ext
-    return title
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        metavar="dir-or-glob",
+        help="""
+            Directories (their *.md files), glob patterns (quote them; '**' is
+            recursive), or files.""",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="[%(default)s] Maximum number of concurrent model calls",
+    )
+    parser.add_argument(
+        "--journal",
+        default=".textllm-batch.jsonl",
+        help="""
+            [%(default)s] JSON-lines journal of completed files. Rerunning with the
+            same journal skips files unchanged since they completed.""",
+    )
+    parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="Do not read or write a journal",
+    )
+    parser.add_argument(
+        "--title",
+        choices=["auto", "off"],
+        default="auto",
+        help=f"[%(default)s] Whether to replace {AUTO_TITLE!r} before chatting",
+    )
+    parser.add_argument("--env", help="Additional environment file to load")
+    parser.add_argument(
+        "-q", "--quiet", action="count", default=0, help="Decrease Verbosity"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Increase Verbosity"
+    )
+    args = parser.parse_args(argv)
 
+    _setup_logging(args.verbose - args.quiet - 1)  # Status lines replace INFO logs
+    _load_environment(args.env)
 
-def uniqueify_filepath(filepath):
-    """Return a non-existing path by adding a numeric suffix when needed.
+    paths = find_conversations(args.paths)
+    log.info(f"Found {len(paths)} files")
 
-    Parameters
-    ----------
-    filepath : str or path-like
-        Desired path.
+    t0 = time.perf_counter()
+    results = run_batch(
+        paths,
+        jobs=args.jobs,
+        journal=None if args.no_journal else args.journal,
+        title=args.title == "auto",
+    )
+    elapsed = max(time.perf_counter() - t0, 1e-6)
+
+    counts = {
+        status: sum(result.status == status for result in results)
+        for status in ["ok", "error", "skipped", "done"]
+    }
+    chars = sum(result.chars for result in results)
+    print(
+        f"{counts['ok']} ok, {counts['error']} failed, {counts['skipped']} skipped, "
+        f"{counts['done']} already done in {elapsed:.1f}s "
+        f"({counts['ok'] / elapsed:.2f} files/s, {chars / elapsed:.0f} chars/s)"
+    )
+    if RESPONSE_CACHE_STATS:
+        print(
+            f"Response cache: {RESPONSE_CACHE_STATS['hit']} hits, "
+            f"{RESPONSE_CACHE_STATS['miss']} misses"
+        )
+    if counts["error"]:
+        sys.exit(1)
 
-    Returns
-    -------
-    str
-        `filepath`, or a suffixed variant, that does not already exist.
 
-    Raises
-    ------
-    ValueError
-        If no unique path is found within 99 suffix attempts.
-    """
-    filepath0 = filepath
-    dirname, filename = os.path.split(filepath)
-    base, ext = os.path.splitext(filename)
+def usage_cli(argv):
+    """Run `textllm usage`.
 
-    c = 0
-    while os.path.exists(filepath):
-        c += 1
-        if c >= 100:
-            raise ValueError(f"Too many for {filepath0!r}")
+    Parameters
+    ----------
+    argv : list of str
+        Arguments after the `usage` command.
+    """
+    parser = argparse.ArgumentParser(
+        prog="textllm usage",
+        description=f"""
+            Report token usage and cost from the usage ledgers ({USAGE_LEDGER_NAME})
+            written when $TEXTLLM_USAGE_LEDGER is set. Totals are kept in an
+            incremental index in $TEXTLLM_CACHE_DIR so only new ledger lines are read.
+            """,
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=["."],
+        metavar="dir",
+        help="[.] Directories to search recursively for ledgers, or ledger files",
+    )
+    parser.add_argument(
+        "--by",
+        choices=["model", "file", "day", "purpose"],
+        default="model",
+        help="[%(default)s] How to group the report",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print the report as JSON"
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Read every ledger in full without reading or updating the index",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="count", default=0, help="Decrease Verbosity"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Increase Verbosity"
+    )
+    args = parser.parse_args(argv)
 
-        new = f"{base} ({c}){ext}"
-        filepath = os.path.join(dirname, new)
-    log.debug(f"{filepath0!r} required {c} iterations for unique name: {filepath!r}")
-    return filepath
+    _setup_logging(args.verbose - args.quiet)
+    report = usage_report(args.paths, by=args.by, use_index=not args.no_index)
 
+    if args.json:
+        print(json.dumps(report, indent=1, sort_keys=True))
+        return
 
-########################################
-########## END Filename Utils ##########
-########################################
+    total = sum(report.values(), Counter())
+    width = max([len(args.by), 5, *map(len, report)])
+    print(
+        f"{args.by:<{width}} {'turns':>7} {'prompt':>11} {'completion':>11} "
+        f"{'cached':>11} {'cost':>10}"
+    )
+    for name, row in sorted(report.items()) + [("total", total)]:
+        cost = f"${row['cost']:.4f}"
+        if row["unpriced"]:
+            cost += f" ({row['unpriced']} unpriced)"
+        print(
+            f"{name:<{width}} {row['turns']:>7} {row['prompt_tokens']:>11} "
+            f"{row['completion_tokens']:>11} {row['cached_tokens']:>11} {cost:>10}"
+        )
 
 
-def grouper(iterable, n, *, fillvalue=None):
-    """Collect data into fixed-length chunks.
+def externalize_cli(argv):
+    """Run `textllm externalize`.
 
     Parameters
     ----------
-    iterable : iterable
-        Values to group.
-    n : int
-        Chunk size.
-    fillvalue : object, optional
-        Value used to pad the last chunk.
-
-    Returns
-    -------
-    iterator
-        Iterator of `n`-tuples.
+    argv : list of str
+        Arguments after the `externalize` command.
     """
-    iterators = [iter(iterable)] * n
-    return itertools.zip_longest(*iterators, fillvalue="")
-
+    parser = argparse.ArgumentParser(
+        prog="textllm externalize",
+        description="""
+            Move pasted base64 'data:' URL images out of conversation files into
+            content-addressed files and link to them instead. The same image data
+            is sent to the model. Set $TEXTLLM_EXTERNALIZE_IMAGES to do this
+            automatically before each chat.
+            """,
+    )
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        metavar="path",
+        help="Conversation files, directories, or glob patterns",
+    )
+    parser.add_argument(
+        "--dir",
+        default=IMAGE_DIR_NAME,
+        help="[%(default)s] Image directory, relative to each conversation",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="count", default=0, help="Decrease Verbosity"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Increase Verbosity"
+    )
+    args = parser.parse_args(argv)
 
-class NoUserMessageError(ValueError):
-    """Error when a conversation does not end with a user message."""
+    _setup_logging(args.verbose - args.quiet)
+    for path in find_conversations(args.paths):
+        if count := externalize_images(path, directory=args.dir):
+            print(f"{path}: {count} image(s) moved to {args.dir!r}")
 
 
-NoHumanMessageError = NoUserMessageError
+COMMANDS = {
+    "serve": serve_cli,
+    "batch": batch_cli,
+    "usage": usage_cli,
+    "externalize": externalize_cli,
+}
 
 
 def cli(argv=None):
@@ -885,9 +4154,15 @@ def cli(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    started = time.perf_counter()
+
     parser = argparse.ArgumentParser(
         description="Simple LLM interface that reads and writes to a text file",
-        epilog="See readme.md for details on format description",
+        epilog=f"""
+            Other commands: {", ".join(COMMANDS)}. Run '%(prog)s <command> -h' for
+            their help. See readme.md for details on format description""",
         # formatter_class=argparse.RawDescriptionHelpFormatter,
     )
 
@@ -924,6 +4199,15 @@ def cli(argv=None):
             """,
     )
 
+    parser.add_argument(
+        "--events",
+        metavar="PATH",
+        help="""
+            Also append the streamed response to PATH as JSON-lines events. Use '-'
+            for stdout, which replaces the normal printed response.
+        """,
+    )
+
     parser.add_argument(
         "--require-user-prompt",
         dest="require_user_prompt",
@@ -947,12 +4231,40 @@ def cli(argv=None):
         """,
     )
 
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument(
+        "--no-cache",
+        dest="response_cache",
+        action="store_const",
+        const="off",
+        help="Do not use the response cache ($TEXTLLM_RESPONSE_CACHE) for this call.",
+    )
+    cache.add_argument(
+        "--refresh-cache",
+        dest="response_cache",
+        action="store_const",
+        const="refresh",
+        help="""
+            Call the model even if the response is cached and store the new
+            response. Works even if $TEXTLLM_RESPONSE_CACHE is not set.
+        """,
+    )
+
     parser.add_argument(
         "--version",
         action="version",
         version="%(prog)s-" + __version__,
     )
 
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="""
+            Print phase timings, time-to-first-token, and tokens/sec to stderr when
+            done. Set $TEXTLLM_METRICS_LOG to also append them to a JSON-lines file.
+        """,
+    )
+
     verb = parser.add_argument_group("Verbosity Settings:")
     verb.add_argument(
         "-q", "--quiet", action="count", default=0, help="Decrease Verbosity"
@@ -996,49 +4308,15 @@ def cli(argv=None):
 
     args = parser.parse_args(argv)
 
-    # Define logging levels
-    levels = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
-    level_index = args.verbose - args.quiet + 2  # +1: WARNING, +2: INFO
-    level_index = max(0, min(level_index, len(levels) - 1))  # Always keep ERROR
-
-    log.setLevel(logging.DEBUG)  # Highest. Handler will set lower
-    fmt = logging.Formatter(
-        "%(asctime)s:%(levelname)s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(fmt)
-    console_handler.setLevel(levels[level_index])
-
-    log.handlers.clear()
-    log.addHandler(console_handler)
-    if _test_mode_enabled():
-        logfile = f"{args.filepath}.log" if args.filepath else "log"
-        try:
-            os.makedirs(os.path.dirname(logfile))
-        except OSError:
-            pass
-        file_handler = logging.FileHandler(logfile, mode="w")
-        file_handler.setFormatter(fmt)
-        file_handler.setLevel(logging.DEBUG)
-        log.addHandler(file_handler)
+    level = _setup_logging(args.verbose - args.quiet, logfile=args.filepath)
 
     log.debug(f"{argv = }")
     log.debug(f"{args = }")
 
-    # Load the environment. Can be in three possible places (a,b,c below)
-    if CONFIG.TEXTLLM_ENV_PATH:  # (a) Specified environment variable with the path
-        if load_dotenv(CONFIG.TEXTLLM_ENV_PATH, override=True):
-            log.debug(f"Loaded env from ${CONFIG.TEXTLLM_ENV_PATH = }")
-        else:
-            log.info(f"Could not load env from specified ${CONFIG.TEXTLLM_ENV_PATH = }")
-    if load_dotenv(override=True):  # (b) a .env file
-        log.debug(f"Loaded env from a found '.env' file")
-    if args.env:  # (c) specified --env at the command line
-        if load_dotenv(args.env, override=True):
-            log.debug(f"Loaded env from args {args.env!r}")
-        else:
-            log.info(f"env file {args.env!r} not loaded or found")
+    env_started = time.perf_counter()
+    _load_environment(args.env)
+    if args.stats or CONFIG.TEXTLLM_METRICS_LOG:
+        start_metrics(started).phases["env"] = time.perf_counter() - env_started
 
     # Handle default --rename
     if args.rename is None:
@@ -1085,16 +4363,32 @@ def cli(argv=None):
             # edit returns True iff it was modified.
             raise ValueError("File not modified")
 
-        convo = Conversation(filepath)
+        if CONFIG.TEXTLLM_EXTERNALIZE_IMAGES:
+            externalize_images(filepath)
+
+        convo = Conversation(filepath, response_cache=args.response_cache)
 
-        if args.title != "off":
-            convo.set_title()  # Will do nothing if AUTO_TITLE not in the top line
         if args.title == "only":
+            convo.set_title()  # Will do nothing if AUTO_TITLE not in the top line
             if _test_mode_enabled():
                 return convo
             return
 
-        convo.chat(require_user_prompt=args.require_user_prompt)
+        with contextlib.ExitStack() as stack:
+            sinks = []
+            if args.events:
+                fp = sys.stdout
+                if args.events != "-":
+                    fp = stack.enter_context(open(args.events, "at"))
+                sinks.append(stack.enter_context(JSONLinesSink(fp)))
+
+            # The title (if needed) is generated concurrently with the response
+            convo.chat(
+                require_user_prompt=args.require_user_prompt,
+                set_title=args.title == "auto",
+                print_stream=args.events != "-",
+                sinks=sinks,
+            )
 
         if args.rename:
             convo.rename_by_title()
@@ -1104,10 +4398,26 @@ def cli(argv=None):
 
     except Exception as E:
         log.error(E)
-        if levels[level_index] == logging.DEBUG or _test_mode_enabled():
+        if level == logging.DEBUG or _test_mode_enabled():
             raise
         sys.exit(1)
 
+    finally:
+        if METRICS:
+            _finish_metrics(stats=args.stats)
+
+
+def _finish_metrics(*, stats):
+    global METRICS
+    metrics, METRICS = METRICS, None
+    if stats:
+        print(metrics.report(), file=sys.stderr)
+    if path := CONFIG.TEXTLLM_METRICS_LOG:
+        try:
+            metrics.record(path)
+        except OSError as E:
+            log.warning(f"Could not write metrics to {path!r}: {E}")
+
 
 if __name__ == "__main__":
     cli()
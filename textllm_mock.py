@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local OpenAI-compatible chat completions server for tests and load tests.
+
+It streams a synthetic reply over SSE with configurable time-to-first-token,
+token rate, chunk size, usage chunk, and error injection, so the real backend
+code paths (LiteLLM or `openai-compat`) can be exercised without a network.
+Point textllm at it with `api_base = "http://127.0.0.1:<port>/v1"`.
+
+    $ textllm-mock --port 8000 --ttft 0.3 --tokens-per-sec 80
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger("textllm.mock")
+
+WORDS = """\
+The quick brown fox jumps over the lazy dog while a mock server streams words at a
+steady pace so that textllm can be measured without calling a real provider
+""".split()
+
+
+class MockServer(ThreadingHTTPServer):
+    """OpenAI-compatible `/chat/completions` server.
+
+    Use as a context manager to serve from a background thread::
+
+        with MockServer(ttft=0.2) as server:
+            settings = {"api_base": server.url, "api_key": "sk-mock"}
+
+    Parameters
+    ----------
+    address : tuple, optional
+        `(host, port)`. Port 0 picks a free port.
+    ttft : float, optional
+        Seconds before the first content chunk.
+    tokens_per_sec : float, optional
+        Streaming rate after the first chunk. 0 streams without delay.
+    tokens : int, optional
+        Reply length in tokens (words).
+    chunk_tokens : int, optional
+        Tokens per streamed chunk.
+    usage : bool, optional
+        Send a final usage chunk when the request asks for one with
+        `stream_options={"include_usage": true}`, as OpenAI does.
+    error_rate : float, optional
+        Probability that a request fails with HTTP 500 before streaming.
+    fail_after : int, optional
+        Stream an error event after this many chunks.
+    seed : int, optional
+        Seed for `error_rate`.
+    record_requests : bool, optional
+        Keep every decoded request body in `requests`. Off by default so a
+        long-running load test does not accumulate them.
+
+    Attributes
+    ----------
+    stats : collections.Counter
+        Counts of `requests`, `errors`, and `chunks` served.
+    requests : list
+        Decoded request bodies, in order, if `record_requests` is set.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        *,
+        ttft=0.0,
+        tokens_per_sec=0.0,
+        tokens=50,
+        chunk_tokens=1,
+        usage=True,
+        error_rate=0.0,
+        fail_after=None,
+        seed=None,
+        record_requests=False,
+    ):
+        super().__init__(address, _MockHandler)
+        self.ttft = ttft
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens = tokens
+        self.chunk_tokens = max(chunk_tokens, 1)
+        self.usage = usage
+        self.error_rate = error_rate
+        self.fail_after = fail_after
+        self.random = random.Random(seed)
+        self.stats = Counter()
+        self.record_requests = record_requests
+        self.requests = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def reply_chunks(self):
+        """The reply text split into chunks of `chunk_tokens` words."""
+        words = [WORDS[ii % len(WORDS)] for ii in range(self.tokens)]
+        return [
+            " ".join(words[ii : ii + self.chunk_tokens]) + " "
+            for ii in range(0, len(words), self.chunk_tokens)
+        ]
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def should_fail(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        server.count("requests")
+        if server.record_requests:
+            with server._lock:
+                server.requests.append(body)
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self._send_json(404, _error(f"No route for {self.path}"))
+        if server.should_fail():
+            server.count("errors")
+            return self._send_json(500, _error("Injected mock server error"))
+
+        model = body.get("model", "mock-model")
+        prompt_tokens = sum(
+            len(json.dumps(msg.get("content", "")).split())
+            for msg in body.get("messages", [])
+        )
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": server.tokens,
+            "total_tokens": prompt_tokens + server.tokens,
+        }
+        chunks = server.reply_chunks()
+
+        time.sleep(server.ttft)
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": "".join(chunks)}
+            reply = _completion(model, message=message) | {"usage": usage}
+            return self._send_json(200, reply)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        delay = 0
+        if server.tokens_per_sec:
+            delay = server.chunk_tokens / server.tokens_per_sec
+        try:
+            self._send_event(_completion(model, delta={"role": "assistant"}))
+            for ii, text in enumerate(chunks):
+                if server.fail_after is not None and ii >= server.fail_after:
+                    server.count("errors")
+                    self._send_event(_error("Injected mid-stream error"))
+                    return
+                if ii and delay:
+                    time.sleep(delay)
+                self._send_event(_completion(model, delta={"content": text}))
+                server.count("chunks")
+            self._send_event(_completion(model, delta={}, finish_reason="stop"))
+            stream_options = body.get("stream_options") or {}
+            if server.usage and stream_options.get("include_usage"):
+                self._send_event(_completion(model) | {"choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            log.debug("Client disconnected mid-stream")
+
+    def _send_event(self, data):
+        self.wfile.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _send_json(self, status, data):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt % args)
+
+
+def _completion(model, *, delta=None, message=None, finish_reason=None):
+    choice = {"index": 0, "finish_reason": finish_reason}
+    if message is not None:
+        choice["message"] = message
+        obj = "chat.completion"
+    else:
+        choice["delta"] = delta or {}
+        obj = "chat.completion.chunk"
+    return {
+        "id": "chatcmpl-mock",
+        "object": obj,
+        "created": int(time.time()),
+        "model": model,
+        "choices": [choice],
+    }
+
+
+def _error(message):
+    return {"error": {"message": message, "type": "server_error", "code": 500}}
+
+
+def main(argv=None):
+    """Run the mock server until interrupted."""
+    parser = argparse.ArgumentParser(
+        prog="textllm-mock",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="[%(default)s]")
+    parser.add_argument("--port", type=int, default=8000, help="[%(default)s]")
+    parser.add_argument(
+        "--ttft", type=float, default=0.0, help="[%(default)s] Seconds to first token"
+    )
+    parser.add_argument(
+        "--tokens-per-sec",
+        type=float,
+        default=0.0,
+        help="[%(default)s] Streaming rate. 0 for no delay",
+    )
+    parser.add_argument(
+        "--tokens", type=int, default=50, help="[%(default)s] Reply length"
+    )
+    parser.add_argument(
+        "--chunk-tokens", type=int, default=1, help="[%(default)s] Tokens per chunk"
+    )
+    parser.add_argument(
+        "--no-usage", action="store_true", help="Do not send a final usage chunk"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="[%(default)s] Fraction of requests that fail with HTTP 500",
+    )
+    parser.add_argument(
+        "--fail-after",
+        type=int,
+        default=None,
+        help="Stream an error event after this many chunks",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Seed for --error-rate")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Log every request"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s:%(levelname)s: %(message)s",
+    )
+    server = MockServer(
+        (args.host, args.port),
+        ttft=args.ttft,
+        tokens_per_sec=args.tokens_per_sec,
+        tokens=args.tokens,
+        chunk_tokens=args.chunk_tokens,
+        usage=not args.no_usage,
+        error_rate=args.error_rate,
+        fail_after=args.fail_after,
+        seed=args.seed,
+    )
+    log.info(f"Serving on {server.url} (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        log.info(f"Served {dict(server.stats)}")
+
+
+if __name__ == "__main__":
+    main()